@@ -0,0 +1,112 @@
+"""Stress test of newdomain's per-user serialization
+
+Starts a hub and a newdomain on spare ports, logs in --users users, then:
+
+  * race: every user walks to the hallway and fires --burst concurrent [take torch];
+    exactly one of each user's burst may succeed and the rest must find the torch
+    already taken, never overlap the winner's hub query and transfer
+  * spread: --users x --burst [look] commands, all users at once
+  * single: the same number of [look] commands from one user
+
+Commands for one user run one at a time while different users run in parallel, so
+spread is bounded only by the servers while single queues behind one lock (the gap
+grows with hub latency). Exits non-zero if the race found any interleaving:
+
+    python3 bench/concurrency.py --users 200 --burst 10
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ADMIN = 'bench-admin-token'
+
+
+async def wait_up(session : aiohttp.ClientSession, url : str):
+    """Polls url until the server behind it answers"""
+    for _ in range(100):
+        try:
+            async with session.get(url) as r:
+                return
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f'{url} never came up')
+
+
+async def timed(session : aiohttp.ClientSession, url : str, cmds : list) -> tuple:
+    """Sends every (user, command) at once; returns the response texts and the commands per second"""
+    async def one(user, cmd):
+        body = {'user':user['id'], 'command':cmd, 'token':user['token']}
+        async with session.post(url+'/command', json=body) as r:
+            return r.status, await r.text()
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(user, cmd) for user, cmd in cmds))
+    return results, len(cmds) / (time.perf_counter() - start)
+
+
+async def main(args):
+    hub_url = f'http://localhost:{args.hub_port}'
+    domain_url = f'http://localhost:{args.domain_port}'
+    servers = [
+        subprocess.Popen([sys.executable, 'hub.py', '-p', str(args.hub_port), '--admin-token', ADMIN], cwd=ROOT, stdout=subprocess.DEVNULL),
+        subprocess.Popen([sys.executable, 'newdomain.py', '-p', str(args.domain_port), '--admin-token', ADMIN, '--state-store', 'none'], cwd=ROOT, stdout=subprocess.DEVNULL),
+    ]
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.connections)) as session:
+            await wait_up(session, hub_url+'/mode')
+            await wait_up(session, domain_url+'/metrics')
+            # No rate limits or load shedding: the point is to pile commands up
+            unlimited = {'rate':1e9, 'burst':1e9, 'concurrency':1e9}
+            for url in (hub_url, domain_url):
+                async with session.post(url+'/admin/limits', json=unlimited, headers={'Authorization':'Bearer '+ADMIN}) as r:
+                    assert r.status == 200, await r.text()
+            async with session.post(hub_url+'/domain', data=domain_url) as r: await r.text()
+            async with session.post(hub_url+'/mode', data='play') as r: await r.text()
+
+            async def login():
+                async with session.get(hub_url+'/login') as r:
+                    return await r.json()
+            users = await asyncio.gather(*(login() for _ in range(args.users)))
+
+            # race
+            await timed(session, domain_url, [(user, ['go', 'west']) for user in users])
+            takers = [user for user in users for _ in range(args.burst)]
+            results, rate = await timed(session, domain_url, [(user, ['take', 'torch']) for user in takers])
+            taken = {}
+            for user, (status, text) in zip(takers, results):
+                taken[user['id']] = taken.get(user['id'], 0) + (text == 'You take the torch.')
+            # A take that ran while another was between its hub query and transfer is refused by the hub instead
+            raced = sum(1 for status, text in results if text not in ('You take the torch.', "You've already picked that, it's in your backpack!"))
+            wrong = sum(1 for n in taken.values() if n != 1) + raced
+            print(f'  race: {len(users)} users x {args.burst} concurrent takes, {raced} interleaved, '
+                  f'{sum(1 for n in taken.values() if n != 1)} users took the torch other than once ({rate:,.0f} commands/s)')
+
+            # spread vs single
+            n = args.users * args.burst
+            results, spread = await timed(session, domain_url, [(users[i % len(users)], ['look']) for i in range(n)])
+            assert all(status == 200 for status, _ in results)
+            results, single = await timed(session, domain_url, [(users[0], ['look']) for _ in range(n)])
+            assert all(status == 200 for status, _ in results)
+            print(f'spread: {n} looks over {len(users)} users, {spread:,.0f} commands/s')
+            print(f'single: {n} looks from 1 user, {single:,.0f} commands/s')
+            return wrong
+    finally:
+        for p in servers:
+            p.terminate()
+            p.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--burst', type=int, default=10, help='concurrent commands sent for each user')
+    parser.add_argument('--connections', type=int, default=256, help='client connection pool size')
+    parser.add_argument('--hub-port', type=int, default=10341)
+    parser.add_argument('--domain-port', type=int, default=3401)
+    args = parser.parse_args()
+    sys.exit(1 if asyncio.run(main(args)) else 0)
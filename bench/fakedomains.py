@@ -0,0 +1,287 @@
+"""Hundreds of fake domains in one process, and simulated players to drive the hub through them
+
+Serves --domains fake domains from a single aiohttp server, each under its own path
+(http://localhost:PORT/d/<n>), registers them all with a hub started for the run (or
+the one at --hub, which must be in setup mode and allow that many domains), switches
+it to play mode and has --players players log in and play for --duration seconds.
+
+Each fake implements /newhub, /arrive, /depart, /dropped and /command. It answers
+after a delay drawn from --latency (scaled by --slow-factor for the --slow-domains
+fraction of them), fails with a 500 at --error-rate, hangs past any deadline at
+--hang-rate, and calls back into the hub's /query, /transfer and /score as often as
+--callbacks says (chances per /arrive and per /command).
+
+Latency specs, in seconds: fixed:S  uniform:A,B  exp:MEAN  lognormal:MEDIAN,SIGMA
+
+    python3 bench/fakedomains.py --domains 300 --players 500 --duration 30 --latency lognormal:0.02,0.8
+"""
+import argparse
+import asyncio
+import collections
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ADMIN = 'bench-admin-token'
+ROOMS = ['room-0', 'room-1', 'room-2']
+# (weight, action) for each step a player takes; 'domain' is a command sent straight to the player's domain
+ACTIONS = [(50, 'domain'), (15, 'inventory'), (10, 'score'), (10, 'journey'), (10, 'drop'), (5, 'leaderboard')]
+
+
+def parse_latency(spec : str):
+    """A function of a random.Random giving one delay, in seconds, drawn as spec says"""
+    kind, _, params = spec.partition(':')
+    p = [float(x) for x in params.split(',')] if params else []
+    if kind == 'fixed': return lambda rng: p[0]
+    if kind == 'uniform': return lambda rng: rng.uniform(p[0], p[1])
+    if kind == 'exp': return lambda rng: rng.expovariate(1/p[0]) if p[0] > 0 else 0.0
+    if kind == 'lognormal': return lambda rng: rng.lognormvariate(math.log(p[0]), p[1])
+    raise ValueError(f'unknown latency distribution {spec!r}')
+
+
+def parse_callbacks(spec : str) -> dict:
+    """'query:0.9,transfer:0.3,score:0.1' -> {'query':0.9, 'transfer':0.3, 'score':0.1}"""
+    chances = {'query':0.0, 'transfer':0.0, 'score':0.0}
+    for part in filter(None, spec.split(',')):
+        name, _, chance = part.partition(':')
+        if name not in chances: raise ValueError(f'unknown callback {name!r}')
+        chances[name] = float(chance)
+    return chances
+
+
+def percentile(values : list, q : float) -> float:
+    if not values: return float('nan')
+    values = sorted(values)
+    return values[min(len(values)-1, int(q*len(values)))]
+
+
+class FakeDomain:
+    """One simulated domain server; everything it did is tallied in stats"""
+    def __init__(self, n : int, url : str, config, stats : collections.Counter):
+        self.n, self.url, self.config, self.stats = n, url, config, stats
+        self.rng = random.Random(n)
+        self.slow = self.rng.random() < config.slow_domains
+        self.hub = self.did = self.secret = None
+        self.items = [] # template ids the hub gave our items
+        self.present = set()
+        self.scores = {} # uid : last score sent
+
+    async def respond(self, endpoint : str):
+        """Waits out this reply's latency; returns an error response if this reply should fail"""
+        self.stats[endpoint] += 1
+        delay = self.config.delay(self.rng) * (self.config.slow_factor if self.slow else 1)
+        if self.rng.random() < self.config.hang_rate:
+            self.stats[endpoint+' hung'] += 1
+            delay = 60
+        await asyncio.sleep(delay)
+        if self.rng.random() < self.config.error_rate:
+            self.stats[endpoint+' failed'] += 1
+            return web.json_response(status=500, data={'error':'simulated failure'})
+        return None
+
+    async def call_hub(self, session : aiohttp.ClientSession, path : str, body : dict):
+        body = {'domain':self.did, 'secret':self.secret} | body
+        try:
+            async with session.post(self.hub+path, json=body) as resp:
+                self.stats[f'{path} {resp.status}'] += 1
+                return await resp.json() if resp.ok else None
+        except Exception as ex:
+            self.stats[f'{path} {type(ex).__name__}'] += 1
+
+    async def callbacks(self, session : aiohttp.ClientSession, uid : int, taking : bool):
+        """Calls back into the hub as a real domain would after a move or command"""
+        chance = self.config.callbacks
+        if self.rng.random() < chance['query']:
+            await self.call_hub(session, '/query', {'user':uid, 'location':self.rng.choice(ROOMS)})
+        if self.items and self.rng.random() < chance['transfer']:
+            await self.call_hub(session, '/transfer', {'user':uid, 'item':self.rng.choice(self.items), 'to':'inventory' if taking else self.rng.choice(ROOMS)})
+        if self.rng.random() < chance['score']:
+            self.scores[uid] = min(1.0, self.scores.get(uid, 0) + 0.1)
+            await self.call_hub(session, '/score', {'user':uid, 'score':self.scores[uid]})
+
+    async def newhub(self, req : web.Request) -> web.Response:
+        self.hub = await req.text()
+        items = [{'name':f'gadget-{self.n}-{i}', 'description':'A simulated item.', 'verb':{'use':'Nothing happens.'}}
+            | ({'depth':i % 3} if i % 2 else {}) for i in range(self.config.items)]
+        async with req.app['session'].post(self.hub+'/register', json={
+            'name':f'Fake {self.n}', 'description':'A simulated domain.', 'url':self.url, 'items':items}) as resp:
+            if not resp.ok:
+                return web.json_response({'error':await resp.text()})
+            data = await resp.json()
+        self.did, self.secret, self.items = data['id'], data['secret'], data['items']
+        return web.json_response({'ok':f'Fake domain {self.n} registered.'})
+
+    async def arrive(self, req : web.Request) -> web.Response:
+        data = await req.json()
+        if data.get('secret') != self.secret: return web.Response(status=403)
+        failed = await self.respond('/arrive')
+        if failed: return failed
+        self.present.add(data['user'])
+        await self.callbacks(req.app['session'], data['user'], False)
+        return web.Response(status=200)
+
+    async def depart(self, req : web.Request) -> web.Response:
+        data = await req.json()
+        if data.get('secret') != self.secret: return web.Response(status=403)
+        failed = await self.respond('/depart')
+        if failed: return failed
+        self.present.discard(data['user'])
+        return web.Response(status=200)
+
+    async def dropped(self, req : web.Request) -> web.Response:
+        data = await req.json()
+        if data.get('secret') != self.secret: return web.Response(status=403)
+        failed = await self.respond('/dropped')
+        if failed: return failed
+        return web.json_response(self.rng.choice(ROOMS))
+
+    async def command(self, req : web.Request) -> web.Response:
+        data = await req.json()
+        if data.get('user') not in self.present:
+            self.stats['/command not arrived'] += 1
+            return web.Response(text='You have to journey to this domain before you can send it commands.')
+        failed = await self.respond('/command')
+        if failed: return failed
+        await self.callbacks(req.app['session'], data['user'], data.get('command', [''])[0] == 'take')
+        return web.Response(text='Simulated things happen.')
+
+
+def fake_app(fakes : list) -> web.Application:
+    """One server for every fake domain, routed by /d/<n>/<endpoint>"""
+    async def route(req : web.Request) -> web.StreamResponse:
+        n, endpoint = int(req.match_info['n']), req.match_info['endpoint']
+        if n >= len(fakes) or endpoint not in ('newhub', 'arrive', 'depart', 'dropped', 'command'):
+            raise web.HTTPNotFound()
+        return await getattr(fakes[n], endpoint)(req)
+    async def start(app):
+        app['session'] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+    async def stop(app):
+        await app['session'].close()
+    app = web.Application()
+    app.router.add_post('/d/{n:[0-9]+}/{endpoint}', route)
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    return app
+
+
+async def player(session : aiohttp.ClientSession, hub : str, config, until : float, timings : dict, outcomes : collections.Counter):
+    """Logs in and plays until the deadline, timing every request"""
+    rng = random.Random()
+    actions = [action for weight, action in ACTIONS for _ in range(weight)]
+    async def timed(kind, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            async with session.request(method, url, **kwargs) as resp:
+                body = await resp.read()
+                outcomes[f'{kind} {resp.status}'] += 1
+                return resp.status, body
+        except Exception as ex:
+            outcomes[f'{kind} {type(ex).__name__}'] += 1
+            return None, None
+        finally:
+            timings[kind].append(time.perf_counter() - start)
+
+    status, body = await timed('login', 'GET', hub+'/login')
+    if status != 200: return
+    me = json.loads(body)
+    creds = {'user':me['id'], 'secret':me['secret']}
+    while time.monotonic() < until:
+        await asyncio.sleep(config.think(rng))
+        action = rng.choice(actions)
+        if action == 'domain':
+            cmd = rng.choice([['look'], ['take', 'gadget'], ['go', rng.choice(['north','south','east','west'])]])
+            await timed('domain', 'POST', me['domain']['url']+'/command', json={'user':me['id'], 'command':cmd, 'token':me.get('token')})
+        elif action == 'journey':
+            await timed('journey', 'POST', hub+'/command', json=creds | {'command':['journey', rng.choice(['north','south','east','west'])]})
+        elif action == 'drop':
+            await timed('drop', 'POST', hub+'/command', json=creds | {'command':['drop', 'gadget']})
+        else:
+            await timed(action, 'POST', hub+'/command', json=creds | {'command':[action]})
+
+
+async def main(args):
+    args.delay, args.think, args.callbacks = parse_latency(args.latency), parse_latency(args.think), parse_callbacks(args.callbacks)
+    stats = collections.Counter()
+    base = f'http://localhost:{args.port}'
+    fakes = [FakeDomain(n, f'{base}/d/{n}', args, stats) for n in range(args.domains)]
+    runner = web.AppRunner(fake_app(fakes), shutdown_timeout=1)
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', args.port).start()
+
+    hub, server = args.hub, None
+    if hub is None:
+        hub = f'http://localhost:{args.hub_port}'
+        server = subprocess.Popen([sys.executable, 'hub.py', '-p', str(args.hub_port), '--admin-token', ADMIN,
+            '--max-domains', str(args.domains)], cwd=ROOT, stdout=subprocess.DEVNULL)
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.connections)) as session:
+            for _ in range(100):
+                try:
+                    async with session.get(hub+'/mode') as r: break
+                except aiohttp.ClientError:
+                    await asyncio.sleep(0.1)
+            if server is not None:
+                async with session.post(hub+'/admin/limits', json={'rate':1e9, 'burst':1e9, 'concurrency':1e9}, headers={'Authorization':'Bearer '+ADMIN}) as r:
+                    assert r.status == 200, await r.text()
+
+            gate = asyncio.Semaphore(32)
+            async def register(fake):
+                async with gate:
+                    async with session.post(hub+'/domain', data=fake.url) as r:
+                        return await r.text()
+            start = time.perf_counter()
+            answers = await asyncio.gather(*(register(fake) for fake in fakes))
+            registered = sum(1 for fake in fakes if fake.did is not None)
+            print(f'registered {registered} of {len(fakes)} fake domains in {time.perf_counter()-start:.1f}s')
+            if registered < len(fakes):
+                print('  for example:', next(a for fake, a in zip(fakes, answers) if fake.did is None))
+            async with session.post(hub+'/mode', data='play') as r:
+                print('hub:', await r.text())
+
+            timings, outcomes = collections.defaultdict(list), collections.Counter()
+            until = time.monotonic() + args.duration
+            start = time.perf_counter()
+            await asyncio.gather(*(player(session, hub, args, until, timings, outcomes) for _ in range(args.players)))
+            elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        await runner.cleanup()
+
+    total = sum(len(t) for t in timings.values())
+    print(f'{total} requests from {args.players} players in {elapsed:.1f}s ({total/elapsed:,.0f}/s)')
+    print(f'{"request":>12} {"count":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for kind, t in sorted(timings.items()):
+        print(f'{kind:>12} {len(t):8} {percentile(t,.5)*1000:8.1f} {percentile(t,.95)*1000:8.1f} {percentile(t,.99)*1000:8.1f}')
+    print('player outcomes:', ', '.join(f'{k}: {v}' for k,v in sorted(outcomes.items())))
+    print('fake domains saw:', ', '.join(f'{k}: {v}' for k,v in sorted(stats.items())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--domains', type=int, default=100)
+    parser.add_argument('--items', type=int, default=4, help='item templates each fake registers')
+    parser.add_argument('--players', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=20, help='seconds the players keep playing')
+    parser.add_argument('--think', type=str, default='exp:0.5', help='latency spec for the pause between a player\'s requests')
+    parser.add_argument('--latency', type=str, default='lognormal:0.01,0.5', help='latency spec for each fake reply')
+    parser.add_argument('--slow-domains', type=float, default=0.0, help='fraction of fakes whose latency is multiplied by --slow-factor')
+    parser.add_argument('--slow-factor', type=float, default=10.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='chance a fake reply is a 500')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='chance a fake reply takes a minute')
+    parser.add_argument('--callbacks', type=str, default='query:0.9,transfer:0.3,score:0.1', help='chance of each hub call per /arrive and /command')
+    parser.add_argument('--port', type=int, default=4000, help='where the fake domains listen')
+    parser.add_argument('--hub', type=str, default=None, help='an already running hub (in setup mode); otherwise one is started')
+    parser.add_argument('--hub-port', type=int, default=10342, help='port for the hub started when --hub is not given')
+    parser.add_argument('--connections', type=int, default=512, help='players\' connection pool size')
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,186 @@
+"""Micro-benchmarks of the servers' pure-CPU hot spots, run in-process without HTTP
+
+Builds a synthetic world (--users users, --templates item templates spread over
+--domains domains, --items placed per user), times each helper below, writes the
+results as JSON to --out and, given --baseline, flags every case that got more
+than --threshold slower than the saved run:
+
+    hub.arrive_payload        the /arrive body for a user entering a domain
+    hub.query_location        /query by location
+    hub.query_depth           /query by prize depth
+    hub.resolve_drop          drop's name and id resolution
+    hub.inventory             inventory rendering
+    hub.score                 score rendering
+    domain.find_item          newdomain find_item_in_domain against a stubbed hub
+    domain.dispatch           newdomain run_command over a mix of commands
+
+`make bench` compares against bench/baseline.json; `make bench-baseline` saves it:
+
+    python3 bench/hotspots.py --users 10000 --out bench/results.json --baseline bench/baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hub
+import newdomain
+
+
+SPOTS = ['lobby', 'hallway', 'forbidden-library', 'sealed-chamber']
+# Commands that leave the user where they are, so every timing run does the same work
+COMMANDS = [['look'], ['look', 'parchment'], ['read', 'parchment'], ['go', 'south'], ['take', 'parchment'], ['use', 'torch'], ['dance']]
+
+
+def run(coro):
+    """Runs a coroutine that never has to wait (every hub call is stubbed) to completion"""
+    try:
+        coro.send(None)
+    except StopIteration as done:
+        return done.value
+    raise RuntimeError('benchmarked coroutine waited on I/O')
+
+
+def build_world(nusers : int, ntemplates : int, ndomains : int, nitems : int, seed : int = 340) -> list:
+    """Fills hub and newdomain with a synthetic world; returns the uids"""
+    rng = random.Random(seed)
+    dids = list(range(1, ndomains+1))
+    for did in dids:
+        hub.domains[did] = {'url':f'http://domain-{did}.invalid', 'name':f'Domain {did}', 'description':'', 'secret':hub.make_secret(), 'loot':[]}
+    for tid in range(100, 100+ntemplates):
+        name = rng.choice(hub.item_names)
+        hub.templates[tid] = {'name':name, 'description':f'A {name}.', 'verb':{'use':f'You use the {name}.'}, 'home':rng.choice(dids)}
+        if rng.random() < 0.25:
+            hub.templates[tid]['depth'] = rng.randrange(3)
+            hub.domains[rng.choice(dids)]['loot'].append(tid)
+
+    # This newdomain is domain 1, with its own items among the templates
+    newdomain.HUB_URL, newdomain.DOMAIN_ID, newdomain.DOMAIN_SECRET = 'http://hub.invalid', 1, hub.domains[1]['secret']
+    for tid, item in zip(range(100, 100+ntemplates), newdomain.DOMAIN_ITEMS):
+        hub.templates[tid] = {k:v for k,v in item.items() if k != 'depth'} | {'home':1}
+    # and, as if every other item had been brought in by someone's /arrive, knowing all the rest too
+    for tid, t in sorted(hub.templates.items(), key=lambda kv: kv[1]['home'] == 1):
+        newdomain.ID_2_ITEM[tid] = {k:v for k,v in t.items() if k in ('name','description','verb','depth')}
+        newdomain.ITEM_NAMES.add(t['name'], tid)
+        if t['home'] == 1: newdomain.NAME_2_ID[t['name']] = tid
+
+    uids = []
+    tids = list(hub.templates)
+    for _ in range(nusers):
+        uid = hub.users.add(hub.make_secret(), 1)
+        for tid in rng.sample(tids, min(nitems, len(tids))):
+            hub.users.move(uid, tid, 'inventory' if rng.random() < 0.5 else (rng.choice(dids), rng.choice(SPOTS)))
+        for did in rng.sample(dids, min(3, len(dids))):
+            hub.users.set_score(uid, did, rng.random())
+        state = newdomain.load_user_state(uid, create=True)
+        state['arrived'] = True
+        uids.append(uid)
+    return uids
+
+
+class StubResponse:
+    """Just enough of aiohttp's ClientResponse for hub_query and hub_transfer"""
+    def __init__(self, data): self.data, self.ok = data, True
+    async def __aenter__(self): return self
+    async def __aexit__(self, *exc): return False
+    async def json(self): return self.data
+
+class StubHub:
+    """Stands in for newdomain's app.client, answering from the in-process hub state"""
+    def post(self, url, json=None, **kwargs):
+        path = url.rsplit('/', 1)[-1]
+        if path == 'query':
+            return StubResponse(hub.query_items(json['user'], json['domain'], json.get('location'), json.get('depth')))
+        return StubResponse({'ok':'stubbed'})
+
+class StubApp:
+    client = StubHub()
+
+
+def cases() -> dict:
+    """name -> function of (uid, rng) that exercises that hot spot once"""
+    app = StubApp()
+    names = hub.item_names + [str(tid) for tid in list(hub.templates)[:50]]
+    domain_names = newdomain.ITEM_NAMES.names or ['parchment']
+    def find_item(uid, rng):
+        newdomain.QUERY_CACHE.set({})
+        return run(newdomain.find_item_in_domain(app, uid, rng.choice(domain_names)))
+    def dispatch(uid, rng):
+        newdomain.QUERY_CACHE.set({})
+        return run(newdomain.run_command(app, uid, newdomain.USER_STATES[uid], rng.choice(COMMANDS)))
+    return {
+        'hub.arrive_payload': lambda uid, rng: hub.arrive_payload(uid, rng.choice(tuple(hub.domains)), 'login'),
+        'hub.query_location': lambda uid, rng: hub.query_items(uid, 1, rng.choice(SPOTS)),
+        'hub.query_depth': lambda uid, rng: hub.query_items(uid, 1, None, rng.randrange(3)),
+        'hub.resolve_drop': lambda uid, rng: hub.resolve_drop(uid, [rng.choice(names)]),
+        'hub.inventory': lambda uid, rng: run(hub.inventory(uid, [])),
+        'hub.score': lambda uid, rng: run(hub.score(uid, [])),
+        'domain.find_item': find_item,
+        'domain.dispatch': dispatch,
+    }
+
+
+def measure(fn, uids : list, ops : int, repeat : int) -> float:
+    """Best-of-repeat microseconds per call of fn over ops randomly chosen users (the same ones each run)"""
+    best = float('inf')
+    for _ in range(repeat):
+        rng = random.Random(1)
+        picks = [rng.choice(uids) for _ in range(ops)]
+        start = time.perf_counter()
+        for uid in picks:
+            fn(uid, rng)
+        best = min(best, (time.perf_counter() - start) / ops * 1e6)
+    return best
+
+
+def compare(results : dict, baseline : dict, threshold : float) -> list:
+    """Prints each case against the baseline; returns the names of the regressions"""
+    regressions = []
+    for name, now in results['results'].items():
+        then = baseline['results'].get(name)
+        if then is None:
+            print(f'{name:>20}: {now["us/op"]:10.2f} us/op  (new)')
+            continue
+        ratio = now['us/op'] / then['us/op']
+        flag = 'REGRESSION' if ratio > 1+threshold else 'faster' if ratio < 1-threshold else ''
+        if flag == 'REGRESSION': regressions.append(name)
+        print(f'{name:>20}: {now["us/op"]:10.2f} us/op  vs {then["us/op"]:10.2f}  x{ratio:5.2f}  {flag}')
+    if baseline.get('world') != results['world']:
+        print('note: the baseline was measured on a different world:', baseline.get('world'))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--templates', type=int, default=200)
+    parser.add_argument('--domains', type=int, default=20)
+    parser.add_argument('--items', type=int, default=12, help='item placements per user')
+    parser.add_argument('--ops', type=int, default=20000, help='calls per timing run')
+    parser.add_argument('--repeat', type=int, default=5, help='timing runs per case (the best is kept)')
+    parser.add_argument('--out', type=str, default=None, help='write the results here as JSON')
+    parser.add_argument('--baseline', type=str, default=None, help='compare against results saved earlier')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown (as a fraction) reported as a regression')
+    args = parser.parse_args()
+
+    world = {'users':args.users, 'templates':args.templates, 'domains':args.domains, 'items':args.items}
+    uids = build_world(args.users, args.templates, args.domains, args.items)
+    results = {'world':world, 'python':platform.python_version(), 'when':time.strftime('%Y-%m-%dT%H:%M:%S'), 'results':{}}
+    for name, fn in cases().items():
+        results['results'][name] = {'us/op':measure(fn, uids, args.ops, args.repeat), 'ops':args.ops}
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        sys.exit(1 if regressions else 0)
+    for name, r in results['results'].items():
+        print(f'{name:>20}: {r["us/op"]:10.2f} us/op')
+    if args.baseline:
+        print(f'no baseline at {args.baseline} yet; save one with `make bench-baseline`')
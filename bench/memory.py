@@ -0,0 +1,65 @@
+"""Bytes per user of the hub's user store, before (dict per user) and after (UserStore)
+
+Builds the same synthetic population both ways and measures it with tracemalloc:
+
+    python3 bench/memory.py --users 200000
+"""
+import argparse
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hub
+
+
+def population(n : int, ntemplates : int, seed : int = 340):
+    """Yields (secret, domain, placements, had, score) for n synthetic users"""
+    rng = random.Random(seed)
+    tids = [100+i for i in range(ntemplates)]
+    spots = ['lobby', 'hallway', 'forbidden-library', 'sealed-chamber']
+    for _ in range(n):
+        held = rng.sample(tids, rng.randrange(2, min(8, ntemplates)))
+        placements = {tid:('inventory' if rng.random() < .7 else (7, rng.choice(spots))) for tid in held}
+        yield hub.make_secret(), 7, placements, set(held), {7:rng.choice((0, 0.5, 1.0))}
+
+
+def legacy(people) -> dict:
+    """The original layout: one dict of containers per user"""
+    users = {}
+    for secret, did, placements, had, score in people:
+        users[len(users)] = {'secret':secret, 'in':did, 'open':[did], 'inventory':dict(placements),
+            'domstate':0, 'score':dict(score), 'hashad':set(had)}
+    return users
+
+def columnar(people) -> hub.UserStore:
+    users = hub.UserStore()
+    for secret, did, placements, had, score in people:
+        uid = users.add(secret, did)
+        for tid, loc in placements.items(): users.move(uid, tid, loc)
+        for tid in had: users.mark_had(uid, tid)
+        for k, v in score.items(): users.set_score(uid, k, v)
+    return users
+
+def measure(build, people) -> int:
+    """Bytes still allocated after building (and keeping) a store"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = build(people)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del store
+    return after - before
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--templates', type=int, default=16)
+    args = parser.parse_args()
+
+    people = list(population(args.users, args.templates))
+    for name, build in (('dict per user', legacy), ('UserStore', columnar)):
+        used = measure(build, people)
+        print(f'{name:>14}: {used/args.users:8.1f} bytes/user ({used/2**20:.1f} MiB for {args.users} users)')
@@ -0,0 +1,103 @@
+"""Creating an event's players: a storm of /login calls versus one /admin/users call
+
+Starts a hub and a newdomain on spare ports, then creates --users players twice: first
+as --concurrency parallel /login calls, then (after restarting both servers) with one
+POST /admin/users, whose arrivals reach the domain as batched /arrive calls. Reports the
+time each took and checks that a sample of the provisioned players can play at once:
+
+    python3 bench/provision.py --users 2000
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ADMIN = 'bench-admin-token'
+
+
+async def wait_up(session : aiohttp.ClientSession, url : str):
+    """Polls url until the server behind it answers"""
+    for _ in range(100):
+        try:
+            async with session.get(url) as r:
+                return
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f'{url} never came up')
+
+
+async def logins(session : aiohttp.ClientSession, hub_url : str, n : int, concurrency : int) -> list:
+    gate = asyncio.Semaphore(concurrency)
+    async def one():
+        async with gate:
+            async with session.get(hub_url+'/login') as r:
+                assert r.status == 200, await r.text()
+                return await r.json()
+    return await asyncio.gather(*(one() for _ in range(n)))
+
+
+async def provision(session : aiohttp.ClientSession, hub_url : str, n : int) -> list:
+    created = []
+    while len(created) < n:
+        count = min(n - len(created), 10000)
+        async with session.post(hub_url+'/admin/users', json={'count':count}, headers={'Authorization':'Bearer '+ADMIN}) as r:
+            assert r.status == 200, await r.text()
+            created += await r.json()
+    return created
+
+
+async def measure(how : str, args) -> float:
+    hub_url, domain_url = f'http://localhost:{args.hub_port}', f'http://localhost:{args.domain_port}'
+    servers = [
+        subprocess.Popen([sys.executable, 'hub.py', '-p', str(args.hub_port), '--admin-token', ADMIN], cwd=ROOT, stdout=subprocess.DEVNULL),
+        subprocess.Popen([sys.executable, 'newdomain.py', '-p', str(args.domain_port), '--admin-token', ADMIN, '--state-store', 'none'], cwd=ROOT, stdout=subprocess.DEVNULL),
+    ]
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+            await wait_up(session, hub_url+'/mode')
+            await wait_up(session, domain_url+'/metrics')
+            for url in (hub_url, domain_url):
+                async with session.post(url+'/admin/limits', json={'rate':1e9, 'burst':1e9, 'concurrency':1e9}, headers={'Authorization':'Bearer '+ADMIN}) as r:
+                    assert r.status == 200, await r.text()
+            async with session.post(hub_url+'/domain', data=domain_url) as r: await r.text()
+            async with session.post(hub_url+'/mode', data='play') as r: await r.text()
+
+            start = time.perf_counter()
+            if how == 'login':
+                players = await logins(session, hub_url, args.users, args.concurrency)
+            else:
+                players = await provision(session, hub_url, args.users)
+            elapsed = time.perf_counter() - start
+
+            for me in random.Random(340).sample(players, min(50, len(players))):
+                async with session.post(domain_url+'/command', json={'user':me['id'], 'command':['look'], 'token':me['token']}) as r:
+                    text = await r.text()
+                    assert r.status == 200 and 'journey' not in text, f'user {me["id"]} cannot play: {text}'
+            return elapsed
+    finally:
+        for p in servers:
+            p.terminate()
+            p.wait()
+
+
+async def main(args):
+    login = await measure('login', args)
+    print(f'{args.users} /login calls, {args.concurrency} at a time: {login:.2f}s ({args.users/login:,.0f} users/s)')
+    bulk = await measure('bulk', args)
+    print(f'/admin/users for {args.users} users: {bulk:.2f}s ({args.users/bulk:,.0f} users/s, x{login/bulk:.1f})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=256, help='/login calls in flight at once')
+    parser.add_argument('--hub-port', type=int, default=10346)
+    parser.add_argument('--domain-port', type=int, default=3406)
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,166 @@
+"""Replay traffic recorded by `hub.py --record` and `newdomain.py --record` against a fresh deployment
+
+Merges the record files by time, starts a hub and a newdomain on spare ports (or uses
+--hub, a hub in setup mode with a domain to register at --domain), and re-sends every
+/login and /command. Each recorded /login becomes a new login and that player's later
+commands are sent with the new user id, secret and token. One player's requests stay
+in order; different players overlap as they did when recorded.
+
+--speed 1 keeps the recorded timing, --speed N compresses it N times and --speed max
+sends each player's next request as soon as the last one is answered. The report puts
+each request type's error rate and latency next to the recorded ones:
+
+    python3 hub.py --record hub.rec & python3 newdomain.py --record domain.rec   # then play
+    python3 bench/replay.py hub.rec domain.rec --speed 10
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ADMIN = 'bench-admin-token'
+
+
+def load(paths : list) -> list:
+    """Every record in the files, oldest first; a torn last line (the server was killed mid-write) is skipped"""
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try: records.append(json.loads(line))
+                except ValueError: pass
+    records.sort(key=lambda r: r['t'])
+    return records
+
+
+def by_player(records : list) -> tuple:
+    """Splits the records into per-player lists, each starting at its /login; also counts records with no login"""
+    players, orphans = {}, 0
+    for r in records:
+        if r['path'] == '/login':
+            if r['status'] == 200: players[r['user']] = [r]
+        elif r.get('user') in players:
+            players[r['user']].append(r)
+        else:
+            orphans += 1
+    return list(players.values()), orphans
+
+
+def percentile(values : list, q : float) -> float:
+    if not values: return float('nan')
+    values = sorted(values)
+    return values[min(len(values)-1, int(q*len(values)))]
+
+
+async def replay(session : aiohttp.ClientSession, hub : str, records : list, t0 : float, start : float, speed : float | None, results : list):
+    """Plays one player's records in order; appends (record, status, ms) to results"""
+    me = None
+    for r in records:
+        if speed is not None:
+            await asyncio.sleep(max(0, start + (r['t']-t0)/speed - time.monotonic()))
+        if r['path'] == '/login':
+            method, url, body = 'GET', hub+'/login', None
+        elif me is None:
+            results.append((r, None, None))
+            continue
+        elif r['srv'] == 'hub':
+            method, url, body = 'POST', hub+'/command', {'user':me['id'], 'secret':me['secret']}
+        else:
+            method, url, body = 'POST', me['domain']['url']+'/command', {'user':me['id'], 'token':me.get('token')}
+        if body is not None:
+            if 'cmds' in r: body['commands'] = r['cmds']
+            else: body['command'] = r.get('cmd')
+        before = time.perf_counter()
+        try:
+            async with session.request(method, url, json=body) as resp:
+                data = await resp.read()
+                status = resp.status
+        except Exception:
+            status = None
+        results.append((r, status, (time.perf_counter()-before)*1000))
+        if r['path'] == '/login':
+            me = json.loads(data) if status == 200 else None
+
+
+def report(results : list, elapsed : float, recorded : float):
+    rows = collections.defaultdict(lambda: {'then':[], 'now':[], 'then_err':0, 'now_err':0})
+    for r, status, ms in results:
+        row = rows[(r['srv'], r['path'])]
+        row['then'].append(r['ms'])
+        row['then_err'] += r['status'] >= 400
+        if ms is not None: row['now'].append(ms)
+        row['now_err'] += status is None or status >= 400
+    print(f'replayed {len(results)} requests in {elapsed:.1f}s (recorded over {recorded:.1f}s)')
+    print(f'{"request":>16} {"count":>7} {"errors then":>12} {"now":>7} {"p50 ms then":>12} {"now":>7} {"p95 ms then":>12} {"now":>7}')
+    for (srv, path), row in sorted(rows.items()):
+        n = len(row['then'])
+        print(f'{srv+" "+path:>16} {n:7} {row["then_err"]/n:12.1%} {row["now_err"]/n:7.1%}'
+              f' {percentile(row["then"],.5):12.1f} {percentile(row["now"],.5):7.1f}'
+              f' {percentile(row["then"],.95):12.1f} {percentile(row["now"],.95):7.1f}')
+
+
+async def main(args):
+    records = load(args.records)
+    if not records:
+        sys.exit('nothing recorded in '+', '.join(args.records))
+    players, orphans = by_player(records)
+    if orphans:
+        print(f'skipping {orphans} requests from players whose /login was not recorded')
+    speed = None if args.speed == 'max' else float(args.speed)
+
+    hub, domain, servers = args.hub, args.domain, []
+    if hub is None:
+        hub, domain = f'http://localhost:{args.hub_port}', f'http://localhost:{args.domain_port}'
+        servers = [
+            subprocess.Popen([sys.executable, 'hub.py', '-p', str(args.hub_port), '--admin-token', ADMIN], cwd=ROOT, stdout=subprocess.DEVNULL),
+            subprocess.Popen([sys.executable, 'newdomain.py', '-p', str(args.domain_port), '--admin-token', ADMIN, '--state-store', 'none'], cwd=ROOT, stdout=subprocess.DEVNULL),
+        ]
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.connections)) as session:
+            for url in (hub+'/mode', domain+'/metrics'):
+                for _ in range(100):
+                    try:
+                        async with session.get(url) as r: break
+                    except aiohttp.ClientError:
+                        await asyncio.sleep(0.1)
+            if args.unlimited:
+                for url in (hub, domain):
+                    async with session.post(url+'/admin/limits', json={'rate':1e9, 'burst':1e9, 'concurrency':1e9}, headers={'Authorization':'Bearer '+ADMIN}) as r:
+                        assert r.status == 200, await r.text()
+            async with session.post(hub+'/domain', data=domain) as r: await r.text()
+            async with session.post(hub+'/mode', data='play') as r: await r.text()
+
+            results = []
+            t0, start = records[0]['t'], time.monotonic()
+            await asyncio.gather(*(replay(session, hub, p, t0, start, speed, results) for p in players))
+            elapsed = time.monotonic() - start
+    finally:
+        for p in servers:
+            p.terminate()
+            p.wait()
+    report(results, elapsed, records[-1]['t'] - t0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('records', nargs='+', help='files written by --record on the hub and domain')
+    parser.add_argument('--speed', type=str, default='1', help='1 for recorded timing, N for N times faster, or max')
+    parser.add_argument('--hub', type=str, default=None, help='an already running hub in setup mode; otherwise one is started')
+    parser.add_argument('--domain', type=str, default=None, help='the domain to register with --hub')
+    parser.add_argument('--hub-port', type=int, default=10343)
+    parser.add_argument('--domain-port', type=int, default=3403)
+    parser.add_argument('--unlimited', action='store_true', help='lift rate limits and load shedding on the servers started here')
+    parser.add_argument('--connections', type=int, default=256, help='client connection pool size')
+    args = parser.parse_args()
+    if args.hub is not None and args.domain is None:
+        parser.error('--hub needs --domain')
+    if args.hub is not None and args.unlimited:
+        parser.error('--unlimited only applies to the servers started here')
+    asyncio.run(main(args))
@@ -0,0 +1,68 @@
+"""Throughput of the hub's user-store backends under the handlers' access pattern
+
+Logs in --users users, then replays --ops store operations drawn with the mix seen
+when playing newdomain (mostly /query placement listings, then transfers, secret
+checks and scores), flushing as the hub's timer would:
+
+    python3 bench/storage.py --users 100000 --ops 200000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hub
+
+
+TIDS = list(range(100, 116))
+SPOTS = ['lobby', 'hallway', 'forbidden-library', 'sealed-chamber']
+# (weight, operation name), from the /query : /transfer : /command ratios of a play-through
+MIX = [(55, 'placements'), (10, 'placement'), (10, 'move'), (10, 'secret'), (5, 'has_had'), (3, 'mark_had'), (4, 'score'), (3, 'set_score')]
+
+
+def run(store : hub.UserBackend, nusers : int, nops : int, flush_every : int, seed : int = 340) -> dict:
+    """Times the login phase and the mixed phase on one backend"""
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    for _ in range(nusers):
+        uid = store.add(hub.make_secret(), 7)
+        for tid in rng.sample(TIDS, 3):
+            store.move(uid, tid, 'inventory')
+            store.mark_had(uid, tid)
+        store.set_score(uid, 7, 0)
+        if uid % flush_every == 0: store.flush()
+    store.flush()
+    login = time.perf_counter() - start
+
+    names = [name for weight, name in MIX for _ in range(weight)]
+    plan = [(rng.choice(names), rng.randrange(nusers), rng.choice(TIDS)) for _ in range(nops)]
+    start = time.perf_counter()
+    for i, (name, uid, tid) in enumerate(plan):
+        if name == 'placements': store.placements(uid)
+        elif name == 'placement': store.placement(uid, tid)
+        elif name == 'move': store.move(uid, tid, rng.choice(('inventory', (7, rng.choice(SPOTS)))))
+        elif name == 'secret': store.secret(uid)
+        elif name == 'has_had': store.has_had(uid, tid)
+        elif name == 'mark_had': store.mark_had(uid, tid)
+        elif name == 'score': store.score(uid, 7)
+        elif name == 'set_score': store.set_score(uid, 7, rng.random())
+        if i % flush_every == 0: store.flush()
+    store.flush()
+    mixed = time.perf_counter() - start
+    return {'logins/s':nusers/login, 'ops/s':nops/mixed, 'us/op':mixed/nops*1e6}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--ops', type=int, default=200000)
+    parser.add_argument('--flush-every', type=int, default=500, help='operations per commit (about flush_interval at hub load)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, store in (('memory', hub.UserStore()), ('sqlite', hub.SQLiteUserStore(os.path.join(tmp, 'users.sqlite')))):
+            result = run(store, args.users, args.ops, args.flush_every)
+            print(f'{name:>7}: ' + ', '.join(f'{v:,.1f} {k}' for k,v in result.items()))
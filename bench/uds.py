@@ -0,0 +1,107 @@
+"""Hub <-> domain calls over loopback TCP versus a Unix domain socket
+
+For each transport, starts a hub and a newdomain (both also listening on Unix sockets
+in a temporary directory), registers the domain by its http:// or unix: URL so that
+every server-to-server call takes that transport, then measures
+
+  * call: --calls sequential POSTs to the domain's /dropped, the cheapest peer endpoint
+  * journey: --journeys sequential journeys, each a hub /depart and /arrive plus the
+    domain's /transfer calls back, with the CPU time both servers spent per journey
+
+    python3 bench/uds.py --calls 5000 --journeys 1000
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ADMIN = 'bench-admin-token'
+
+
+def cpu_seconds(pid : int) -> float:
+    """User plus system CPU time used so far by a process (Linux /proc)"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def percentile(values : list, q : float) -> float:
+    values = sorted(values)
+    return values[min(len(values)-1, int(q*len(values)))]
+
+
+async def measure(transport : str, args, tmp : str) -> dict:
+    hub_sock, domain_sock = os.path.join(tmp, f'hub-{transport}.sock'), os.path.join(tmp, f'domain-{transport}.sock')
+    hub, domain = f'http://localhost:{args.hub_port}', f'http://localhost:{args.domain_port}'
+    servers = [
+        subprocess.Popen([sys.executable, 'hub.py', '-p', str(args.hub_port), '--unix', hub_sock, '--admin-token', ADMIN], cwd=ROOT, stdout=subprocess.DEVNULL),
+        subprocess.Popen([sys.executable, 'newdomain.py', '-p', str(args.domain_port), '--unix', domain_sock, '--admin-token', ADMIN, '--state-store', 'none'], cwd=ROOT, stdout=subprocess.DEVNULL),
+    ]
+    try:
+        async with aiohttp.ClientSession() as session:
+            for url in (hub+'/mode', domain+'/metrics'):
+                for _ in range(100):
+                    try:
+                        async with session.get(url) as r: break
+                    except aiohttp.ClientError:
+                        await asyncio.sleep(0.1)
+            for url in (hub, domain):
+                async with session.post(url+'/admin/limits', json={'rate':1e9, 'burst':1e9, 'concurrency':1e9}, headers={'Authorization':'Bearer '+ADMIN}) as r:
+                    assert r.status == 200, await r.text()
+            async with session.post(hub+'/domain', data=domain if transport == 'tcp' else 'unix:'+domain_sock) as r:
+                print(f'{transport:>5}: {await r.text()}')
+            async with session.post(hub+'/mode', data='play') as r: await r.text()
+            async with session.get(hub+'/login') as r: me = await r.json()
+
+        # The bench's own calls to the domain take the same transport the hub's do
+        connector = aiohttp.TCPConnector() if transport == 'tcp' else aiohttp.UnixConnector(path=domain_sock)
+        async with aiohttp.ClientSession(connector=connector) as peer:
+            url = domain+'/dropped' if transport == 'tcp' else 'http://unix/dropped'
+            calls = []
+            for _ in range(args.calls):
+                before = time.perf_counter()
+                async with peer.post(url, json={'user':me['id']}) as r: await r.read()
+                calls.append(time.perf_counter() - before)
+
+        async with aiohttp.ClientSession() as session:
+            cpu = sum(cpu_seconds(p.pid) for p in servers)
+            before = time.perf_counter()
+            for i in range(args.journeys):
+                async with session.post(hub+'/command', json={'user':me['id'], 'secret':me['secret'], 'command':['journey', 'east']}) as r:
+                    assert r.status == 200, await r.text()
+            journeys = time.perf_counter() - before
+            cpu = sum(cpu_seconds(p.pid) for p in servers) - cpu
+    finally:
+        for p in servers:
+            p.terminate()
+            p.wait()
+    return {
+        'call p50 us': percentile(calls, .5)*1e6,
+        'call p99 us': percentile(calls, .99)*1e6,
+        'journey ms': journeys/args.journeys*1000,
+        'server cpu ms/journey': cpu/args.journeys*1000,
+    }
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {transport: await measure(transport, args, tmp) for transport in ('tcp', 'unix')}
+    for name in results['tcp']:
+        tcp, unix = results['tcp'][name], results['unix'][name]
+        print(f'{name:>22}: tcp {tcp:9.1f}  unix {unix:9.1f}  ({unix/tcp-1:+.0%})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=5000)
+    parser.add_argument('--journeys', type=int, default=1000)
+    parser.add_argument('--hub-port', type=int, default=10344)
+    parser.add_argument('--domain-port', type=int, default=3404)
+    args = parser.parse_args()
+    asyncio.run(main(args))
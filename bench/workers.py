@@ -0,0 +1,103 @@
+"""newdomain throughput as worker processes are added
+
+For each worker count in --workers, starts a hub and a newdomain (`--workers N`, users
+kept in a fresh SQLite state store; 0 means a plain single process with no store),
+logs in --users users, then sends --commands commands spread over them with at most
+--concurrency in flight, once per mix:
+
+  * local: [go south] in the lobby, answered by the domain alone
+  * hub: [look], which also queries the hub, so the single hub caps it however many workers
+
+    python3 bench/workers.py --workers 0 1 2 4 --users 200 --commands 20000
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ADMIN = 'bench-admin-token'
+MIXES = {'local': ['go', 'south'], 'hub': ['look']}
+
+
+async def wait_up(session : aiohttp.ClientSession, url : str):
+    """Polls url until the server behind it answers"""
+    for _ in range(200):
+        try:
+            async with session.get(url) as r:
+                return
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f'{url} never came up')
+
+
+async def throughput(session : aiohttp.ClientSession, url : str, users : list, cmd : list, n : int, concurrency : int) -> float:
+    """Commands per second for n copies of cmd over the users, at most concurrency at once"""
+    gate = asyncio.Semaphore(concurrency)
+    async def one(user):
+        async with gate:
+            async with session.post(url+'/command', json={'user':user['id'], 'command':cmd, 'token':user['token']}) as r:
+                assert r.status == 200, await r.text()
+                await r.read()
+    start = time.perf_counter()
+    await asyncio.gather(*(one(users[i % len(users)]) for i in range(n)))
+    return n / (time.perf_counter() - start)
+
+
+async def measure(workers : int, args, tmp : str) -> dict:
+    hub_url, domain_url = f'http://localhost:{args.hub_port}', f'http://localhost:{args.domain_port}'
+    domain = [sys.executable, 'newdomain.py', '-p', str(args.domain_port), '--admin-token', ADMIN]
+    if workers:
+        domain += ['--workers', str(workers), '--state-store', 'sqlite:'+os.path.join(tmp, f'state-{workers}.sqlite')]
+    else:
+        domain += ['--state-store', 'none']
+    servers = [
+        subprocess.Popen([sys.executable, 'hub.py', '-p', str(args.hub_port), '--admin-token', ADMIN], cwd=ROOT, stdout=subprocess.DEVNULL),
+        subprocess.Popen(domain, cwd=ROOT, stdout=subprocess.DEVNULL),
+    ]
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+            await wait_up(session, hub_url+'/mode')
+            await wait_up(session, domain_url+'/metrics')
+            for url in (hub_url, domain_url):
+                async with session.post(url+'/admin/limits', json={'rate':1e9, 'burst':1e9, 'concurrency':1e9}, headers={'Authorization':'Bearer '+ADMIN}) as r:
+                    assert r.status == 200, await r.text()
+            async with session.post(hub_url+'/domain', data=domain_url) as r: await r.text()
+            async with session.post(hub_url+'/mode', data='play') as r: await r.text()
+
+            async def login():
+                async with session.get(hub_url+'/login') as r:
+                    return await r.json()
+            users = await asyncio.gather(*(login() for _ in range(args.users)))
+            return {mix: await throughput(session, domain_url, users, cmd, args.commands, args.concurrency) for mix, cmd in MIXES.items()}
+    finally:
+        for p in servers:
+            p.terminate()
+            p.wait()
+
+
+async def main(args):
+    print(f'{"workers":>8} ' + ' '.join(f'{mix+" cmd/s":>14}' for mix in MIXES))
+    first = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in args.workers:
+            rates = await measure(workers, args, tmp)
+            first = first or rates
+            print(f'{workers or "single":>8} ' + ' '.join(f'{rates[mix]:9,.0f} x{rates[mix]/first[mix]:3.1f}' for mix in MIXES))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4], help='worker counts to measure (0: no --workers at all)')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--commands', type=int, default=20000, help='commands sent per mix')
+    parser.add_argument('--concurrency', type=int, default=256, help='most commands in flight at once')
+    parser.add_argument('--hub-port', type=int, default=10345)
+    parser.add_argument('--domain-port', type=int, default=3405)
+    args = parser.parse_args()
+    asyncio.run(main(args))
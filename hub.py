@@ -1,9 +1,414 @@
 from aiohttp import web
+from array import array
+import asyncio
+import base64
+import bisect
+import collections
+import contextlib
+import contextvars
+import gzip
+import hashlib
+import hmac
+import json
+import math
+import mimetypes
+import os
 import random
+import sqlite3
+import stat
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+try: import brotli # optional: br-encoded copies of the front-end
+except ImportError: brotli = None
 
 routes = web.RouteTableDef()
 
 
+###########################
+###  Section: user store  ###
+
+
+class UserBackend:
+    """The operations hub handlers perform on user data; see UserStore and SQLiteUserStore
+
+    Users are numbered 0, 1, 2, ... in login order. A location is either "inventory"
+    or a (domain_id, spot) pair naming where an item was dropped or placed.
+    """
+    def clear(self) -> None:
+        """Forget every user"""
+        raise NotImplementedError
+    def __len__(self) -> int:
+        raise NotImplementedError
+    def __contains__(self, uid) -> bool:
+        return isinstance(uid, int) and not isinstance(uid, bool) and 0 <= uid < len(self)
+    def add(self, secret : str, did : int) -> int:
+        """Creates a user in domain did, returning their uid"""
+        raise NotImplementedError
+    def secret(self, uid : int) -> str:
+        raise NotImplementedError
+    def domain(self, uid : int) -> int:
+        """The domain the user is in"""
+        raise NotImplementedError
+    def domstate(self, uid : int) -> int:
+        """Progress through the simulated other domains"""
+        raise NotImplementedError
+    def set_domstate(self, uid : int, value : int) -> None:
+        raise NotImplementedError
+    def placements(self, uid : int) -> dict:
+        """{template_id: location} for every item the user has placed, in placement order"""
+        raise NotImplementedError
+    def placement(self, uid : int, tid : int):
+        """Where the user's copy of an item is, or None if it has not been placed"""
+        raise NotImplementedError
+    def move(self, uid : int, tid : int, loc) -> None:
+        """Places (or re-places) the user's copy of an item"""
+        raise NotImplementedError
+    def has_had(self, uid : int, tid : int) -> bool:
+        """Whether the item was ever in the user's inventory"""
+        raise NotImplementedError
+    def mark_had(self, uid : int, tid : int) -> None:
+        raise NotImplementedError
+    def scores(self, uid : int) -> dict:
+        """{domain_id: score} for every domain the user has arrived in"""
+        raise NotImplementedError
+    def score(self, uid : int, did : int) -> float | None:
+        """The user's score in one domain, or None if they never arrived there"""
+        raise NotImplementedError
+    def set_score(self, uid : int, did : int, value : float) -> None:
+        raise NotImplementedError
+    def flush(self) -> None:
+        """Makes buffered writes durable; called periodically and at shutdown"""
+        pass
+
+
+class UserStore(UserBackend):
+    """Compact, columnar in-memory storage for every user the hub knows about
+
+    Users are numbered 0, 1, 2, ... in login order. Scalar fields live in uid-indexed
+    arrays, which templates a user has ever had is a fixed-width row of a shared bitset,
+    and item placements are packed (template index, location code) pairs whose locations
+    are interned in one table shared by all users.
+    """
+    SECRET_LEN = 16 # make_secret() default length
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.secrets = bytearray() # SECRET_LEN ascii bytes per user
+        self.where = array('i') # domain each user is in
+        self.domstates = array('b') # progress through the simulated other domains
+        self.points = {} # domain_id : array('d') of scores by uid, nan if never arrived there
+        self.had = bytearray() # row of `stride` bytes per user, one bit per template index
+        self.stride = 0
+        self.placed = [] # uid : bytes of array('I') (template index, location code) pairs
+        self.template_ids = [] # template index : template id
+        self.template_index = {} # template id : template index
+        self.locations = [] # location code : location ("inventory" or (domain_id, spot))
+        self.location_codes = {} # interning key : location code
+
+    def __len__(self) -> int:
+        return len(self.where)
+
+    def add(self, secret : str, did : int) -> int:
+        raw = secret.encode()
+        if len(raw) != self.SECRET_LEN:
+            raise ValueError(f'secrets must be {self.SECRET_LEN} ascii characters')
+        uid = len(self.where)
+        self.secrets += raw
+        self.where.append(did)
+        self.domstates.append(0)
+        self.had += bytes(self.stride)
+        self.placed.append(b'')
+        return uid
+
+    def secret(self, uid : int) -> str:
+        return self.secrets[uid*self.SECRET_LEN:(uid+1)*self.SECRET_LEN].decode()
+
+    def domain(self, uid : int) -> int:
+        return self.where[uid]
+
+    def domstate(self, uid : int) -> int:
+        return self.domstates[uid]
+
+    def set_domstate(self, uid : int, value : int) -> None:
+        self.domstates[uid] = value
+
+    def index_of(self, tid : int) -> int:
+        """Dense index of a template id, widening every bitset row if needed"""
+        i = self.template_index.get(tid)
+        if i is None:
+            i = self.template_index[tid] = len(self.template_ids)
+            self.template_ids.append(tid)
+            if i >= self.stride*8:
+                old, self.stride = self.stride, max(1, self.stride*2)
+                rows = [self.had[u*old:(u+1)*old] + bytes(self.stride-old) for u in range(len(self))]
+                self.had = bytearray().join(rows)
+        return i
+
+    def location_code(self, loc) -> int:
+        """Interns a location, returning its code"""
+        try: key = hash(loc), loc
+        except TypeError: key = None, json.dumps(loc, sort_keys=True) # e.g. a list from JSON
+        code = self.location_codes.get(key)
+        if code is None:
+            code = self.location_codes[key] = len(self.locations)
+            self.locations.append(loc)
+        return code
+
+    def placements(self, uid : int) -> dict:
+        packed = array('I', self.placed[uid])
+        return {self.template_ids[packed[i]]:self.locations[packed[i+1]] for i in range(0, len(packed), 2)}
+
+    def placement(self, uid : int, tid : int):
+        i = self.template_index.get(tid)
+        if i is None: return None
+        packed = array('I', self.placed[uid])
+        for j in range(0, len(packed), 2):
+            if packed[j] == i: return self.locations[packed[j+1]]
+        return None
+
+    def move(self, uid : int, tid : int, loc) -> None:
+        i, code = self.index_of(tid), self.location_code(loc)
+        packed = array('I', self.placed[uid])
+        for j in range(0, len(packed), 2):
+            if packed[j] == i:
+                packed[j+1] = code
+                break
+        else:
+            packed.extend((i, code))
+        self.placed[uid] = packed.tobytes()
+
+    def has_had(self, uid : int, tid : int) -> bool:
+        i = self.template_index.get(tid)
+        if i is None: return False
+        return bool(self.had[uid*self.stride + i//8] >> (i%8) & 1)
+
+    def mark_had(self, uid : int, tid : int) -> None:
+        i = self.index_of(tid)
+        self.had[uid*self.stride + i//8] |= 1 << (i%8)
+
+    def scores(self, uid : int) -> dict:
+        return {did:col[uid] for did,col in self.points.items() if uid < len(col) and col[uid] == col[uid]}
+
+    def score(self, uid : int, did : int) -> float | None:
+        col = self.points.get(did)
+        if col is None or uid >= len(col) or col[uid] != col[uid]: return None
+        return col[uid]
+
+    def set_score(self, uid : int, did : int, value : float) -> None:
+        col = self.points.setdefault(did, array('d'))
+        if uid >= len(col):
+            col.extend([math.nan]*(len(self)-len(col)))
+        col[uid] = value
+
+
+class SQLiteUserStore(UserBackend):
+    """User storage in an embedded SQLite database, for user counts beyond what fits in RAM
+
+    The database runs in WAL mode. Statements use fixed SQL text, so sqlite3's statement
+    cache prepares each one only once. Writes accumulate in an open transaction that
+    flush() commits; the hub calls it every flush_interval seconds, which batches many
+    writes into one commit.
+    """
+    def __init__(self, path : str):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS users (uid INTEGER PRIMARY KEY, secret TEXT NOT NULL, domain INTEGER NOT NULL, domstate INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS placements (uid INTEGER NOT NULL, tid INTEGER NOT NULL, loc TEXT NOT NULL, UNIQUE (uid, tid));
+            CREATE TABLE IF NOT EXISTS hashad (uid INTEGER NOT NULL, tid INTEGER NOT NULL, PRIMARY KEY (uid, tid)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS scores (uid INTEGER NOT NULL, did INTEGER NOT NULL, score REAL NOT NULL, PRIMARY KEY (uid, did)) WITHOUT ROWID;
+        ''')
+        self.count = self.db.execute('SELECT count(*) FROM users').fetchone()[0]
+
+    @staticmethod
+    def decode(loc : str):
+        loc = json.loads(loc)
+        return tuple(loc) if isinstance(loc, list) else loc
+
+    def clear(self) -> None:
+        self.db.executescript('DELETE FROM users; DELETE FROM placements; DELETE FROM hashad; DELETE FROM scores;')
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, secret : str, did : int) -> int:
+        uid = self.count
+        self.db.execute('INSERT INTO users (uid, secret, domain) VALUES (?, ?, ?)', (uid, secret, did))
+        self.count += 1
+        return uid
+
+    def secret(self, uid : int) -> str:
+        return self.db.execute('SELECT secret FROM users WHERE uid = ?', (uid,)).fetchone()[0]
+
+    def domain(self, uid : int) -> int:
+        return self.db.execute('SELECT domain FROM users WHERE uid = ?', (uid,)).fetchone()[0]
+
+    def domstate(self, uid : int) -> int:
+        return self.db.execute('SELECT domstate FROM users WHERE uid = ?', (uid,)).fetchone()[0]
+
+    def set_domstate(self, uid : int, value : int) -> None:
+        self.db.execute('UPDATE users SET domstate = ? WHERE uid = ?', (value, uid))
+
+    def placements(self, uid : int) -> dict:
+        rows = self.db.execute('SELECT tid, loc FROM placements WHERE uid = ? ORDER BY rowid', (uid,))
+        return {tid:self.decode(loc) for tid,loc in rows}
+
+    def placement(self, uid : int, tid : int):
+        row = self.db.execute('SELECT loc FROM placements WHERE uid = ? AND tid = ?', (uid, tid)).fetchone()
+        return None if row is None else self.decode(row[0])
+
+    def move(self, uid : int, tid : int, loc) -> None:
+        self.db.execute('INSERT INTO placements (uid, tid, loc) VALUES (?, ?, ?) ON CONFLICT (uid, tid) DO UPDATE SET loc = excluded.loc',
+            (uid, tid, json.dumps(loc)))
+
+    def has_had(self, uid : int, tid : int) -> bool:
+        return self.db.execute('SELECT 1 FROM hashad WHERE uid = ? AND tid = ?', (uid, tid)).fetchone() is not None
+
+    def mark_had(self, uid : int, tid : int) -> None:
+        self.db.execute('INSERT OR IGNORE INTO hashad (uid, tid) VALUES (?, ?)', (uid, tid))
+
+    def scores(self, uid : int) -> dict:
+        return dict(self.db.execute('SELECT did, score FROM scores WHERE uid = ?', (uid,)))
+
+    def score(self, uid : int, did : int) -> float | None:
+        row = self.db.execute('SELECT score FROM scores WHERE uid = ? AND did = ?', (uid, did)).fetchone()
+        return None if row is None else row[0]
+
+    def set_score(self, uid : int, did : int, value : float) -> None:
+        self.db.execute('INSERT OR REPLACE INTO scores (uid, did, score) VALUES (?, ?, ?)', (uid, did, value))
+
+    def flush(self) -> None:
+        self.db.commit()
+
+
+class Leaderboard:
+    """Ranks users by total score, updated incrementally whenever a total changes
+
+    Totals are kept in thousandths of a point (the finest step /score is meant to award).
+    Users with a non-zero total are counted per value in a Fenwick tree, so a rank is
+    O(log V) for V distinct values; the top k walks down the occupied values only, and
+    each value keeps its users in id order so ties are taken as they are, k at most.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.values = array('i') # uid : total in thousandths
+        self.tree = [0]*4097 # Fenwick tree of user counts by value, 1-based
+        self.members = {} # value : sorted list of uids, non-zero values only
+        self.occupied = [] # sorted non-zero values that have members
+        self.ranked = 0 # users with a non-zero total
+
+    def _add(self, value : int, delta : int) -> None:
+        if value >= len(self.tree)-1:
+            size = len(self.tree)-1
+            while value >= size: size *= 2
+            counts = {v:len(m) for v,m in self.members.items() if v != value}
+            self.tree = [0]*(size+1)
+            for v,n in counts.items(): self._add(v, n)
+        i = value
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def _at_most(self, value : int) -> int:
+        """Users with a non-zero total of at most value"""
+        i, n = min(value, len(self.tree)-1), 0
+        while i > 0:
+            n += self.tree[i]
+            i -= i & -i
+        return n
+
+    def update(self, uid : int, total : float) -> None:
+        """Record a user's new total score"""
+        if uid >= len(self.values):
+            self.values.extend([0]*(uid+1-len(self.values)))
+        old, new = self.values[uid], max(0, round(total*1000))
+        if old == new: return
+        self.values[uid] = new
+        if old:
+            self._add(old, -1)
+            self.ranked -= 1
+            tied = self.members[old]
+            del tied[bisect.bisect_left(tied, uid)]
+            if not tied:
+                del self.members[old]
+                del self.occupied[bisect.bisect_left(self.occupied, old)]
+        if new:
+            self._add(new, 1)
+            self.ranked += 1
+            if new not in self.members:
+                self.members[new] = []
+                bisect.insort(self.occupied, new)
+            bisect.insort(self.members[new], uid)
+
+    def total(self, uid : int) -> float:
+        return self.values[uid]/1000 if uid < len(self.values) else 0.0
+
+    def rank(self, uid : int) -> int:
+        """1 + the number of users with a strictly higher total"""
+        return 1 + self.ranked - self._at_most(self.values[uid] if uid < len(self.values) else 0)
+
+    def top(self, k : int, everyone : int) -> list:
+        """[(uid, total)] for the k highest totals among users 0..everyone-1"""
+        best = []
+        for value in reversed(self.occupied):
+            for uid in self.members[value]:
+                if len(best) == k: return best
+                best.append((uid, value/1000))
+        # fewer than k users have points; fill with the (earliest) zero-point users
+        for uid in range(everyone):
+            if len(best) >= k: break
+            if uid >= len(self.values) or self.values[uid] == 0:
+                best.append((uid, 0.0))
+        return best
+
+
+class ItemNames:
+    """Item ids by name, where any prefix of a name also finds its items
+
+    Several items may share a name. Names are kept sorted so a prefix is a bisect
+    plus a walk over just the names that start with it.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.ids = {} # name : set of item ids
+        self.names = [] # every name in ids, sorted
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name : str, iid : int) -> None:
+        if name not in self.ids:
+            self.ids[name] = set()
+            bisect.insort(self.names, name)
+        self.ids[name].add(iid)
+
+    def complete(self, prefix : str, limit : int | None = None) -> list[str]:
+        """The names starting with prefix, in order (at most limit of them)"""
+        found = []
+        for i in range(bisect.bisect_left(self.names, prefix), len(self.names)):
+            if not self.names[i].startswith(prefix) or len(found) == limit: break
+            found.append(self.names[i])
+        return found
+
+    def lookup(self, name : str) -> set:
+        """The ids of the items called name or, if there are none, of those whose name starts with it"""
+        if name in self.ids: return set(self.ids[name])
+        if not name: return set()
+        return set().union(*(self.ids[n] for n in self.complete(name)))
+
+
 ###############################
 ###    Section: global state    ###
 
@@ -12,17 +417,39 @@ routes = web.RouteTableDef()
 grid = {} # {(x,y): domain_id}
 
 # Information about each domain
-domains = {} # {domain_id:{"url":url, "name":str, "description":str, "cell":[x,y], "loot":[item_id]}}
+domains = {} # {domain_id:{"url":url, "peer":url the hub calls it at, "name":str, "description":str, "cell":[x,y], "loot":[item_id]}}
+max_domains = 2 # registrations accepted; set by --max-domains (e.g. for bench/fakedomains.py)
 
 # All item templates
 templates = {} # {item_id:{"name":str, "description":str, "home":domain_id, "hosts":[domain_id], "depth":int}}
 
-# Centrally-tracked information about each user
-users = {} # id : {"in":domain_id, "open":[domain_id], "inventory":{item_id:location,...}}
+# Centrally-tracked information about each user: domain they are in, secret, item placements, scores, ...
+users = UserStore() # or a SQLiteUserStore, chosen by --store
+flush_interval = 0.05 # seconds between users.flush() calls
+leaderboard = Leaderboard() # kept up to date with total_score() by /score and journey()
 
 # Global tracking of the different operation modes
 mode = "setup" # {"setup", "play", "locked"}
 
+# Signed session tokens "uid.did.expiry.signature", keyed per domain so that domain can check them too
+token_ttl = 12*3600 # seconds a token issued at /login stays valid; set by --token-ttl
+token_keys = {} # domain_id : key derived from that domain's secret
+
+# Unix socket this hub also listens on (--unix), offered to domains registered by a unix: URL
+unix_path = None
+
+# Bearer token required by /admin/... endpoints; set by --admin-token or generated at startup
+admin_token = None
+
+# Bulk provisioning through /admin/users
+max_provision = 10000 # users one call may create
+arrive_batch = 200 # users per batched /arrive sent to a domain
+
+# End-to-end time budget for user-facing requests, shared with every outbound call they make
+DEADLINE_HEADER = 'X-Deadline-Ms' # milliseconds remaining, relative so peers need not share a clock
+request_budget = 5.0 # seconds allowed for /login and /command; set by --budget
+deadline = contextvars.ContextVar('deadline', default=None) # time.monotonic() value, or None if unbounded
+
 
 
 ##########################################################
@@ -57,6 +484,12 @@ def make_secret(secure=False, nbytes=12):
         return ''.join(random.choice(alphabet) for _ in range(nbytes*8//6))
 
 
+def make_secrets(n : int) -> list[str]:
+    """n secrets like make_secret()'s, cut from one draw of random bytes instead of one draw per character"""
+    raw = base64.urlsafe_b64encode(random.randbytes(n*12)).decode()
+    return [raw[i*16:(i+1)*16] for i in range(n)]
+
+
 def make_map():
     """Puts each domain in a random location on a grid"""
     # For this practice hub, only a single domain is supported
@@ -105,16 +538,77 @@ def assign_loot():
         domains[hostid]['loot'].append(lootid+i)
 
 
+def time_left() -> float | None:
+    """Seconds remaining before the current request's deadline, or None if it has none"""
+    when = deadline.get()
+    if when is None: return None
+    return when - time.monotonic()
+
+def budget() -> dict:
+    """Extra keyword arguments for app.client.post that forward the current deadline
+
+    Raises asyncio.TimeoutError if the budget is already spent, so no request is sent
+    that the user can no longer see the result of.
+    """
+    left = time_left()
+    if left is None: return {}
+    if left <= 0: raise asyncio.TimeoutError('deadline exceeded before outbound call')
+    from aiohttp import ClientTimeout
+    return {'headers':{DEADLINE_HEADER:str(int(left*1000))}, 'timeout':ClientTimeout(total=min(3, left))}
+
+
+def token_key(did : int) -> bytes:
+    """The session-token signing key for a domain, which it can derive from its own secret"""
+    key = token_keys.get(did)
+    if key is None:
+        key = token_keys[did] = hmac.new(domains[did]['secret'].encode(), b'mini-zork session token', hashlib.sha256).digest()
+    return key
+
+def sign_token(body : str, key : bytes) -> str:
+    """URL-safe signature of a token body"""
+    return base64.urlsafe_b64encode(hmac.new(key, body.encode(), hashlib.sha256).digest()).rstrip(b'=').decode()
+
+def make_token(uid : int, did : int) -> str:
+    """A session token for uid that expires token_ttl seconds from now"""
+    body = f'{uid}.{did}.{int(time.time()+token_ttl)}'
+    return body+'.'+sign_token(body, token_key(did))
+
+def verify_token(token, uid) -> bool:
+    """Whether token is an unexpired session token for uid, without looking the user up"""
+    if not isinstance(token, str) or token.count('.') != 3: return False
+    body, sig = token.rsplit('.', 1)
+    tuid, tdid, expires = body.split('.')
+    try: tdid, expires = int(tdid), int(expires)
+    except ValueError: return False
+    if tuid != str(uid) or tdid not in domains or expires < time.time(): return False
+    return hmac.compare_digest(sig, sign_token(body, token_key(tdid)))
+
+def total_score(uid : int) -> float:
+    """A user's points across all domains, as shown by the score command"""
+    return sum(users.scores(uid).values()) + round(users.domstate(uid)/2,2)
+
+def carrying(uid : int) -> ItemNames:
+    """The user's carried items by name, indexed afresh from their few placements rather than kept per user"""
+    names = ItemNames()
+    for tid, where in users.placements(uid).items():
+        if where == 'inventory': names.add(templates[tid]['name'], tid)
+    return names
+
 def checkuid(data : dict) -> web.Response | int:
     if mode != 'play':
         return web.json_response(status=409, data={'error':'Only available during play'})
-    for need in 'user','secret':
-        if need not in data:
-            return web.json_response(status=400, data={'error':'Request must contain '+need})
+    if 'user' not in data:
+        return web.json_response(status=400, data={'error':'Request must contain user'})
     uid = data['user']
+    if 'token' in data:
+        if not verify_token(data['token'], uid) or uid not in users:
+            return web.json_response(status=403, data={'error':'Invalid or expired token'})
+        return uid
+    if 'secret' not in data:
+        return web.json_response(status=400, data={'error':'Request must contain secret or token'})
     if uid not in users:
         return web.json_response(status=403, data={'error':f'User {uid} not known'})
-    if users[uid]['secret'] != data['secret']:
+    if users.secret(uid) != data['secret']:
         return web.json_response(status=403, data={'error':f'Invalid secret'})
     return uid
 
@@ -130,16 +624,105 @@ def checkdid(data : dict) -> web.Response | int:
     if domains[did]['secret'] != data['secret']:
         return web.json_response(status=403, data={'error':f'Invalid secret'})
     return did
+
+def checkadmin(req : web.Request) -> web.Response | None:
+    """Returns an error response unless the request carries the admin bearer token"""
+    given = req.headers.get('Authorization', '')
+    if admin_token is None or not hmac.compare_digest(given, 'Bearer '+admin_token):
+        return web.json_response(status=401, data={'error':'Admin token required'}, headers={'WWW-Authenticate':'Bearer'})
+    return None
     
 
 
+##################################
+###  Section: static front-end  ###
+
+static_files = {'/': 'tba.html'} # url path : file served there
+static_assets = {} # url path : {'type', 'mtime', 'etag', and the body under 'identity', 'gzip' and (with brotli) 'br'}
+static_max_age = 0 # seconds browsers may reuse a page without revalidating; 0 sends no-cache (--static-max-age)
+dev_mode = False # reload front-end files when they change on disk (--dev)
+asset_poll_interval = 1.0 # seconds between dev-mode checks for changed files
+
+def load_asset(path : str, file : str) -> None:
+    """Read a front-end file into memory along with its compressed copies"""
+    mtime = os.stat(file).st_mtime_ns
+    with open(file, 'rb') as f: body = f.read()
+    asset = {
+        'type': mimetypes.guess_type(file)[0] or 'application/octet-stream',
+        'mtime': mtime,
+        'etag': hashlib.sha256(body).hexdigest()[:24],
+        'identity': body,
+        'gzip': gzip.compress(body, compresslevel=9, mtime=0),
+    }
+    if brotli is not None: asset['br'] = brotli.compress(body, quality=11)
+    static_assets[path] = asset
+
+def load_assets() -> None:
+    for path, file in static_files.items(): load_asset(path, file)
+
+def pick_encoding(accept : str, asset : dict) -> str:
+    """The smallest copy of asset that an Accept-Encoding header allows"""
+    allowed = {}
+    for part in accept.split(','):
+        name, _, params = part.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try: q = float(value)
+                except ValueError: q = 0.0
+        allowed[name.strip().lower()] = q
+    candidates = [enc for enc in ('br', 'gzip') if enc in asset and allowed.get(enc, allowed.get('*', 0)) > 0]
+    return min(candidates, key=lambda enc: len(asset[enc]), default='identity')
+
+def static_response(req : web.Request, path : str) -> web.Response:
+    """Serve a preloaded asset: compressed if the client accepts it, 304 if its copy is current"""
+    asset = static_assets[path]
+    enc = pick_encoding(req.headers.get('Accept-Encoding', ''), asset)
+    etag = asset['etag'] if enc == 'identity' else asset['etag']+'-'+enc
+    headers = {
+        'ETag': f'"{etag}"',
+        'Vary': 'Accept-Encoding',
+        'Cache-Control': f'public, max-age={static_max_age}' if static_max_age > 0 else 'no-cache',
+    }
+    wanted = req.headers.get('If-None-Match')
+    if wanted is not None:
+        tags = [tag.strip().removeprefix('W/').strip('"') for tag in wanted.split(',')]
+        if '*' in tags or etag in tags:
+            return web.Response(status=304, headers=headers)
+    if enc != 'identity': headers['Content-Encoding'] = enc
+    charset = 'utf-8' if asset['type'].startswith('text/') else None
+    return web.Response(body=asset[enc], content_type=asset['type'], charset=charset, headers=headers)
+
+async def watch_assets():
+    """Dev mode: reload any front-end file whose modification time changed"""
+    while True:
+        await asyncio.sleep(asset_poll_interval)
+        for path, file in static_files.items():
+            try: changed = os.stat(file).st_mtime_ns != static_assets[path]['mtime']
+            except OSError: continue # mid-save; look again next time
+            if changed:
+                try: load_asset(path, file)
+                except OSError: continue
+                print("Reloaded", file)
+
+async def start_assets(app):
+    """Load the front-end, and in dev mode start watching it for changes"""
+    load_assets()
+    app.asset_watcher = asyncio.create_task(watch_assets()) if dev_mode else None
+
+async def stop_assets(app):
+    if app.asset_watcher is not None: app.asset_watcher.cancel()
+
+
+
 ####################################
 ###  Section: web UI interfaces  ###
 
 @routes.get("/")
 async def web_interface(req : web.Request) -> web.StreamResponse:
     """Display web front-end"""
-    return web.FileResponse(path="tba.html")
+    return static_response(req, '/')
 
 @routes.get("/mode")
 async def get_mode(req : web.Request) -> web.Response:
@@ -157,6 +740,7 @@ async def set_mode(req : web.Request) -> web.Response:
         return web.Response(status=403, text="The demo server cannot be put into setup mode.")
         mode = 'setup'
         users.clear()
+        leaderboard.clear()
         grid.clear()
         domains.clear()
         templates.clear()
@@ -172,6 +756,22 @@ async def set_mode(req : web.Request) -> web.Response:
     
     return web.Response(text="Now in "+mode+" mode")
 
+@routes.get("/leaderboard")
+async def get_leaderboard(req : web.Request) -> web.Response:
+    """Top-k totals as JSON, plus the rank of ?user= if given; ?k= defaults to 10"""
+    try:
+        k = max(1, min(int(req.query.get('k', 10)), 1000))
+        uid = int(req.query['user']) if 'user' in req.query else None
+    except ValueError:
+        return web.json_response(status=400, data={'error':'k and user must be integers'})
+    ans = {'top':[{'user':who, 'score':points} for who,points in leaderboard.top(k, len(users))], 'users':len(users)}
+    if uid is not None:
+        if uid not in users:
+            return web.json_response(status=404, data={'error':f'User {uid} not known'})
+        ans['rank'] = leaderboard.rank(uid)
+        ans['score'] = leaderboard.total(uid)
+    return web.json_response(data=ans)
+
 @routes.post("/domain")
 async def notify_domain(req : web.Request) -> web.Response:
     """Web front-end to tell hub server to ask domain server for details"""
@@ -179,9 +779,11 @@ async def notify_domain(req : web.Request) -> web.Response:
         return web.Response(status=409, text="Central server is not in setup mode.")
     try:
         data = await req.text()
-        if any(d['url'] == data for d in domains.values()):
+        if any(data in (d['url'], d['peer']) for d in domains.values()):
             return web.Response(text="That domain server has already been registered.")
-        async with req.app.client.post(data+'/newhub', data=whoami) as resp:
+        # A domain reached over a Unix socket is on this host, so it can call back over ours too
+        me = 'unix:'+unix_path if data.startswith('unix:') and unix_path else whoami
+        async with req.app.client.post(data+'/newhub', data=me) as resp:
             spot = await resp.json()
             if 'error' in spot:
                 return web.Response(text="Domain server returned an error message:<pre>"+spot['error']+"</pre>")
@@ -202,19 +804,50 @@ async def login(req : web.Request) -> web.Response:
     """User log-in"""
     if mode != 'play':
         return web.json_response(status=409, data={'error':'Players cannot log in during setup'})
-    data = {}
-    data['secret'] = make_secret()
-    data['in'] = random.choice(tuple(domains))
-    data['open'] = [data['in']]
-    data['inventory'] = {}
-    data['domstate'] = 0
-    data['score'] = {}
-    data['hashad'] = set() # items ever in inventory
-    uid = len(users)
-    users[uid] = data
-    await arrive(uid, data['in'], req.app, 'login')
-    return web.json_response(data={'id':uid,'secret':data['secret'],
-        'domain':{k:v for k,v in domains[data['in']].items() if k in ('url','name','description')}})
+    secret = make_secret()
+    did = random.choice(tuple(domains))
+    async def join() -> int:
+        uid = users.add(secret, did)
+        deadline.set(None) # a created user is always told to their domain, whatever is left of the budget
+        await arrive(uid, did, req.app, 'login')
+        return uid
+    # Shielded so a deadline cannot leave a user created but never arrived
+    uid = await asyncio.shield(join())
+    return web.json_response(data={'id':uid,'secret':secret,'token':make_token(uid, did),
+        'domain':{k:v for k,v in domains[did].items() if k in ('url','name','description')}})
+
+@routes.post("/admin/users")
+async def provision_users(req : web.Request) -> web.Response:
+    """Create {"count": N} users at once, ahead of an event, in {"domain": id} or in domains picked at random
+
+    Every domain hears of its new users through batched /arrive calls (see arrive_many).
+    Returns a list with what /login would have returned for each user, plus "arrived": false
+    for any user their domain could not be told about (they must log in again to play).
+    """
+    denied = checkadmin(req)
+    if denied is not None: return denied
+    if mode != 'play':
+        return web.json_response(status=409, data={'error':'Users can only be created during play'})
+    try: data = await req.json()
+    except: return web.json_response(status=400, data={'error':'JSON data required'})
+    n = data.get('count') if isinstance(data, dict) else None
+    if not isinstance(n, int) or isinstance(n, bool) or not 0 < n <= max_provision:
+        return web.json_response(status=400, data={'error':f'count must be an integer from 1 to {max_provision}'})
+    did = data.get('domain')
+    if did is not None and did not in domains:
+        return web.json_response(status=400, data={'error':f'Domain {did} not known'})
+
+    dids = [did]*n if did is not None else random.choices(tuple(domains), k=n)
+    created, by_domain = [], collections.defaultdict(list)
+    for secret, did in zip(make_secrets(n), dids):
+        uid = users.add(secret, did)
+        by_domain[did].append(uid)
+        created.append({'id':uid, 'secret':secret, 'token':make_token(uid, did),
+            'domain':{k:v for k,v in domains[did].items() if k in ('url','name','description')}})
+    failed = set().union(*await asyncio.gather(*(arrive_many(uids, did, req.app) for did, uids in by_domain.items())))
+    for user in created:
+        if user['id'] in failed: user['arrived'] = False
+    return web.json_response(data=created)
 
 
 @routes.post("/command")
@@ -224,19 +857,35 @@ async def handle_command(req : web.Request) -> web.Response:
     except: return web.json_response(status=400, text="JSON data required")
     uid = checkuid(data)
     if isinstance(uid, web.Response): return uid
+    wait = take_token(uid)
+    if wait: return too_many(wait, 'Too many commands; slow down')
     if 'command' not in data: return web.json_response(status=400, text="Command expected")
     cmd = data['command']
     if not isinstance(cmd, list): return web.json_response(status=400, text="Command should be a list")
     if not all(isinstance(word, str) for word in cmd): return web.json_response(status=400, text="Command should be a list of strings")
+    if not cmd: return web.json_response(status=400, text="Command should not be empty")
+    req['verb'] = cmd[0] if cmd[0] in hub_verbs else 'other'
     
     if cmd[0] == 'region': return await region(uid, cmd[1:])
     if cmd[0] == 'journey': return await journey(uid, cmd[1:], req.app)
     if cmd[0] == 'inventory': return await inventory(uid, cmd[1:])
     if cmd[0] == 'score': return await score(uid, cmd[1:])
     if cmd[0] == 'drop': return await drop(uid, cmd[1:], req.app)
+    if cmd[0] == 'leaderboard': return await ranking(uid, cmd[1:])
     
     return web.Response(text="I don't know how to do that")
 
+@routes.post("/complete")
+async def complete(req : web.Request) -> web.Response:
+    """Up to 20 names of carried items starting with "prefix", for the front-end to suggest as a drop is typed"""
+    try: data = await req.json()
+    except: return web.json_response(status=400, data={'error':'JSON data required'})
+    uid = checkuid(data)
+    if isinstance(uid, web.Response): return uid
+    prefix = data.get('prefix', '')
+    if not isinstance(prefix, str): return web.json_response(status=400, data={'error':'prefix must be a string'})
+    return web.json_response(data=carrying(uid).complete(prefix, limit=20))
+
 
 
 
@@ -247,8 +896,7 @@ async def handle_command(req : web.Request) -> web.Response:
 
 async def region(uid:int, rest:list[str]) -> web.Response:
     """Information about the current domain for the user"""
-    me = users[uid]
-    here = domains[me['in']]
+    here = domains[users.domain(uid)]
     return web.Response(text='You are in domain <strong>'+here['name']+'</strong>\n'+here['description']+'\n\nFor this MP, there is no detail available about other domains in the region.')
 
 async def journey(uid:int, rest:list[str], app:web.Application) -> web.Response:
@@ -256,63 +904,129 @@ async def journey(uid:int, rest:list[str], app:web.Application) -> web.Response:
     if len(rest) != 1 or rest[0] not in ('north','south','east','west'):
         return web.Response(text='I only know how to journey in cardinal directions', status=403)
 
-    me = users[uid]
-    here = domains[me['in']]
+    did = users.domain(uid)
+    here = domains[did]
     src = {'north':'south','south':'north','east':'west','west':'east'}.get(rest[0],'direct')
 
-    try:
-        async with app.client.post(here['url']+'/depart', json={
-            'secret':here['secret'],
-            'user':uid,
-        }) as resp:
-            if not resp.ok:
-                print("/depart returned a failing status code", resp.status)
-    except BaseException as ex:
-        print("/depart failed", ex)
-
-
-    msg = ['You travel in other domains for a time.']
-    used = []
-    for ds in range(3):
-        if me['domstate'] == ds:
-            for prize in domains_prizes.get(me['in'],{}).get(ds,[]):
-                if prize not in me['hashad']:
-                    me['inventory'][prize] = 'inventory'
-                    me['hashad'].add(prize)
-                    msg.append('You find a '+templates[prize]['name'])
-            if me['inventory'].get(others_items[ds]['id']) == 'inventory':
-                me['domstate'] = ds+1
-                msg.append('You use your '+others_items[ds]['name']+' to bypass an obstacle.')
-    if len(msg) == 1: msg.append('Finding nothing new, you return to this domain.')
-    else: msg.append('You then return to this domain.')
-
-    await arrive(uid, me['in'], app, src)
+    async def travel() -> list[str]:
+        try:
+            async with app.client.post(here['peer']+'/depart', json={
+                'secret':here['secret'],
+                'user':uid,
+            }, **budget()) as resp:
+                if not resp.ok:
+                    print("/depart returned a failing status code", resp.status)
+        except Exception as ex:
+            print("/depart failed", ex)
+
+        msg = ['You travel in other domains for a time.']
+        for ds in range(3):
+            if users.domstate(uid) == ds:
+                for prize in domains_prizes.get(did,{}).get(ds,[]):
+                    if not users.has_had(uid, prize):
+                        users.move(uid, prize, 'inventory')
+                        users.mark_had(uid, prize)
+                        msg.append('You find a '+templates[prize]['name'])
+                if users.placement(uid, others_items[ds]['id']) == 'inventory':
+                    users.set_domstate(uid, ds+1)
+                    leaderboard.update(uid, total_score(uid))
+                    msg.append('You use your '+others_items[ds]['name']+' to bypass an obstacle.')
+        if len(msg) == 1: msg.append('Finding nothing new, you return to this domain.')
+        else: msg.append('You then return to this domain.')
+
+        deadline.set(None) # once departed, the user must arrive again whatever is left of the budget
+        await arrive(uid, did, app, src)
+        return msg
+
+    # Shielded so a deadline cannot stop it between /depart and /arrive, leaving the user departed
+    msg = await asyncio.shield(travel())
     return web.Response(text='\n'.join(msg))
 
 async def inventory(uid:int, rest:list[str]) -> web.Response:
     """Display what the user is carrying"""
-    me = users[uid]
-    if not any(v == 'inventory' for v in me['inventory'].values()):
+    placed = users.placements(uid)
+    if not any(v == 'inventory' for v in placed.values()):
         return web.Response(text='You are not carrying anything.')
-    return web.Response(text='You are carrying:<ul>'+''.join(f'<li>{templates[tid]["name"]} <sub>{tid}</sub></li>' for tid in me['inventory'] if me['inventory'][tid] == 'inventory'))
+    return web.Response(text='You are carrying:<ul>'+''.join(f'<li>{templates[tid]["name"]} <sub>{tid}</sub></li>' for tid in placed if placed[tid] == 'inventory'))
 
 async def score(uid:int, rest:list[str]) -> web.Response:
     """Display the scoreboard"""
     ans = f'Score for user {uid}:<ul>'
     points = 0
-    for k,v in users[uid]['score'].items():
+    for k,v in users.scores(uid).items():
         ans += f'<li>Domain {k}: {v} points</li>'
         points += v
-    ans += f'<li>Others: {round(users[uid]["domstate"]/2,2)} points</li>'
-    ans += f'</ul>Total: {points+round(users[uid]["domstate"]/2,2)} points.'
+    ans += f'<li>Others: {round(users.domstate(uid)/2,2)} points</li>'
+    ans += f'</ul>Total: {points+round(users.domstate(uid)/2,2)} points.'
         
     return web.Response(text=ans)
 
+async def ranking(uid:int, rest:list[str]) -> web.Response:
+    """Display the top players and the user's own rank"""
+    k = int(rest[0]) if rest and rest[0].isdigit() else 10
+    k = max(1, min(k, 100))
+    ans = f'Top {k} players:<ol>'
+    for who, points in leaderboard.top(k, len(users)):
+        ans += f'<li>{"<strong>you</strong>" if who == uid else "User "+str(who)}: {points} points</li>'
+    ans += f'</ol>You are ranked {leaderboard.rank(uid)} of {len(users)} with {leaderboard.total(uid)} points.'
+    return web.Response(text=ans)
+
+
+async def arrive(uid: int, dest: int, app:web.Application, src:str='login') -> bool:
+    """Alert a domain that a user has arrived; False if it could not be told"""
+    with span('arrive', user=uid, domain=dest, src=src):
+        return await send_arrive(uid, dest, app, src)
 
-async def arrive(uid: int, dest: int, app:web.Application, src:str='login') -> None:
-    """Alert a domain that a user has arrived"""
+async def send_arrive(uid: int, dest: int, app:web.Application, src:str) -> bool:
+    """Send the /arrive payload for arrive()"""
+    payload = arrive_payload(uid, dest, src)
+    
+    if users.score(uid, dest) is None:
+        users.set_score(uid, dest, 0)
+    
+    try:
+        async with app.client.post(domains[dest]['peer']+'/arrive', json=payload, **budget()) as resp:
+            assert resp.status == 200, (resp.status, await resp.read())
+        return True
+    except Exception as ex:
+        print('ERROR:',domains[dest]['peer']+'/arrive','did not work',repr(ex))
+        return False
+
+async def arrive_many(uids: list[int], dest: int, app:web.Application) -> set[int]:
+    """arrive() from login for many users at once, sent to the domain arrive_batch users per /arrive
+
+    A batched /arrive body is {"secret": the domain's secret, "users": [an /arrive body without its secret per user]}.
+    A domain that does not answer it with 200, or does not answer at all, is told about that batch's users one
+    at a time instead. Arriving twice is harmless: the payload is rebuilt from current placements, so items the
+    domain already placed for a user are not sent again. Returns the users the domain could not be told about.
+    """
+    failed = set()
+    from aiohttp import ClientTimeout
+    for i in range(0, len(uids), arrive_batch):
+        batch = uids[i:i+arrive_batch]
+        bodies = []
+        for uid in batch:
+            bodies.append({k:v for k,v in arrive_payload(uid, dest, 'login').items() if k != 'secret'})
+            if users.score(uid, dest) is None:
+                users.set_score(uid, dest, 0)
+        with span('arrive', domain=dest, src='login', users=len(batch)):
+            try:
+                # The domain makes its own hub calls for every user in the batch before answering
+                async with app.client.post(domains[dest]['peer']+'/arrive', json={'secret':domains[dest]['secret'], 'users':bodies},
+                                           timeout=ClientTimeout(total=3+0.05*len(batch))) as resp:
+                    if resp.status == 200: continue
+                    print('batched /arrive refused by', domains[dest]['peer'], resp.status, '- sending users one at a time')
+            except Exception as ex:
+                print('ERROR:',domains[dest]['peer']+'/arrive','did not work for a batch of',len(batch),repr(ex),'- sending users one at a time')
+        for uid in batch:
+            if not await arrive(uid, dest, app, 'login'): failed.add(uid)
+    return failed
+
+def arrive_payload(uid: int, dest: int, src:str) -> dict:
+    """The body of the /arrive request telling domain dest that user uid came from src"""
     owned, carried, dropped, prize = [],[],[],[]
-    for tid, loc in users[uid]['inventory'].items():
+    placed = users.placements(uid)
+    for tid, loc in placed.items():
         t = templates[tid]
         brief = {k:v for k,v in t.items() if k in ('name','description','verb')}
         brief['id'] = tid
@@ -324,67 +1038,62 @@ async def arrive(uid: int, dest: int, app:web.Application, src:str='login') -> N
             brief['location'] = loc[1]
             dropped.append(brief)
     for tid in domains[dest]['loot']:
-        if tid not in users[uid]['inventory']:
+        if tid not in placed:
             t = templates[tid]
             brief = {k:v for k,v in t.items() if k in ('name','description','verb','depth')}
             brief['id'] = tid
             prize.append(brief)
-    
-    users[uid]['score'].setdefault(dest, 0)
-    
-    try:
-        async with app.client.post(domains[dest]['url']+'/arrive', json={
-            'secret':domains[dest]['secret'],
-            'user':uid,
-            'from':src,
-            'owned':owned,
-            'carried':carried,
-            'dropped':dropped,
-            'prize':prize,
-        }) as resp:
-            assert resp.status == 200, (resp.status, await resp.read())
-    except BaseException as ex:
-        print('ERROR:',domains[dest]['url']+'/arrive','did not work',repr(ex))
+    return {
+        'secret':domains[dest]['secret'],
+        'user':uid,
+        'from':src,
+        'owned':owned,
+        'carried':carried,
+        'dropped':dropped,
+        'prize':prize,
+    }
 
 async def drop(uid:int, rest:list[str], app:web.Application) -> web.Response:
     """Called by users to drop items where they are"""
     if len(rest) == 0:
         return web.Response(text='What do you want to drop?\n><code>inventory</code> will show your options')
     
-    me = users[uid]
-    gear = [tid for tid,where in me['inventory'].items() if where == 'inventory']
-    
-    todrop = ' '.join(rest)
-    
-    if todrop in [str(tid) for tid in gear]:
-        item = int(todrop)
-    else:
-        todrop = [tid for tid in gear if templates[tid]['name'] == todrop]
-        if len(todrop) == 0:
-            return web.Response(text='You have no '+' '.join(rest)+' to drop')
-        if len(todrop) > 1:
-            return web.Response(text='You have more than one '+' '.join(rest)+': please disambiguate which one you mead by using one of the following:<ul>'+
-                ''.join(f'<li><code>drop {tid}</code> to drop {templates[tid]["name"]} <sub>{tid}</sub></li>' for tid in todrop)
-            +'</ul')
-        item = todrop[0]
+    item = resolve_drop(uid, rest)
+    if isinstance(item, web.Response): return item
     
-    did = users[uid]['in']
+    did = users.domain(uid)
     spot = None
     try:
-        async with app.client.post(domains[did]['url']+'/dropped', json={
+        async with app.client.post(domains[did]['peer']+'/dropped', json={
             'secret':domains[did]['secret'],
             'user':uid,
             'item':{'id':item} | {k:v for k,v in templates[item].items() if k in ('name','description','verb')},
-        }) as resp:
+        }, **budget()) as resp:
             spot = await resp.json()
-    except:
+    except Exception:
         return web.Response(text="You try to drop it, but the domain won't let you")
     
-    me['inventory'][item] = (did, spot)
+    users.move(uid, item, (did, spot))
     
     return web.Response(text=templates[item]['name']+f" <sub>{item}</sub> dropped.")
 
 
+def resolve_drop(uid:int, rest:list[str]) -> web.Response | int:
+    """The carried item that drop's words name (an id, or a name or the start of one naming one item), or a response explaining why there is none"""
+    todrop = ' '.join(rest)
+    
+    if todrop.isdigit() and users.placement(uid, int(todrop)) == 'inventory':
+        return int(todrop)
+    todrop = sorted(carrying(uid).lookup(todrop))
+    if len(todrop) == 0:
+        return web.Response(text='You have no '+' '.join(rest)+' to drop')
+    if len(todrop) > 1:
+        return web.Response(text='You have more than one '+' '.join(rest)+': please disambiguate which one you mead by using one of the following:<ul>'+
+            ''.join(f'<li><code>drop {tid}</code> to drop {templates[tid]["name"]} <sub>{tid}</sub></li>' for tid in todrop)
+        +'</ul')
+    return todrop[0]
+
+
 
 ###########################################
 ###  Section: domain server interfaces  ###
@@ -405,23 +1114,28 @@ async def register_domain(req : web.Request) -> web.Response:
         return web.json_response(status=400, data={"error":"Sever url required"})
     if 'items' not in data or not isinstance(data['items'], list) or any(not isinstance(item, dict) for item in data['items']):
         return web.json_response(status=400, data={"error":"List of item templates required"})
+    if not isinstance(data.get('peer', data['url']), str):
+        return web.json_response(status=400, data={"error":"Peer url must be a string"})
     for i,d in domains.items():
         if d['url'] == data['url']:
             return web.json_response(status=409, data={"error":"Cannot register same domain more than once"})
-    if len(domains) > 1:
-        return web.Response(status=409, text="MP10's hub server only supports a single domain at a time.")
-    did = random.randrange(1000) # only one domain, but fake a different ID for each
+    if len(domains) >= max_domains:
+        return web.Response(status=409, text=f"This hub server only supports {max_domains} domains at a time.")
+    did = random.randrange(1000) # fake a different ID for each run
+    while did in domains: did = random.randrange(1000*max_domains)
     secret = make_secret()
     domains[did] = {
         'url':data['url'],
+        'peer':data.get('peer', data['url']),
         'name':data['name'],
         'description':data['description'],
         'secret':secret,
+        'loot':[],
     }
     ids = []
-    t0 = random.randrange(1000)
-    for item in data['items']:
-        tid = len(templates)+t0
+    t0 = random.randrange(1000) if not templates else max(templates)+1 # later domains' ids follow on from earlier ones
+    for i,item in enumerate(data['items']):
+        tid = t0+i
         templates[tid] = {'name':item.get('name','thing'), 'description':item.get('description','error: owner did not describe this item'), 'verb':item.get('verb',{}), 'home':did}
         ids.append(tid)
         if 'depth' in item and isinstance(item['depth'], int):
@@ -455,9 +1169,10 @@ async def transfer(req: web.Request) -> web.Response:
         return web.json_response(status=400, data={"error":"Numeric score required"})
     if score < 0 or score > 1.005:
         return web.json_response(status=400, data={"error":"Invalid score; should be between 0 and 1"})
-    if score < users[uid]['score'].get(did,0):
+    if score < (users.score(uid, did) or 0):
         return web.json_response(status=409, data={"error":"Reducing scores is not supported"})
-    users[uid]['score'][did] = score
+    users.set_score(uid, did, score)
+    leaderboard.update(uid, total_score(uid))
     return web.json_response(data={"ok":"Score changed"})
 
 @routes.post("/transfer")
@@ -488,7 +1203,7 @@ async def transfer(req: web.Request) -> web.Response:
     if 'to' not in data:
         return web.json_response(status=400, data={"error":"Missing \"to\" field"})
     
-    old = users[uid]['inventory'].get(tid)
+    old = users.placement(uid, tid)
     new = data['to']
     owned = templates[tid]['home'] == did or did in templates[tid].get('hosts',[])
     
@@ -504,9 +1219,9 @@ async def transfer(req: web.Request) -> web.Response:
     if old is not None and old[0] != did:
         return web.json_response(status=403, data={"error":"That item has been dropped in a different domain"})
 
-    users[uid]['inventory'][tid] = new if new == 'inventory' else (did, new)
-    if users[uid]['inventory'][tid] == 'inventory':
-        users[uid]['hashad'].add(tid)
+    users.move(uid, tid, new if new == 'inventory' else (did, new))
+    if new == 'inventory':
+        users.mark_had(uid, tid)
 
 
     return web.json_response(status=200, data={"ok":"Item transferred"})
@@ -537,28 +1252,659 @@ async def transfer(req: web.Request) -> web.Response:
     if ('location' in data) == ('depth' in data):
         return web.json_response(status=400, data={"error":"Must provide location xor depth"})
 
-    if 'location' in data:
-        where = data['location']
-        if where is None:
-            return web.json_response(status=400, data={"error":"Location required"})
-        if where != 'inventory':
-            where = (did, where)
-        resp = [iid for iid,loc in users[uid]['inventory'].items() if loc == where]
-    else:
-        resp = [iid for iid in domains[did]['loot'] if iid not in users[uid]['inventory'] and templates[iid].get('depth') == data['depth']]
-    
-    return web.json_response(status=200, data=resp)
+    if 'location' in data and data['location'] is None:
+        return web.json_response(status=400, data={"error":"Location required"})
+
+    return web.json_response(status=200, data=query_items(uid, did, data.get('location'), data.get('depth')))
 
+def query_items(uid:int, did:int, location:str | None, depth:int | None = None) -> list[int]:
+    """The items a /query from domain did asks for: those of uid's at location, or if that is None, uid's unclaimed prizes of that depth"""
+    if location is not None:
+        where = location if location == 'inventory' else (did, location)
+        return [iid for iid,loc in users.placements(uid).items() if loc == where]
+    placed = users.placements(uid)
+    return [iid for iid in domains[did]['loot'] if iid not in placed and templates[iid].get('depth') == depth]
+
+
+
+###################################
+###  Section: admission control  ###
+
+# Limits on user-facing traffic, adjustable at runtime through /admin/limits
+limits = {
+    'rate': 10.0, # commands per second each user may sustain
+    'burst': 20, # commands a user may send at once after being idle
+    'concurrency': 512, # /login and /command requests in progress at once before shedding load
+}
+buckets = collections.OrderedDict() # uid : [tokens, time.monotonic() of last refill], least recently used first
+in_flight = 0 # /login and /command requests currently being handled
+
+
+def take_token(uid : int) -> float:
+    """Spends one of the user's tokens; returns 0 if allowed, else seconds until one is available"""
+    now = time.monotonic()
+    # A bucket left idle long enough to refill is no different from none, so those are dropped as they come up
+    refill = limits['burst']/limits['rate'] if limits['rate'] > 0 else math.inf
+    while buckets and now - next(iter(buckets.values()))[1] >= refill:
+        buckets.popitem(last=False)
+    bucket = buckets.get(uid)
+    if bucket is None:
+        bucket = buckets[uid] = [limits['burst'], now]
+    buckets.move_to_end(uid)
+    bucket[0] = min(limits['burst'], bucket[0] + (now - bucket[1])*limits['rate'])
+    bucket[1] = now
+    if bucket[0] >= 1:
+        bucket[0] -= 1
+        return 0
+    return (1 - bucket[0]) / limits['rate'] if limits['rate'] > 0 else 60
+
+def too_many(wait : float, why : str) -> web.Response:
+    """A 429 response telling the client when to try again"""
+    return web.json_response(status=429, data={'error':why}, headers={'Retry-After':str(max(1, math.ceil(wait)))})
+
+@web.middleware
+async def shed_load(req : web.Request, handler) -> web.StreamResponse:
+    """Refuse user-facing requests beyond the global concurrency cap rather than queueing them"""
+    global in_flight
+    if req.path not in ('/login', '/command'):
+        return await handler(req)
+    if in_flight >= limits['concurrency']:
+        return too_many(1, 'Server is busy; try again shortly')
+    in_flight += 1
+    try:
+        return await handler(req)
+    finally:
+        in_flight -= 1
+
+@routes.get("/admin/limits")
+async def get_limits(req : web.Request) -> web.Response:
+    """Current admission-control limits"""
+    denied = checkadmin(req)
+    if denied is not None: return denied
+    return web.json_response(data=limits)
+
+@routes.post("/admin/limits")
+async def set_limits(req : web.Request) -> web.Response:
+    """Change some or all of the admission-control limits, e.g. {"rate": 5}"""
+    denied = checkadmin(req)
+    if denied is not None: return denied
+    try: data = await req.json()
+    except: return web.json_response(status=400, data={"error":"JSON data required"})
+    if not isinstance(data, dict) or any(k not in limits for k in data):
+        return web.json_response(status=400, data={"error":"Known limits are "+', '.join(limits)})
+    if any(not isinstance(v, (int, float)) or isinstance(v, bool) or v < 0 for v in data.values()):
+        return web.json_response(status=400, data={"error":"Limits must be non-negative numbers"})
+    limits.update(data)
+    return web.json_response(data=limits)
+
+
+###############################
+###  Section: observability  ###
+
+# Metric definitions: name -> (type, help, histogram buckets)
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+metric_info = {
+    'hub_requests_total': ('counter', 'Requests handled, by route, command verb and status', None),
+    'hub_request_seconds': ('histogram', 'Request latency, by route and command verb', LATENCY_BUCKETS),
+    'hub_outbound_requests_total': ('counter', 'Calls made to domain servers, by peer, path and status', None),
+    'hub_outbound_seconds': ('histogram', 'Latency of calls made to domain servers, by peer and path', LATENCY_BUCKETS),
+    'hub_event_loop_lag_seconds': ('histogram', 'How late the event loop ran a timer scheduled every lag_interval', LATENCY_BUCKETS),
+    'hub_event_loop_stalls_total': ('counter', 'Times a single callback blocked the event loop for over stall_threshold', None),
+}
+# Recorded values, keyed by (name, ((label,value),...)); histograms hold per-bucket counts then the sum
+metric_values = {}
+
+hub_verbs = ('region', 'journey', 'inventory', 'score', 'drop', 'leaderboard')
+
+
+def count(name : str, labels : tuple, by : float = 1) -> None:
+    """Add to a counter"""
+    key = (name, labels)
+    metric_values[key] = metric_values.get(key, 0) + by
+
+def observe(name : str, labels : tuple, value : float) -> None:
+    """Record one sample in a histogram"""
+    key = (name, labels)
+    buckets = metric_info[name][2]
+    h = metric_values.get(key)
+    if h is None:
+        h = metric_values[key] = [0]*(len(buckets)+2)
+    h[bisect.bisect_left(buckets, value)] += 1
+    h[-1] += value
+
+def gauges() -> dict:
+    """Point-in-time values computed at scrape time: name -> (help, value)"""
+    return {
+        'hub_users': ('Users who have logged in', len(users)),
+        'hub_domains': ('Registered domains', len(domains)),
+        'hub_templates': ('Known item templates', len(templates)),
+        'hub_event_loop_lag_last_seconds': ('Most recently measured event loop lag', loop_lag),
+    }
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    def fmt(labels):
+        return '{'+','.join(f'{k}="{v}"' for k,v in labels)+'}' if labels else ''
+    lines = []
+    for name, (kind, text, buckets) in metric_info.items():
+        lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for (n, labels), value in list(metric_values.items()):
+            if n != name: continue
+            if kind == 'counter':
+                lines.append(f'{name}{fmt(labels)} {value}')
+                continue
+            total = 0
+            for le, hits in zip(buckets + ('+Inf',), value):
+                total += hits
+                lines.append(f'{name}_bucket{fmt(labels + (("le", le),))} {total}')
+            lines.append(f'{name}_sum{fmt(labels)} {value[-1]}')
+            lines.append(f'{name}_count{fmt(labels)} {total}')
+    for name, (text, value) in gauges().items():
+        lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {value}')
+    return '\n'.join(lines)+'\n'
+
+
+@routes.get("/metrics")
+async def metrics(req : web.Request) -> web.Response:
+    """Prometheus scrape endpoint"""
+    return web.Response(text=render_metrics(), content_type='text/plain', headers={'X-Content-Type-Options':'nosniff'})
+
+
+@web.middleware
+async def record_metrics(req : web.Request, handler) -> web.StreamResponse:
+    """Count and time every request; handle_command fills in req['verb']"""
+    resource = req.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    start = time.perf_counter()
+    status = 500
+    try:
+        resp = await handler(req)
+        status = resp.status
+        return resp
+    except web.HTTPException as ex:
+        status = ex.status
+        raise
+    finally:
+        labels = (('route', route), ('verb', req.get('verb', '')))
+        observe('hub_request_seconds', labels, time.perf_counter() - start)
+        count('hub_requests_total', labels + (('status', status),))
+
+def outbound_tracing():
+    """aiohttp client hooks that time every call the hub makes to a domain"""
+    from aiohttp import TraceConfig
+    async def on_start(session, ctx, params):
+        ctx.start = time.perf_counter()
+        ctx.parent = current_span.get()
+        if ctx.parent is not None:
+            ctx.span = (ctx.parent[0], new_id(8), ctx.parent[2])
+            ctx.wall = time.time()
+            params.headers[TRACE_HEADER] = f'00-{ctx.span[0]}-{ctx.span[1]}-{"01" if ctx.span[2] else "00"}'
+    def finish(ctx, params, status):
+        labels = (('peer', str(params.url.origin())), ('path', params.url.path))
+        observe('hub_outbound_seconds', labels, time.perf_counter() - ctx.start)
+        count('hub_outbound_requests_total', labels + (('status', status),))
+        if ctx.parent is not None and ctx.span[2]:
+            write_span(params.method+' '+str(params.url), ctx.span, ctx.parent[1], ctx.wall, time.time(), {'status':status})
+    async def on_end(session, ctx, params):
+        finish(ctx, params, params.response.status)
+    async def on_error(session, ctx, params):
+        finish(ctx, params, 'error')
+    trace = TraceConfig()
+    trace.on_request_start.append(on_start)
+    trace.on_request_end.append(on_end)
+    trace.on_request_exception.append(on_error)
+    return trace
+
+
+# Distributed tracing: W3C traceparent headers between servers, spans written in the
+# Chrome trace-event JSON format (loadable by Perfetto, chrome://tracing or speedscope)
+TRACE_HEADER = 'traceparent'
+trace_sample_rate = 0.0 # fraction of new traces recorded; set by --trace-sample
+trace_file = 'hub-trace.json' # set by --trace-file; rotated to .1, .2, ... when full
+trace_max_bytes = 16*1024*1024
+trace_backups = 3
+trace_out = None # open trace file, created on the first sampled span
+current_span = contextvars.ContextVar('current_span', default=None) # (trace_id, span_id, sampled)
+
+
+def new_id(nbytes : int) -> str:
+    """A random lowercase hex identifier"""
+    return f'{random.getrandbits(nbytes*8):0{nbytes*2}x}'
+
+def parse_traceparent(header : str | None) -> tuple | None:
+    """(trace_id, parent_span_id, sampled) from a traceparent header, or None if absent or malformed"""
+    if not header: return None
+    parts = header.strip().split('-')
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16: return None
+    try: flags = int(parts[3], 16)
+    except ValueError: return None
+    return (parts[1], parts[2], bool(flags & 1))
+
+def open_trace_file() -> None:
+    """Start a fresh trace file, shifting older ones along"""
+    global trace_out
+    if trace_out is not None: trace_out.close()
+    for i in range(trace_backups-1, 0, -1):
+        if os.path.exists(f'{trace_file}.{i}'):
+            os.replace(f'{trace_file}.{i}', f'{trace_file}.{i+1}')
+    if os.path.exists(trace_file):
+        os.replace(trace_file, trace_file+'.1')
+    trace_out = open(trace_file, 'w')
+    # the closing ] is optional in this format, so events can simply be appended
+    trace_out.write('[\n'+json.dumps({'name':'process_name', 'ph':'M', 'pid':os.getpid(), 'args':{'name':'hub'}})+',\n')
+
+def write_span(name : str, me : tuple, parent_id : str | None, start : float, end : float, args : dict) -> None:
+    """Append one finished span to the trace file"""
+    if trace_out is None or trace_out.tell() > trace_max_bytes:
+        open_trace_file()
+    trace_out.write(json.dumps({
+        'name':name, 'cat':'hub', 'ph':'X',
+        'ts':int(start*1e6), 'dur':int((end-start)*1e6),
+        'pid':os.getpid(), 'tid':int(me[0][:8], 16),
+        'args':{'trace_id':me[0], 'span_id':me[1], 'parent_id':parent_id} | args,
+    })+',\n')
+
+@contextlib.contextmanager
+def span(name : str, parent : tuple | None = None, **args):
+    """Time a unit of work as a child of parent (default: the current span)
+
+    parent is (trace_id, span_id, sampled); span_id may be None for a new root.
+    Does nothing outside of a trace.
+    """
+    if parent is None: parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    me = (parent[0], new_id(8), parent[2])
+    token = current_span.set(me)
+    start = time.time()
+    try:
+        yield me
+    finally:
+        current_span.reset(token)
+        if me[2]: write_span(name, me, parent[1], start, time.time(), args)
+
+
+@web.middleware
+async def trace_requests(req : web.Request, handler) -> web.StreamResponse:
+    """Continue the caller's trace, or start one for user-facing requests"""
+    parent = parse_traceparent(req.headers.get(TRACE_HEADER))
+    if parent is None:
+        if req.path not in ('/login', '/command'):
+            return await handler(req)
+        parent = (new_id(16), None, random.random() < trace_sample_rate)
+    with span(req.method+' '+req.path, parent) as me:
+        resp = await handler(req)
+        resp.headers['X-Trace-Id'] = me[0]
+        return resp
+
+
+# Traffic recorder: user-facing requests appended to record_file as one compact JSON object per line,
+# {"t": unix time, "srv": "hub", "path", "user", "cmd" or "cmds", "status", "ms"}, for bench/replay.py
+record_file = None # set by --record; nothing is recorded while None
+record_out = None # the open record file
+
+
+def traffic_entry(srv : str, path : str, body : bytes, resp : web.StreamResponse | None, status : int, start : float, ms : float) -> dict:
+    """The record of one request; secrets and tokens are left out, as replay issues its own"""
+    entry = {'t':round(start, 4), 'srv':srv, 'path':path}
+    try: data = json.loads(body) if body else {}
+    except ValueError: data = {}
+    if isinstance(data, dict):
+        if 'user' in data: entry['user'] = data['user']
+        if 'command' in data: entry['cmd'] = data['command']
+        if 'commands' in data: entry['cmds'] = data['commands']
+    if path == '/login' and status == 200 and isinstance(resp, web.Response) and resp.body:
+        entry['user'] = json.loads(resp.body)['id']
+    entry['status'] = status
+    entry['ms'] = round(ms, 2)
+    return entry
+
+@web.middleware
+async def record_traffic(req : web.Request, handler) -> web.StreamResponse:
+    """Append each /login and /command to the record file, with its outcome"""
+    if record_out is None or req.path not in ('/login', '/command'):
+        return await handler(req)
+    body = await req.read() if req.can_read_body else b''
+    start, before = time.time(), time.perf_counter()
+    resp, status = None, 500
+    try:
+        resp = await handler(req)
+        status = resp.status
+        return resp
+    except web.HTTPException as ex:
+        status = ex.status
+        raise
+    finally:
+        entry = traffic_entry('hub', req.path, body, resp, status, start, (time.perf_counter()-before)*1000)
+        record_out.write(json.dumps(entry, separators=(',',':'))+'\n')
+
+
+# On-demand sampling profiler: a background thread periodically snapshots the event-loop
+# thread's stack and tallies collapsed stacks ("outer;...;inner count", as flamegraph.pl expects)
+profiling = None # while running: {'routes':set, 'users':set, 'frames':set of middleware frames of selected requests}
+
+
+def frame_name(frame) -> str:
+    """file:function label for one stack frame"""
+    code = frame.f_code
+    return os.path.basename(code.co_filename)+':'+getattr(code, 'co_qualname', code.co_name)
+
+def sample_stacks(thread_id : int, interval : float, stop : threading.Event, stacks : dict, selected : set | None) -> None:
+    """Profiler thread body; only counts stacks passing through a frame in selected, if given"""
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        if frame is None: return
+        if frame.f_code.co_name == 'select' and frame.f_code.co_filename.endswith('selectors.py'):
+            continue # idle event loop
+        names = []
+        chosen = selected is None
+        while frame is not None:
+            if not chosen and frame in selected: chosen = True
+            names.append(frame_name(frame))
+            frame = frame.f_back
+        if chosen:
+            key = ';'.join(reversed(names))
+            stacks[key] = stacks.get(key, 0) + 1
+
+@routes.post("/admin/profile")
+async def profile(req : web.Request) -> web.Response:
+    """Sample the event loop for a number of seconds and return collapsed stacks
+
+    { "seconds": how long to profile, at most 60 (default 10)
+    , "interval": seconds between samples (default 0.005)
+    , "routes": optional list of routes (e.g. "/command") to restrict sampling to
+    , "users": optional list of user ids to restrict sampling to
+    }
+    """
+    global profiling
+    denied = checkadmin(req)
+    if denied is not None: return denied
+    try: data = await req.json() if req.can_read_body else {}
+    except: return web.json_response(status=400, data={"error":"JSON data required"})
+    if profiling is not None:
+        return web.json_response(status=409, data={"error":"A profile is already being taken"})
+    try:
+        seconds = min(60, max(0, float(data.get('seconds', 10))))
+        interval = max(0.001, float(data.get('interval', 0.005)))
+    except (TypeError, ValueError):
+        return web.json_response(status=400, data={"error":"seconds and interval must be numbers"})
+    filtered = 'routes' in data or 'users' in data
+    profiling = {'routes':set(data.get('routes', ())), 'users':set(data.get('users', ())), 'frames':set()}
+    stacks = {}
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_stacks, daemon=True,
+        args=(threading.get_ident(), interval, stop, stacks, profiling['frames'] if filtered else None))
+    # Without a short GIL switch interval the sampler mostly wakes when the loop is idle
+    switch = sys.getswitchinterval()
+    sys.setswitchinterval(min(switch, interval/5))
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stop.set()
+        sampler.join()
+        sys.setswitchinterval(switch)
+        profiling = None
+    return web.Response(text=''.join(f'{k} {v}\n' for k,v in sorted(stacks.items())))
+
+@web.middleware
+async def mark_profiled(req : web.Request, handler) -> web.StreamResponse:
+    """While a filtered profile runs, mark the requests it selected by their frame"""
+    if profiling is None or not (profiling['routes'] or profiling['users']):
+        return await handler(req)
+    chosen = req.path in profiling['routes']
+    if not chosen and profiling['users'] and req.can_read_body:
+        try: chosen = (await req.json()).get('user') in profiling['users']
+        except: pass
+    if not chosen:
+        return await handler(req)
+    marks = profiling['frames']
+    me = sys._getframe()
+    marks.add(me)
+    try:
+        return await handler(req)
+    finally:
+        marks.discard(me)
+
+
+# Event-loop watchdog: a timer measures loop lag, and a thread captures the loop's stack
+# whenever that timer is overdue by more than stall_threshold (i.e. a callback is blocking)
+lag_interval = 0.1 # seconds between lag measurements
+stall_threshold = 0.25 # seconds of blocking worth a stack capture; set by --stall-threshold
+loop_lag = 0.0 # latest lag measurement
+heartbeat = time.monotonic() # when the lag timer was last scheduled
+stalls = collections.deque(maxlen=20) # recent captures: {"at", "seconds", "stack"}
+
+
+async def measure_lag() -> None:
+    """Runs forever, recording how late each lag_interval sleep wakes up"""
+    global loop_lag, heartbeat
+    loop = asyncio.get_running_loop()
+    while True:
+        heartbeat = time.monotonic()
+        before = loop.time()
+        await asyncio.sleep(lag_interval)
+        loop_lag = max(0.0, loop.time() - before - lag_interval)
+        observe('hub_event_loop_lag_seconds', (), loop_lag)
+
+def watch_loop(thread_id : int, stop : threading.Event) -> None:
+    """Watchdog thread body: capture the loop thread's stack once per stall"""
+    stall = None
+    while not stop.wait(stall_threshold/4):
+        late = time.monotonic() - heartbeat - lag_interval
+        if late <= stall_threshold:
+            stall = None
+        elif stall is None:
+            frame = sys._current_frames().get(thread_id)
+            stall = {'at':time.time(), 'seconds':late, 'stack':''.join(traceback.format_stack(frame)) if frame else ''}
+            stalls.append(stall)
+            count('hub_event_loop_stalls_total', ())
+            print(f'WARNING: event loop blocked for over {stall_threshold}s in:\n{stall["stack"]}', file=sys.stderr)
+        else:
+            stall['seconds'] = late
+
+@routes.get("/admin/stalls")
+async def list_stalls(req : web.Request) -> web.Response:
+    """Recent event-loop stalls with the stack that was running, newest last"""
+    denied = checkadmin(req)
+    if denied is not None: return denied
+    return web.json_response(data=list(stalls))
+
+async def start_watchdog(app):
+    """Start the lag timer and the watchdog thread"""
+    app.lag_timer = asyncio.create_task(measure_lag())
+    app.watchdog_stop = threading.Event()
+    threading.Thread(target=watch_loop, args=(threading.get_ident(), app.watchdog_stop), daemon=True).start()
+
+async def stop_watchdog(app):
+    """Stop the lag timer and the watchdog thread"""
+    app.watchdog_stop.set()
+    app.lag_timer.cancel()
+
+
+# Memory accounting: approximate deep sizes of the global structures, and tracemalloc
+# snapshots each diffed against the one before to find what keeps growing
+memory_structures = ('users', 'templates', 'domains', 'grid', 'domains_prizes', 'others_items',
+                     'leaderboard', 'token_keys', 'static_assets', 'metric_values', 'stalls')
+memory_snapshot = None # the last tracemalloc snapshot taken, compared against by the next diff
+memory_filters = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+def deep_size(root) -> int:
+    """Approximate bytes held by root and everything it reaches, each object counted once
+
+    Containers are followed, as are the attributes of objects whose class is defined in
+    this file; anything else (sockets, sqlite connections, ...) counts only its own size,
+    so data a SQLiteUserStore keeps on disk or in SQLite's page cache is not included.
+    """
+    size, seen, todo = 0, set(), [root]
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen: continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            todo.extend(obj.keys())
+            todo.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            todo.extend(obj)
+        elif type(obj).__module__ == __name__:
+            if hasattr(obj, '__dict__'): todo.append(obj.__dict__)
+            todo.extend(getattr(obj, slot) for slot in getattr(type(obj), '__slots__', ()) if hasattr(obj, slot))
+    return size
+
+def resident_bytes() -> int | None:
+    """The process's resident set size, from /proc on Linux"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'): return int(line.split()[1]) * 1024
+    except OSError: pass
+    return None
+
+def memory_trace(action : str, top : int, frames : int) -> dict:
+    """Start, diff or stop tracemalloc; a diff lists the top allocation sites by growth since the last snapshot"""
+    global memory_snapshot
+    if action == 'stop':
+        tracemalloc.stop()
+        memory_snapshot = None
+        return {'tracing': False}
+    if action == 'start' and not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    snapshot = tracemalloc.take_snapshot().filter_traces(memory_filters)
+    current, peak = tracemalloc.get_traced_memory()
+    result = {'tracing': True, 'traced_bytes': current, 'peak_bytes': peak}
+    if action == 'diff':
+        key = 'traceback' if tracemalloc.get_traceback_limit() > 1 else 'lineno'
+        result['growth'] = [
+            {'where': [f'{frame.filename}:{frame.lineno}' for frame in stat.traceback],
+             'size_diff': stat.size_diff, 'count_diff': stat.count_diff, 'size': stat.size, 'count': stat.count}
+            for stat in snapshot.compare_to(memory_snapshot, key)[:top]
+        ]
+    memory_snapshot = snapshot
+    return result
+
+@routes.post("/admin/memory")
+async def memory(req : web.Request) -> web.Response:
+    """Report approximate memory use per global structure, and optionally trace allocations
+
+    { "structures": names from memory_structures to size (default all; [] for none)
+    , "trace": "start" (begin tracing and take a baseline snapshot), "diff" (compare a new
+               snapshot to the last one, which it then replaces) or "stop"
+    , "top": allocation sites listed by a diff (default 25)
+    , "frames": traceback depth recorded from "start" on (default 1)
+    }
+    Sizing walks every object in the structures on the event loop, so it stalls the hub
+    for as long as that takes on a large deployment.
+    """
+    denied = checkadmin(req)
+    if denied is not None: return denied
+    try: data = await req.json() if req.can_read_body else {}
+    except: return web.json_response(status=400, data={"error":"JSON data required"})
+    names = data.get('structures', memory_structures)
+    if not isinstance(names, list | tuple) or any(name not in memory_structures for name in names):
+        return web.json_response(status=400, data={"error":"structures must be a list of: "+', '.join(memory_structures)})
+    action = data.get('trace')
+    if action not in (None, 'start', 'diff', 'stop'):
+        return web.json_response(status=400, data={"error":"trace must be start, diff or stop"})
+    if action == 'diff' and memory_snapshot is None:
+        return web.json_response(status=409, data={"error":"Tracing is not started"})
+    try:
+        top = max(0, int(data.get('top', 25)))
+        frames = min(100, max(1, int(data.get('frames', 1))))
+    except (TypeError, ValueError):
+        return web.json_response(status=400, data={"error":"top and frames must be integers"})
+
+    report = {'rss_bytes': resident_bytes()}
+    # Snapshot before sizing so the walk's own allocations are not in the diff
+    if action is not None: report['tracemalloc'] = memory_trace(action, top, frames)
+    report['structures'] = {}
+    for name in names:
+        obj = globals()[name]
+        report['structures'][name] = {'bytes': deep_size(obj), 'entries': len(obj) if hasattr(obj, '__len__') else None}
+    return web.json_response(data=report)
+
+
+@web.middleware
+async def enforce_deadline(req : web.Request, handler) -> web.StreamResponse:
+    """Bound user-facing requests by request_budget and honour deadlines forwarded by peers"""
+    bounds = []
+    if req.path in ('/login', '/command'):
+        bounds.append(request_budget)
+    if DEADLINE_HEADER in req.headers:
+        try: bounds.append(int(req.headers[DEADLINE_HEADER])/1000)
+        except ValueError: return web.json_response(status=400, data={'error':'Malformed '+DEADLINE_HEADER+' header'})
+    if not bounds:
+        return await handler(req)
+    left = min(bounds)
+    if left <= 0:
+        return web.json_response(status=504, data={'error':'Deadline exceeded'})
+    deadline.set(time.monotonic() + left)
+    try:
+        return await asyncio.wait_for(handler(req), left)
+    except asyncio.TimeoutError:
+        return web.json_response(status=504, data={'error':'Deadline exceeded'})
+
+
+async def flush_users() -> None:
+    """Runs forever, committing the user store's batched writes"""
+    while True:
+        await asyncio.sleep(flush_interval)
+        users.flush()
+
+async def start_flusher(app):
+    """Start committing user-store writes in batches"""
+    app.flusher = asyncio.create_task(flush_users())
+
+async def stop_flusher(app):
+    """Commit any remaining user-store writes"""
+    app.flusher.cancel()
+    users.flush()
+
+
+class PeerClient:
+    """Posts to http:// peers over TCP and to unix:/path/to/socket peers over that Unix socket"""
+    def __init__(self, **kwargs):
+        from aiohttp import ClientSession
+        self.kwargs = kwargs
+        self.tcp = ClientSession(**kwargs)
+        self.unix = {} # socket path : ClientSession using a UnixConnector to it
+
+    def post(self, url : str, **kwargs):
+        """Like ClientSession.post; every peer endpoint is one path segment, so a unix: URL splits at its last /"""
+        if not url.startswith('unix:'):
+            return self.tcp.post(url, **kwargs)
+        sock, _, endpoint = url[len('unix:'):].rpartition('/')
+        session = self.unix.get(sock)
+        if session is None:
+            from aiohttp import ClientSession, UnixConnector
+            session = self.unix[sock] = ClientSession(connector=UnixConnector(path=sock), **self.kwargs)
+        return session.post('http://unix/'+endpoint, **kwargs)
+
+    async def close(self):
+        await self.tcp.close()
+        for session in self.unix.values(): await session.close()
 
 
 async def start_session(app):
     """To be run on startup of each event loop"""
-    from aiohttp import ClientSession, ClientTimeout
-    app.client = ClientSession(timeout=ClientTimeout(total=3))
+    global record_out
+    from aiohttp import ClientTimeout
+    app.client = PeerClient(timeout=ClientTimeout(total=3), trace_configs=[outbound_tracing()])
+    if record_file is not None: record_out = open(record_file, 'a', buffering=1)
 
 async def end_session(app):
     """To be run on shutdown of each event loop"""
     await app.client.close()
+    if trace_out is not None: trace_out.flush()
+    if record_out is not None: record_out.close()
 
 
 if __name__ == '__main__':
@@ -566,7 +1912,36 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', type=str, default="0.0.0.0")
     parser.add_argument('-p','--port', type=int, default=10340)
+    parser.add_argument('--budget', type=float, default=request_budget, help='seconds allowed for each /login and /command')
+    parser.add_argument('--trace-sample', type=float, default=trace_sample_rate, help='fraction of /login and /command requests to trace')
+    parser.add_argument('--trace-file', type=str, default=trace_file, help='where to write sampled spans')
+    parser.add_argument('--store', choices=('memory', 'sqlite'), default='memory', help='where user data is kept')
+    parser.add_argument('--store-file', type=str, default='hub-users.sqlite', help='database file for --store sqlite')
+    parser.add_argument('--token-ttl', type=int, default=token_ttl, help='seconds a session token stays valid')
+    parser.add_argument('--stall-threshold', type=float, default=stall_threshold, help='seconds a callback may block the event loop before its stack is captured')
+    parser.add_argument('--admin-token', type=str, default=None, help='bearer token for /admin/... endpoints (random if omitted)')
+    parser.add_argument('--max-domains', type=int, default=max_domains, help='most domains that may register')
+    parser.add_argument('--record', type=str, default=None, help='append every /login and /command to this file, for bench/replay.py')
+    parser.add_argument('--unix', type=str, default=None, help='also listen on this Unix socket; domains registered as unix:/path call back on it')
+    parser.add_argument('--static-max-age', type=int, default=static_max_age, help='seconds browsers may cache the front-end without revalidating')
+    parser.add_argument('--dev', action='store_true', help='reload the front-end when its files change')
     args = parser.parse_args()
+    request_budget = args.budget
+    trace_sample_rate = args.trace_sample
+    trace_file = args.trace_file
+    admin_token = args.admin_token or make_secret(secure=True)
+    stall_threshold = args.stall_threshold
+    token_ttl = args.token_ttl
+    max_domains = args.max_domains
+    record_file = args.record
+    unix_path = args.unix
+    static_max_age = args.static_max_age
+    dev_mode = args.dev
+    if unix_path and os.path.exists(unix_path) and stat.S_ISSOCK(os.stat(unix_path).st_mode):
+        os.unlink(unix_path) # left behind by an earlier run
+    if args.store == 'sqlite':
+        users = SQLiteUserStore(args.store_file)
+        users.clear() # user ids are only meaningful alongside this run's domains and templates
 
     import socket
     whoami = socket.getfqdn()
@@ -574,10 +1949,17 @@ if __name__ == '__main__':
     whoami += ':'+str(args.port)
     whoami = 'http://' + whoami
     print("URL to visit in browser:\n\t"+whoami)
+    print("Admin token:\n\t"+admin_token)
     print()
     
-    app = web.Application()
+    app = web.Application(middlewares=[record_metrics, record_traffic, shed_load, trace_requests, enforce_deadline, mark_profiled])
     app.on_startup.append(start_session)
+    app.on_startup.append(start_watchdog)
+    app.on_startup.append(start_flusher)
+    app.on_startup.append(start_assets)
     app.on_shutdown.append(end_session)
+    app.on_shutdown.append(stop_watchdog)
+    app.on_shutdown.append(stop_flusher)
+    app.on_shutdown.append(stop_assets)
     app.add_routes(routes)
-    web.run_app(app, host=args.host, port=args.port)
+    web.run_app(app, host=args.host, port=args.port, path=unix_path)
@@ -1,6 +1,26 @@
 from aiohttp import web 
 from aiohttp.web import Request, Response, json_response
+import asyncio
+import base64
+import bisect
+import collections
+import contextlib
+import contextvars
+import hashlib
+import hmac
+import html
+import json
+import math
+import os
 import random
+import sqlite3
+import stat
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+import zlib
 
 routes = web.RouteTableDef()
 
@@ -62,8 +82,41 @@ DOMAIN_ITS = {
     "sword-of-gryffindor": False
 }
 
-NAME_2_ID = {}          # The helper dict for (item_name -> item_id)
+# Item ids by name, where any prefix of a name also finds its items (names are kept sorted for bisect)
+class ItemNames:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.ids = {}       # name -> set of item ids (several items may share a name)
+        self.names = []     # every name in ids, sorted
+
+    def add(self, name, item_id):
+        if name not in self.ids:
+            self.ids[name] = set()
+            bisect.insort(self.names, name)
+        self.ids[name].add(item_id)
+
+    # The names starting with prefix, in order (at most limit of them)
+    def complete(self, prefix, limit=None):
+        found = []
+        for i in range(bisect.bisect_left(self.names, prefix), len(self.names)):
+            if not self.names[i].startswith(prefix) or len(found) == limit:
+                break
+            found.append(self.names[i])
+        return found
+
+    # The ids of the items called name or, if there are none, of those whose name starts with it
+    def lookup(self, name):
+        if name in self.ids:
+            return set(self.ids[name])
+        if not name:
+            return set()
+        return set().union(*(self.ids[n] for n in self.complete(name)))
+
+NAME_2_ID = {}          # The helper dict for (item_name -> item_id), of this domain's own items
 ID_2_ITEM = {}          # The helper dict for (item_id -> item_info)
+ITEM_NAMES = ItemNames()    # Every item in ID_2_ITEM by name, ours and those brought in by /arrive
 
 # Per-user state dictionary
 # Key: user_id
@@ -79,10 +132,39 @@ ID_2_ITEM = {}          # The helper dict for (item_id -> item_info)
 #   "from": str (the direction or mode they arrived from)
 USER_STATES = {}
 
-# A simple counter to order arrivals/departures since no real time is provided.
-# Every time a user arrives or departs, increment counters and store them.
-ARRIVAL_COUNTER = 0
-DEPARTURE_COUNTER = 0
+# Idle players are evicted from USER_STATES to a local SQLite file and rehydrated on their next request
+USER_TTL = 30 * 60              # Seconds without a request before a user is evicted (--user-ttl)
+MAX_USERS = 100000              # Most users held in memory at once (--max-users)
+SPILL_FILE = "domain-users.sqlite"  # Where evicted users go (--spill-file)
+SPILL_DB = None                 # sqlite3 connection, opened on first use
+LAST_SEEN = collections.OrderedDict()   # user_id -> time.monotonic() of last request, least recent first
+
+# Session tokens from the hub's /login ("uid.did.expiry.signature"), checked locally with a key derived from DOMAIN_SECRET
+TOKEN_KEY = None        # Set once registered with the hub
+REQUIRE_TOKEN = True    # Reject requests without a token; --allow-missing-token turns it off for hubs that do not issue them
+
+# Unix socket this domain also listens on (--unix), offered to a hub that reached us by a unix: URL
+UNIX_PATH = None
+
+# Bearer token required by /admin/... endpoints (--admin-token, or random at startup)
+ADMIN_TOKEN = None
+
+# The deadline forwarded by the hub (milliseconds remaining), as a time.monotonic() value per request
+DEADLINE_HEADER = 'X-Deadline-Ms'
+DEADLINE = contextvars.ContextVar('DEADLINE', default=None)
+
+# Per-request cache of hub /query answers, {(user, location, depth): item ids}; cleared by every transfer
+QUERY_CACHE = contextvars.ContextVar('QUERY_CACHE', default=None)
+
+# Who is where: room -> set of user_ids of the arrived users in it, kept up to date by /arrive, /depart and [go]
+ROOM_OCCUPANTS = {}
+
+# One lock per user with requests in progress, user_id -> [asyncio.Lock, requests holding or waiting on it]
+# /command, /arrive and /depart for the same user run one at a time; different users never wait on each other
+USER_LOCKS = {}
+
+# Users of a batched /arrive set up at once (each makes its own hub calls)
+ARRIVE_CONCURRENCY = 16
 
 # HELPER: Initialize the user
 def new_user_state():
@@ -102,6 +184,10 @@ def new_user_state():
 
 # HELPER: Synchronize the state of the user
 def syn_user_state(user_id, user_state):
+    # Evicted while the command was waiting on the hub: this copy is the newest one
+    if user_id not in USER_STATES:
+        USER_STATES[user_id] = user_state
+        touch_user(user_id)
     USER_STATES[user_id]["arrived"] = user_state["arrived"]
     USER_STATES[user_id]["arrive_time"] = user_state["arrive_time"]
     USER_STATES[user_id]["depart_time"] = user_state["depart_time"]
@@ -113,6 +199,145 @@ def syn_user_state(user_id, user_state):
     USER_STATES[user_id]["torch_state"] = user_state["torch_state"]
     USER_STATES[user_id]["from"] = user_state["from"]
 
+# HELPER: Move the user between rooms in ROOM_OCCUPANTS (None for leaving or entering the domain)
+def place_user(user_id, old_loc, new_loc):
+    if old_loc is not None and old_loc in ROOM_OCCUPANTS:
+        ROOM_OCCUPANTS[old_loc].discard(user_id)
+        if not ROOM_OCCUPANTS[old_loc]:
+            del ROOM_OCCUPANTS[old_loc]
+    if new_loc is not None:
+        ROOM_OCCUPANTS.setdefault(new_loc, set()).add(user_id)
+
+# HELPER: Hold state as the user's own, moving them in ROOM_OCCUPANTS from where their old state (if any) had them
+def adopt_user_state(user_id, state):
+    old = USER_STATES.get(user_id)
+    place_user(user_id, old["loc"] if old and old["arrived"] else None, state["loc"] if state["arrived"] else None)
+    USER_STATES[user_id] = state
+
+# HELPER: The users arrived in a room: this process's ROOM_OCCUPANTS, or under --workers (where each worker only
+# places its own users) those the store has there and has seen within USER_TTL, as eviction would have kept them
+def room_occupants(room):
+    if WORKER_SOCKET is None:
+        return ROOM_OCCUPANTS.get(room, set())
+    return set(STATE_STORE.room_users(room, time.time() - USER_TTL))
+
+# HELPER: Run the block with the user's lock held, dropping the lock once nobody holds or waits on it
+@contextlib.asynccontextmanager
+async def user_lock(user_id):
+    entry = USER_LOCKS.get(user_id)
+    if entry is None:
+        entry = USER_LOCKS[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            if STATE_STORE is None:
+                yield
+                return
+            # Another worker may have handled this user since this one last did: the store has the latest state
+            stored = STATE_STORE.get_user(user_id)
+            if stored is not None:
+                adopt_user_state(user_id, stored)
+            else:
+                USER_STATES.pop(user_id, None)
+            try:
+                yield
+            finally:
+                # Handed back before the next request for this user, on any worker, can read it;
+                # "seen" lets room_occupants() leave out users who have gone idle
+                if user_id in USER_STATES:
+                    USER_STATES[user_id]["seen"] = time.time()
+                    STATE_STORE.put_user(user_id, USER_STATES[user_id])
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del USER_LOCKS[user_id]
+
+# HELPER: The spill database, created on first use
+def spill_db():
+    global SPILL_DB
+    if SPILL_DB is None:
+        SPILL_DB = sqlite3.connect(SPILL_FILE)
+        SPILL_DB.execute("PRAGMA journal_mode=WAL")
+        SPILL_DB.execute("PRAGMA synchronous=NORMAL")
+        SPILL_DB.execute("CREATE TABLE IF NOT EXISTS user_states (user_id TEXT PRIMARY KEY, state TEXT NOT NULL)")
+    return SPILL_DB
+
+# HELPER: Mark a user as just seen, evicting the least recently seen users if over MAX_USERS
+def touch_user(user_id):
+    LAST_SEEN[user_id] = time.monotonic()
+    LAST_SEEN.move_to_end(user_id)
+    if len(LAST_SEEN) > MAX_USERS:
+        evict_users(len(LAST_SEEN) - MAX_USERS)
+
+# HELPER: Spill the n least recently seen users (or all idle ones, if n is None) to disk, or to the STATE_STORE if there is one
+def evict_users(n=None):
+    cutoff = time.monotonic() - USER_TTL
+    spilled = []
+    # LAST_SEEN is in order of last request, so idle users are always at the front
+    while LAST_SEEN and (len(spilled) < n if n is not None else next(iter(LAST_SEEN.values())) < cutoff):
+        user_id, _ = LAST_SEEN.popitem(last=False)
+        state = USER_STATES.pop(user_id, None)
+        BUCKETS.pop(user_id, None)
+        if state is not None:
+            # An idle user is no longer shown in their room or sent what is said there, until they come back
+            if state["arrived"]:
+                place_user(user_id, state["loc"], None)
+            spilled.append((user_id, state))
+    if spilled and STATE_STORE is not None:
+        for user_id, state in spilled:
+            STATE_STORE.put_user(user_id, state)
+        count("domain_user_evictions_total", (), len(spilled))
+    elif spilled:
+        db = spill_db()
+        db.executemany("INSERT OR REPLACE INTO user_states VALUES (?, ?)", [(json.dumps(u), json.dumps(s)) for u, s in spilled])
+        db.commit()
+        count("domain_user_evictions_total", (), len(spilled))
+
+# HELPER: The user's state, from memory or rehydrated from disk; a fresh one (if create) or None when unknown
+def load_user_state(user_id, create=False):
+    state = USER_STATES.get(user_id)
+    if state is None and STATE_STORE is not None:
+        state = STATE_STORE.get_user(user_id)
+        if state is not None:
+            adopt_user_state(user_id, state)
+            count("domain_user_rehydrations_total", ())
+    elif state is None and (SPILL_DB is not None or os.path.exists(SPILL_FILE)):
+        row = spill_db().execute("SELECT state FROM user_states WHERE user_id = ?", (json.dumps(user_id),)).fetchone()
+        if row is not None:
+            state = json.loads(row[0])
+            adopt_user_state(user_id, state)
+            count("domain_user_rehydrations_total", ())
+    if state is None and create:
+        state = USER_STATES[user_id] = new_user_state()
+    if state is not None:
+        touch_user(user_id)
+    return state
+
+# HELPER: Drop every user, in memory and on disk
+def forget_users():
+    USER_STATES.clear()
+    LAST_SEEN.clear()
+    ROOM_OCCUPANTS.clear()
+    if STATE_STORE is not None:
+        STATE_STORE.clear_users()
+    elif SPILL_DB is not None or os.path.exists(SPILL_FILE):
+        spill_db().execute("DELETE FROM user_states")
+        spill_db().commit()
+
+# Evict idle users every so often (LAST_SEEN keeps them at the front, so this never scans active ones)
+async def evict_idle_users():
+    while True:
+        await asyncio.sleep(min(60, USER_TTL / 4))
+        evict_users()
+
+async def start_evictor(app):
+    app.evictor = asyncio.create_task(evict_idle_users())
+
+async def stop_evictor(app):
+    app.evictor.cancel()
+    if SPILL_DB is not None:
+        SPILL_DB.close()
+
 # HELPER: Initialize the item location
 async def register_item(app, user_id, item_name, location):
     target_id = NAME_2_ID.get(item_name, None)
@@ -128,6 +353,42 @@ async def register_item(app, user_id, item_name, location):
         if not found_locations:
             await hub_transfer(app, user_id, target_id, location)
 
+# HELPER: Extra arguments for app.client.post that forward the remaining deadline (raises once it is spent)
+def budget():
+    deadline = DEADLINE.get()
+    if deadline is None:
+        return {}
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise asyncio.TimeoutError("deadline exceeded before calling the hub")
+    from aiohttp import ClientTimeout
+    return {"headers": {DEADLINE_HEADER: str(int(left*1000))}, "timeout": ClientTimeout(total=min(3, left))}
+
+# HELPER: The key session tokens are signed with, derived from the domain secret
+def token_key(secret):
+    return hmac.new(secret.encode(), b"mini-zork session token", hashlib.sha256).digest()
+
+# HELPER: Whether token is an unexpired session token the hub issued for this user in this domain
+def verify_token(token, user_id):
+    if TOKEN_KEY is None or not isinstance(token, str) or token.count(".") != 3:
+        return False
+    body, sig = token.rsplit(".", 1)
+    tuid, tdid, expires = body.split(".")
+    try:
+        if tuid != str(user_id) or int(tdid) != DOMAIN_ID or int(expires) < time.time():
+            return False
+    except ValueError:
+        return False
+    expected = base64.urlsafe_b64encode(hmac.new(TOKEN_KEY, body.encode(), hashlib.sha256).digest()).rstrip(b"=").decode()
+    return hmac.compare_digest(sig, expected)
+
+# HELPER: Returns an error response unless the request carries the admin bearer token
+def check_admin(req):
+    given = req.headers.get("Authorization", "")
+    if ADMIN_TOKEN is None or not hmac.compare_digest(given, "Bearer " + ADMIN_TOKEN):
+        return json_response(status=401, data={"error": "Admin token required"}, headers={"WWW-Authenticate": "Bearer"})
+    return None
+
 # HELPER: Update the location of an item
 async def hub_transfer(app, user_id, item_id, to):
     async with app.client.post(HUB_URL+'/transfer', json={
@@ -136,7 +397,10 @@ async def hub_transfer(app, user_id, item_id, to):
         "user": user_id,
         "item": item_id,
         "to": to
-    }) as resp:
+    }, **budget()) as resp:
+        cache = QUERY_CACHE.get()
+        if cache is not None:
+            cache.clear()
         return await resp.json()
 
 # HELPER: List the items in the given location / depth
@@ -151,11 +415,24 @@ async def hub_query(app, user_id, location=None, depth=None):
     else:
         data["depth"] = depth
 
-    async with app.client.post(HUB_URL+'/query', json=data) as resp:
-        return await resp.json()
+    cache = QUERY_CACHE.get()
+    key = (user_id, location, depth)
+    if cache is not None and key in cache:
+        return cache[key]
+    async with app.client.post(HUB_URL+'/query', json=data, **budget()) as resp:
+        ids = await resp.json()
+    if cache is not None and resp.ok:
+        cache[key] = ids
+    return ids
 
 
 
+# HELPER: A response for a command that did nothing, so a macro stops there
+def refuse(text):
+    resp = web.Response(text=text)
+    resp["failed"] = True
+    return resp
+
 # HELPER: Return the discription given the state of the parchment
 def look_skeleton(parchment_state):
     if parchment_state == 'unmoved':
@@ -212,7 +489,57 @@ def location_description(loc):
             return "Gentle moonlight streamed through the floor-to-ceiling windows, casting its glow on something in front of it, while the rest of the room was completely empty, spider webs are everywhere."
     else:
         return ""
-    
+
+
+
+# The room graph: room -> {direction: (next room, guard)}, where the guard names what must hold to pass that way
+ROOM_EXITS = {
+    "lobby": {"north": ("sealed-chamber", "lock"), "west": ("hallway", None)},
+    "hallway": {"east": ("lobby", None), "west": ("forbidden-library", "altar")},
+    "forbidden-library": {"east": ("hallway", "torch")},
+    "sealed-chamber": {"south": ("lobby", None)},
+}
+
+# Edge predicates: guard -> (user_state, torch location) -> the obstacle in the way, or None if the user may pass
+EXIT_GUARDS = {
+    "lock": lambda state, torch: None if state["lock_state"] == "open" else "the colossal lock on the stone gate north of the lobby",
+    "altar": lambda state, torch: (
+        "the sealed way behind the altar" if state["altar_state"] != "open" else
+        None if torch == "inventory" and state["torch_state"] == "light" else
+        "the darkness down the stairs, you need a lit torch with you"
+    ),
+    "torch": lambda state, torch: None if torch == "inventory" else "the spiral stairs, you'd better pick up the torch first",
+}
+
+# HELPER: Return the shortest route (a list of directions) between every pair of rooms, found by BFS over ROOM_EXITS
+def shortest_routes():
+    routes_found = {}
+    for start in ROOM_EXITS:
+        paths = {start: []}
+        queue = collections.deque([start])
+        while queue:
+            room = queue.popleft()
+            for direction, (next_room, guard) in ROOM_EXITS[room].items():
+                if next_room not in paths:
+                    paths[next_room] = paths[room] + [direction]
+                    queue.append(next_room)
+        for end, path in paths.items():
+            routes_found[(start, end)] = path
+    return routes_found
+
+# Precomputed once at startup, the room graph never changes
+ROOM_ROUTES = shortest_routes()
+
+# HELPER: Return the room named by the words of a [go to room] command, or None if they name a direction
+def travel_target(words):
+    name = "-".join(w for w in words if w != "to")
+    if not name:
+        return None
+    for room in ROOM_EXITS:
+        if room == name or room.endswith("-" + name):
+            return room
+    return None
+
 # HELPER: Return the discription for the item <- command [read item]
 def item_description(item_id):
     return ID_2_ITEM[item_id].get("description", "")
@@ -224,30 +551,40 @@ def item_action(item_id, verb):
 
 
 
-# HELPER: Return the tiple of (found, item_id, current_location)
-async def find_item_in_domain(app, user_id, name_or_id):
-    # Initialization
-    global DOMAIN_LOCS
-    item_id = None
-    
-    # Get the asking item id
+# HELPER: Return the list of (item_id, location) for the user's items in places named by an id, a name or the start of one
+async def locate_items(app, user_id, name_or_id, places):
     try:
-        item_id = int(name_or_id)
+        wanted = {int(name_or_id)}
     except:
-        item_id = NAME_2_ID.get(name_or_id, None)
-        if not item_id:
-            return False, None, None
-        else:
-            item_id = int(item_id)
-    
-    # Check every location
-    for loc in DOMAIN_LOCS.keys():
-        existing_ids = await hub_query(app, user_id, location=loc)
-        if item_id in existing_ids:
-            return True, item_id, loc
+        wanted = ITEM_NAMES.lookup(name_or_id)
+    found = []
+    if wanted:
+        for loc in places:
+            found += [(item_id, loc) for item_id in await hub_query(app, user_id, location=loc) if item_id in wanted]
+    return found
 
-    # Not found
-    return False, None, None
+# HELPER: Return the tiple of (found, item_id, current_location)
+async def find_item_in_domain(app, user_id, name_or_id):
+    found = await locate_items(app, user_id, name_or_id, DOMAIN_LOCS.keys())
+    if not found:
+        return False, None, None
+    return True, found[0][0], found[0][1]
+
+# HELPER: Return (item_id, location) of the one item in places the user's words name, or a response saying why there is none
+async def resolve_item(app, user_id, verb, name_or_id, places, missing):
+    found = await locate_items(app, user_id, name_or_id, places)
+    if not found:
+        return refuse(missing)
+    if len(found) > 1:
+        return ambiguous(verb, name_or_id, found)
+    return found[0]
+
+# HELPER: A response listing the items the user's words could mean, as commands naming each one by id
+def ambiguous(verb, name_or_id, found):
+    return refuse(f"There is more than one {html.escape(str(name_or_id))} around: please disambiguate which one you mean by using one of the following:<ul>"
+        + "".join(f"<li><code>{verb} {item_id}</code> for the {ID_2_ITEM[item_id]['name']} <sub>{item_id}</sub>"
+                  + (" you carry" if loc == "inventory" else "") + "</li>" for item_id, loc in found)
+        + "</ul>")
 
 # HELPER: Return the list of items in a location
 async def list_items_in_location(app, user_id, loc):
@@ -266,23 +603,28 @@ async def list_items_in_location(app, user_id, loc):
 @routes.post('/newhub')
 async def hub_handler(req: Request) -> Response:
     # Initialization
-    global HUB_URL, DOMAIN_ID, DOMAIN_SECRET, DOMAIN_ITEMS
+    global HUB_URL, DOMAIN_ID, DOMAIN_SECRET, DOMAIN_ITEMS, TOKEN_KEY
     text = await req.text()
     HUB_URL = text.strip()
 
     # Get register authentication from the hub (hub -> json)
+    # A hub reached over a Unix socket is on this host, so it can call us back over ours too
+    peer = {'peer': "unix:" + UNIX_PATH} if HUB_URL.startswith("unix:") and UNIX_PATH else {}
     async with req.app.client.post(HUB_URL + '/register', json={
         'url': whoami,
         'name': "Final Project",
         'description': "An example domain based in a magic ruin.",
         'items': DOMAIN_ITEMS,
-    }) as resp:
+    } | peer) as resp:
         data = await resp.json()
         if 'error' in data:
             return json_response(status=resp.status, data=data)
     
     DOMAIN_ID = data['id']
     DOMAIN_SECRET = data['secret']
+    TOKEN_KEY = token_key(DOMAIN_SECRET)
+    # Users kept from an earlier registration were numbered by that hub, so they would be mistaken for this one's
+    forget_users()
     assigned_item_ids = data['items']
     
     # Store the domain items in global data structures
@@ -301,111 +643,174 @@ async def hub_handler(req: Request) -> Response:
         # HELPER DATA
         ID_2_ITEM[item_id] = item_info
         NAME_2_ID[item["name"]] = item_id
+        ITEM_NAMES.add(item["name"], item_id)
     
     return json_response({"ok":"Domain registered."})
 
 @routes.post('/arrive')
 async def arrive_handler(req: Request) -> Response:
-    # Initialization
-    global ARRIVAL_COUNTER
     data = await req.json()
-    app = req.app
+    # The hub's bulk provisioning sends {"users": [an /arrive body per user]}, each handled as its own /arrive
+    if "users" in data:
+        gate = asyncio.Semaphore(ARRIVE_CONCURRENCY)
+        async def arrive_one(body):
+            async with gate:
+                await arrive_user(req.app, body)
+        await asyncio.gather(*(arrive_one(body) for body in data["users"]))
+        return web.Response(status=200)
+    await arrive_user(req.app, data)
+    return web.Response(status=200)
+
+# HELPER: Mark the user in one /arrive body as arrived and put the items it brings in place
+async def arrive_user(app, data):
+    # Initialization
     user_id = data['user']
     arrive_from = data.get('from','login')
-
-    # Initialize domain states for a fresh start each arrive
-    if user_id not in USER_STATES:
-        USER_STATES[user_id] = new_user_state()
-    user_state = USER_STATES[user_id]
-
-    # Mark arrived
-    user_state["arrived"] = True
-    user_state["from"] = arrive_from
-    ARRIVAL_COUNTER += 1
-    user_state["arrive_time"] = ARRIVAL_COUNTER
+    async with user_lock(user_id):
+        # Initialize domain states for a fresh start each arrive
+        user_state = load_user_state(user_id, create=True)
+
+        # Mark arrived
+        user_state["arrived"] = True
+        place_user(user_id, user_state["loc"], user_state["loc"])
+        user_state["from"] = arrive_from
+        # Arrivals and departures are numbered per user, one past their latest, so the order holds on any worker
+        user_state["arrive_time"] = max(user_state["arrive_time"], user_state["depart_time"]) + 1
     
-    # Handle dropped items
-    for item in data.get('dropped', []):
-        item_id = item['id']
-        if item_id not in ID_2_ITEM:
-            info = {k:v for k,v in item.items() if k in ('name','description','verb','depth')}
-            ID_2_ITEM[item_id] = info
-            NAME_2_ID[info['name']] = item_id
-
-        # Transfer the item to its original location (hub)
-        pass
-
-    # Handle prize items
-    for item in data.get('prize',[]):
-        item_id = item['id']
-        if item_id not in ID_2_ITEM:
-            info = {k:v for k,v in item.items() if k in ('name','description','verb','depth')}
-            ID_2_ITEM[item_id] = info
-            NAME_2_ID[info['name']] = item_id
+        # Handle dropped items
+        for item in data.get('dropped', []):
+            item_id = item['id']
+            if item_id not in ID_2_ITEM:
+                info = {k:v for k,v in item.items() if k in ('name','description','verb','depth')}
+                ID_2_ITEM[item_id] = info
+                ITEM_NAMES.add(info['name'], item_id)
+
+            # Transfer the item to its original location (hub)
+            pass
+
+        # Handle prize items
+        for item in data.get('prize',[]):
+            item_id = item['id']
+            if item_id not in ID_2_ITEM:
+                info = {k:v for k,v in item.items() if k in ('name','description','verb','depth')}
+                ID_2_ITEM[item_id] = info
+                ITEM_NAMES.add(info['name'], item_id)
         
-        # Transfer the item to its original location (domain)
-        item_depth = item.get('depth', 0)
-        if item_depth == 0:
-            await hub_transfer(app, user_id, item_id, "hallway")
-        elif item_depth == 1:
-            await hub_transfer(app, user_id, item_id, "forbidden-library")
-        elif item_depth == 2:
-            await hub_transfer(app, user_id, item_id, "sealed-chamber")
-
-    # register the 2 no-depth item ('parchment', 'torch')
-    await register_item(app, user_id, "parchment", "lobby")
-    await register_item(app, user_id, "torch", "hallway")
-
-    return web.Response(status=200)
+            # Transfer the item to its original location (domain)
+            item_depth = item.get('depth', 0)
+            if item_depth == 0:
+                await hub_transfer(app, user_id, item_id, "hallway")
+            elif item_depth == 1:
+                await hub_transfer(app, user_id, item_id, "forbidden-library")
+            elif item_depth == 2:
+                await hub_transfer(app, user_id, item_id, "sealed-chamber")
+
+        # register the 2 no-depth item ('parchment', 'torch')
+        await register_item(app, user_id, "parchment", "lobby")
+        await register_item(app, user_id, "torch", "hallway")
 
 @routes.post('/depart')
 async def depart_handler(req: Request) -> Response:
-    global DEPARTURE_COUNTER
     data = await req.json()
     user_id = data['user']
-    # Mark user as departed
-    if user_id not in USER_STATES:
+    async with user_lock(user_id):
+        # Mark user as departed
         # If we never saw this user, just do nothing special
-        USER_STATES[user_id] = new_user_state()
-    user_state = USER_STATES[user_id]
-    DEPARTURE_COUNTER += 1
-    user_state["depart_time"] = DEPARTURE_COUNTER
-    user_state["arrived"] = False
+        user_state = load_user_state(user_id, create=True)
+        user_state["depart_time"] = max(user_state["arrive_time"], user_state["depart_time"]) + 1
+        user_state["arrived"] = False
+        place_user(user_id, user_state["loc"], None)
 
-    return web.Response(status=200)
+        return web.Response(status=200)
 
 @routes.post('/dropped')
 async def dropped_handler(req: Request) -> Response:
     data = await req.json()
     user_id = data['user']
-    user_state = USER_STATES.get(user_id, new_user_state())
+    user_state = load_user_state(user_id) or new_user_state()
     return json_response(user_state["loc"])
 
+# Up to 20 names of the user's items here or in their backpack starting with "prefix", for the front-end to suggest
+@routes.post("/complete")
+async def complete_handler(req : Request) -> Response:
+    data = await req.json()
+    user_id = data['user']
+    if ("token" in data or REQUIRE_TOKEN) and not verify_token(data.get("token"), user_id):
+        return web.Response(status=403, text="Your session is not valid here; please log in again.")
+    prefix = data.get("prefix", "")
+    if not isinstance(prefix, str):
+        return web.Response(status=400, text="prefix must be a string")
+    user_state = load_user_state(user_id)
+    if not user_state or not user_state["arrived"]:
+        return json_response([])
+
+    QUERY_CACHE.set({})
+    at_hand = set()
+    for loc in (user_state["loc"], "inventory"):
+        at_hand.update(await hub_query(req.app, user_id, location=loc))
+    return json_response([name for name in ITEM_NAMES.complete(prefix) if ITEM_NAMES.ids[name] & at_hand][:20])
+
 @routes.post("/command")
 async def command_handler(req : Request) -> Response:
     # Initialization
     data = await req.json()
     app = req.app
     user_id = data['user']
-    user_state = USER_STATES.get(user_id, None)
-    
-    # user not arrived yet
-    if not user_state:
-        return web.Response(text="You have to journey to this domain before you can send it commands.")
-    # If user departed more recently than arrived, return 409
-    if user_state["depart_time"] > user_state["arrive_time"]:
-        return web.Response(status=409, text="You have departed this domain. You must arrive again before issuing commands.")
-    # user not arrived yet
-    if not user_state["arrived"]:
-        return web.Response(text="You have to journey to this domain before you can send it commands.")
-
-    cmd = data['command']
+
+    # user claims to be someone they cannot prove to be
+    if ("token" in data or REQUIRE_TOKEN) and not verify_token(data.get("token"), user_id):
+        return web.Response(status=403, text="Your session is not valid here; please log in again.")
+    # A macro: {"commands": [[...], ...]} runs each in turn, stopping at the first failure or journey
+    cmds = data.get("commands")
+    if "commands" in data:
+        most = min(LIMITS["batch"], int(LIMITS["burst"]))     # a bigger batch could never be paid for
+        if not isinstance(cmds, list) or not 0 < len(cmds) <= most:
+            return web.Response(status=400, text=f"Send a list of 1 to {most} commands.")
+    # user sending commands too quickly (checked before queueing, so a flood cannot pile up behind the user's lock);
+    # a macro costs one token per command in it
+    wait = take_token(user_id, len(cmds) if "commands" in data else 1)
+    if wait:
+        return too_many(wait, "You are acting too quickly; slow down.")
+
+    # Commands for one user run in order, with /arrive and /depart for them serialized alongside
+    async with user_lock(user_id):
+        user_state = load_user_state(user_id)
+
+        # user not arrived yet
+        if not user_state:
+            return web.Response(text="You have to journey to this domain before you can send it commands.")
+        # If user departed more recently than arrived, return 409
+        if user_state["depart_time"] > user_state["arrive_time"]:
+            return web.Response(status=409, text="You have departed this domain. You must arrive again before issuing commands.")
+        # user not arrived yet
+        if not user_state["arrived"]:
+            return web.Response(text="You have to journey to this domain before you can send it commands.")
+
+        # Hub query results are reused until something is transferred
+        QUERY_CACHE.set({})
+
+        if "commands" in data:
+            req["verb"] = "batch"
+            results = []
+            for cmd in cmds:
+                resp = await run_command(app, user_id, user_state, cmd)
+                results.append({"status": resp.status, "text": resp.text})
+                if resp.get("failed") or resp.status >= 400 or resp.text.startswith("$journey"):
+                    break
+            return json_response(results)
+
+        cmd = data['command']
+        req["verb"] = cmd[0] if isinstance(cmd, list) and cmd and cmd[0] in DOMAIN_VERBS else "other"
+        return await run_command(app, user_id, user_state, cmd)
+
+# HELPER: Carry out one command for an arrived user
+async def run_command(app, user_id, user_state, cmd):
     # Invalid command
     if not isinstance(cmd, list) or not all(isinstance(x,str) for x in cmd):
-        return web.Response(text="I don't know how to do that.")
+        return refuse("I don't know how to do that.")
     # Void Command
     if len(cmd) == 0:
-        return web.Response(text="I don't know how to do that.")
+        return refuse("I don't know how to do that.")
 
     # Split the command into [VERB ARGS]
     verb = cmd[0]
@@ -429,26 +834,27 @@ async def command_handler(req : Request) -> Response:
             items_here = await list_items_in_location(app, user_id, USER_LOC)
             for (item_name, item_id) in items_here:
                 desc += f"\nThere is a {item_name} <sub>{item_id}</sub> here."
+
+            # Other players in the room
+            others = room_occupants(USER_LOC) - {user_id}
+            if others:
+                shown = ", ".join(f"user #{uid}" for uid in sorted(others, key=str)[:5])
+                if len(others) > 5:
+                    shown += f" and {len(others) - 5} others"
+                desc += f"\nAlso here: {shown}."
             return web.Response(text=desc)
         
         # command: [look item]
         elif len(args) == 1:
             item_name = args[-1]
-            found, item_id, where = await find_item_in_domain(app, user_id, item_name)
-            
-            # Named item not found
-            if not found:
-                return web.Response(text=f"There is no such thing called a {item_name} in this room.")
-            # Sccessful case
-            elif USER_LOC == where or "inventory" == where:
-                return web.Response(text=item_description(item_id))
-            # Other Invalid cases
-            else:
-                return web.Response(text="I don't know how to do that.")
+            item = await resolve_item(app, user_id, "look", item_name, [USER_LOC, "inventory"], f"There is no such thing called a {item_name} in this room.")
+            if isinstance(item, Response):
+                return item
+            return web.Response(text=item_description(item[0]))
         
         # command: <invalid>
         else:
-            return web.Response(text="I don't know how to do that.")
+            return refuse("I don't know how to do that.")
 
     async def do_take():
         # Initialization
@@ -457,45 +863,39 @@ async def command_handler(req : Request) -> Response:
         # command [take item]
         if len(args) == 1:
             name_or_id = args[-1]
-            try:
-                item_id = int(name_or_id)
-                item_info = ID_2_ITEM.get(item_id, None)
-                if not item_info:
-                    return web.Response(text=f"There's no such thing here to take in this room")
-                else:
-                    item_name = str(item_info['name'])
-            except:
-                item_name = str(name_or_id)
-            found, iid, where = await find_item_in_domain(app, user_id, item_name)
+            # Items in the room are what can be taken; the same name in the backpack only matters if none are
+            found = await locate_items(app, user_id, name_or_id, [USER_LOC])
             
-            # Named item not found
+            # Named item not here
             if not found:
-                return web.Response(text=f"There's no such thing here to take in this room")
-            # Named item already taken
-            elif where == 'inventory':
-                return web.Response(text="You've already picked that, it's in your backpack!")
+                if await locate_items(app, user_id, name_or_id, ["inventory"]):
+                    return refuse("You've already picked that, it's in your backpack!")
+                return refuse(f"There's no such thing here to take in this room")
+            # More than one item here by that name
+            elif len(found) > 1:
+                return ambiguous("take", name_or_id, found)
             # Successful case
-            elif USER_LOC == where:
+            else:
+                iid = found[0][0]
+                item_name = ID_2_ITEM[iid]["name"]
                 res = await hub_transfer(app, user_id, iid, "inventory")
                 if "error" in res:
-                    return web.Response(text=f"There is something wrong when picking {item_name}")
+                    return refuse(f"There is something wrong when picking {item_name}")
                 else:
                     if item_name == 'parchment':
                         user_state['parchment_state'] = 'moved'
                     return web.Response(text=f"You take the {item_name}.")
-            else:
-                return web.Response(text=f"There's no such thing here to take in this room")
                 
         # command: <invalid>
         else:
-            return web.Response(text="I don't know how to do that.")
+            return refuse("I don't know how to do that.")
 
     async def do_go():
         # Initialization
         nonlocal args, user_state, USER_LOC
         global DOMAIN_LOCS
         if len(args) == 0:
-            return web.Response(text="Please spesify the direction.")
+            return refuse("Please spesify the direction.")
         direction = args[-1]
 
         # from lobby
@@ -505,6 +905,7 @@ async def command_handler(req : Request) -> Response:
                 if user_state['lock_state'] == 'open':
                     # change player location
                     USER_LOC = "sealed-chamber"
+                    place_user(user_id, user_state["loc"], USER_LOC)
                     user_state["loc"] = USER_LOC
                     # return the discription
                     saved_args = args
@@ -519,11 +920,11 @@ async def command_handler(req : Request) -> Response:
                         "secret": DOMAIN_SECRET, 
                         "user": user_id,   
                         "score": congrats(DOMAIN_LOCS["sealed-chamber"], DOMAIN_LOCS["forbidden-library"])[0]
-                    }) as sc:
+                    }, **budget()) as sc:
                         await sc.json()
                 else:
-                    resp = web.Response(
-                        text="A massive stone gate stood imposingly, draped with numerous thick iron chains. These chains were tightly bound together by a colossal lock, as if sealing away the treasures (and ghosts) hidden behind it."
+                    resp = refuse(
+                        "A massive stone gate stood imposingly, draped with numerous thick iron chains. These chains were tightly bound together by a colossal lock, as if sealing away the treasures (and ghosts) hidden behind it."
                     )
                 return resp
             # South -> skeletons
@@ -534,6 +935,7 @@ async def command_handler(req : Request) -> Response:
             elif direction == 'west':
                 # change player location
                 USER_LOC = "hallway"
+                place_user(user_id, user_state["loc"], USER_LOC)
                 user_state["loc"] = USER_LOC
                 # return the discription
                 saved_args = args
@@ -548,7 +950,7 @@ async def command_handler(req : Request) -> Response:
                 return web.Response(text="$journey east")
             # Other directions
             else:
-                return web.Response(text="Not a valid direction")
+                return refuse("Not a valid direction")
             
         # from hallway
         elif USER_LOC == "hallway":
@@ -557,6 +959,7 @@ async def command_handler(req : Request) -> Response:
                 # change player location
                 DOMAIN_LOCS['lobby'] = True
                 USER_LOC = "lobby"
+                place_user(user_id, user_state["loc"], USER_LOC)
                 user_state["loc"] = USER_LOC
                 # return the discription
                 saved_args = args
@@ -571,6 +974,7 @@ async def command_handler(req : Request) -> Response:
                 if user_state['altar_state'] == 'open' and where == 'inventory' and user_state['torch_state'] == 'light':
                     # change player location
                     USER_LOC = "forbidden-library"
+                    place_user(user_id, user_state["loc"], USER_LOC)
                     user_state["loc"] = USER_LOC
                     # return the discription
                     saved_args = args
@@ -585,19 +989,19 @@ async def command_handler(req : Request) -> Response:
                         "secret": DOMAIN_SECRET, 
                         "user": user_id,   
                         "score": congrats(DOMAIN_LOCS["sealed-chamber"], DOMAIN_LOCS["forbidden-library"])[0]
-                    }) as sc:
+                    }, **budget()) as sc:
                         await sc.json()
                     return resp
                 elif user_state['altar_state'] == 'locked':
-                    return web.Response(text="Hmm... maybe there is some mechanism at the altar to open the way infront...")
+                    return refuse("Hmm... maybe there is some mechanism at the altar to open the way infront...")
                 elif user_state['altar_state'] == 'open' and (where != 'inventory' or user_state['torch_state'] != 'light'):
-                    return web.Response(text="It's too dark inside! You refuse to move forward...")
+                    return refuse("It's too dark inside! You refuse to move forward...")
                 else:
-                    return web.Response(text="Hmm... maybe there is some mechanism at the altar to open the way infront...")
+                    return refuse("Hmm... maybe there is some mechanism at the altar to open the way infront...")
             
             # Other directions
             else:
-                return web.Response(text="Just a old boring brick wall...")
+                return refuse("Just a old boring brick wall...")
 
         # from forbidden-library
         elif USER_LOC == "forbidden-library":
@@ -605,10 +1009,11 @@ async def command_handler(req : Request) -> Response:
             if direction == 'east' or direction == 'up':
                 found, item_id, where = await find_item_in_domain(app, user_id, 'torch')
                 if where != 'inventory':
-                    return web.Response(text="In case falling down from the spirwal staris, I'd better pick up the torch...")
+                    return refuse("In case falling down from the spirwal staris, I'd better pick up the torch...")
                 else:
                     # change player location
                     USER_LOC = "hallway"
+                    place_user(user_id, user_state["loc"], USER_LOC)
                     user_state["loc"] = USER_LOC
                     # return the discription
                     saved_args = args
@@ -619,7 +1024,7 @@ async def command_handler(req : Request) -> Response:
             
             # Other directions
             else:
-                return web.Response(text="You are blocked with mountians of books...")
+                return refuse("You are blocked with mountians of books...")
         
         # from sealed-chamber
         elif USER_LOC == 'sealed-chamber':
@@ -627,6 +1032,7 @@ async def command_handler(req : Request) -> Response:
             if direction == 'south':
                 # change player location
                 USER_LOC = "lobby"
+                place_user(user_id, user_state["loc"], USER_LOC)
                 user_state["loc"] = USER_LOC
                 # return the discription
                 saved_args = args
@@ -641,57 +1047,95 @@ async def command_handler(req : Request) -> Response:
             
             # Other directions
             else:
-                return web.Response(text="There is nothing here.")
+                return refuse("There is nothing here.")
                 
         else:
-            return web.Response(text="You can't go that way from here.")
+            return refuse("You can't go that way from here.")
+
+    async def do_travel(target):
+        # Initialization
+        nonlocal args, user_state, USER_LOC
+        if target == USER_LOC:
+            return refuse("You're already there.")
+        route = ROOM_ROUTES.get((USER_LOC, target), None)
+        if route is None:
+            return refuse("You can't find a way there from here.")
+
+        # Check every guard along the route before taking the first step
+        room, torch_where = USER_LOC, None
+        for direction in route:
+            next_room, guard = ROOM_EXITS[room][direction]
+            if guard is not None:
+                if guard in ("altar", "torch") and torch_where is None:
+                    found, iid, torch_where = await find_item_in_domain(app, user_id, 'torch')
+                obstacle = EXIT_GUARDS[guard](user_state, torch_where)
+                if obstacle is not None:
+                    return refuse(f"You can't get to the {target}, the way is blocked by {obstacle}.")
+            room = next_room
+
+        # Walk the route one step at a time, collecting the descriptions
+        saved_args = args
+        texts = []
+        for direction in route:
+            args = [direction]
+            resp = await do_go()
+            texts.append(resp.text)
+            if resp.get("failed"):
+                break
+        args = saved_args
+        combined = web.Response(text="\n\n".join(texts))
+        if resp.get("failed"):
+            combined["failed"] = True
+        return combined
 
     async def do_read():
         # Initialization
         nonlocal args, user_state, USER_LOC
         if len(args) == 0:
-            return web.Response(text="Please spesify the item to read.")
+            return refuse("Please spesify the item to read.")
         target = args[-1]
         
-        # Check the location of the item to read
-        found, iid, where = await find_item_in_domain(app, user_id, target)
-        if not found:
-            return web.Response(text="I don't know how to do that.")
+        # The item to read must be here or carried
+        item = await resolve_item(app, user_id, "read", target, [USER_LOC, "inventory"], "I don't know how to do that.")
+        if isinstance(item, Response):
+            return item
         
-        # Check if user location is valid
-        vr = item_action(iid, "read")
+        vr = item_action(item[0], "read")
         if vr is not None:
-            if where == 'inventory' or where == USER_LOC:
-                return web.Response(text=vr)
-            else:
-                return web.Response(text="I don't know how to do that.")
-        return web.Response(text="I don't know how to do that.")
+            return web.Response(text=vr)
+        return refuse("I don't know how to do that.")
 
     async def do_use():
         # Initialization
         nonlocal args, user_state, USER_LOC
         global DOMAIN_ITS
         if len(args) == 0:
-            return web.Response(text="Please specify what item to use and on which object to apply it.")
+            return refuse("Please specify what item to use and on which object to apply it.")
         item_name = args[0]
+        # An id or the start of a name of something at hand stands for its name; other words are taken as typed
+        at_hand = await locate_items(app, user_id, item_name, [USER_LOC, "inventory"])
+        if len({ID_2_ITEM[iid]["name"] for iid, _ in at_hand}) > 1:
+            return ambiguous("use", item_name, at_hand)
+        if at_hand:
+            item_name = ID_2_ITEM[at_hand[0][0]]["name"]
         
         # Use [dagger]
         if item_name == "dagger":
             found, item_id, where = await find_item_in_domain(app, user_id, item_name)
             if not found:
-                return web.Response(text=f"I don't have {item_name}")
+                return refuse(f"I don't have {item_name}")
             else:
                 if where != 'inventory' and where != USER_LOC:
-                    return web.Response(text=f"I don't have {item_name} with me.")
+                    return refuse(f"I don't have {item_name} with me.")
                     
             # No objective to apply
             if len(args) < 2:
-                return web.Response(text="I don't know how to do that.")
+                return refuse("I don't know how to do that.")
             
             # use [dagger] on [altar]
             if "altar" in args and USER_LOC == 'hallway':
                 if DOMAIN_ITS['dagger']:
-                    return web.Response(text="I do not want to scratch myself anymore...")
+                    return refuse("I do not want to scratch myself anymore...")
                 
                 DOMAIN_ITS['dagger'] = True
                 user_state['altar_state'] = 'open'
@@ -700,28 +1144,28 @@ async def command_handler(req : Request) -> Response:
                     
             # use [dagger] on [altar]
             elif "altar" in args and USER_LOC != 'hallway':
-                return web.Response(text="Maybe try somewhere else...")
+                return refuse("Maybe try somewhere else...")
             # use [dagger] ...
             else:
-                return web.Response(text="I don't see the reason to do that...")
+                return refuse("I don't see the reason to do that...")
         
         # Use [sword-of-gryffindor]
         elif item_name == "sword-of-gryffindor":
             found, item_id, where = await find_item_in_domain(app, user_id, item_name)
             if not found:
-                return web.Response(text=f"I don't have {item_name}")
+                return refuse(f"I don't have {item_name}")
             else:
                 if where != 'inventory' and where != USER_LOC:
-                    return web.Response(text=f"I don't have {item_name} with me.")
+                    return refuse(f"I don't have {item_name} with me.")
                 
             # No objective to apply
             if len(args) < 2:
-                return web.Response(text="I don't know how to do that.")
+                return refuse("I don't know how to do that.")
             
             # use [sword-of-gryffindor] on [lock]
             if "lock" in args and USER_LOC == 'lobby':
                 if DOMAIN_ITS['sword-of-gryffindor']:
-                    return web.Response(text="You feel that the magic within your body is insufficient to wield it once more...")
+                    return refuse("You feel that the magic within your body is insufficient to wield it once more...")
                 
                 DOMAIN_ITS['sword-of-gryffindor'] = True
                 user_state['lock_state'] = 'open'
@@ -730,10 +1174,10 @@ async def command_handler(req : Request) -> Response:
                 return web.Response(text=result)
             # use [sword-of-gryffindor] on [lock]  
             elif "lock" in args and USER_LOC != 'lobby':
-                return web.Response(text="Maybe try somewhere else...")
+                return refuse("Maybe try somewhere else...")
             # use [sword-of-gryffindor] ...
             else:
-                return web.Response(text="I don't see the reason to do that...")
+                return refuse("I don't see the reason to do that...")
         
         # Use [torch]
         elif item_name == "torch":
@@ -742,7 +1186,7 @@ async def command_handler(req : Request) -> Response:
             # use [torch]
             if where == USER_LOC or where == 'inventory':
                 if DOMAIN_ITS['torch']:
-                    return web.Response(text="The torch is bright enough...")
+                    return refuse("The torch is bright enough...")
                 
                 DOMAIN_ITS['torch'] = True
                 user_state['torch_state'] = 'light'
@@ -752,44 +1196,57 @@ async def command_handler(req : Request) -> Response:
                 
             else:
                 if where != 'inventory' and where != USER_LOC:
-                    return web.Response(text=f"I don't have {item_name} with me.")
+                    return refuse(f"I don't have {item_name} with me.")
                 
         # Use [parchment]
         elif item_name == "parchment":
             found, item_id, where = await find_item_in_domain(app, user_id, item_name)
             if not found:
-                return web.Response(text=f"I don't have {item_name}")
+                return refuse(f"I don't have {item_name}")
             else:
                 if where != 'inventory' and where != USER_LOC:
-                    return web.Response(text=f"I don't have {item_name} with me.")
+                    return refuse(f"I don't have {item_name} with me.")
             
-            return web.Response(text="I don't see though anyway I can USE it, may be just read it...")
+            return refuse("I don't see though anyway I can USE it, may be just read it...")
 
         # Use other items
         else:
-            return web.Response(text="Maybe try it somewhere else other than this domain...")
+            return refuse("Maybe try it somewhere else other than this domain...")
 
     
     
-    # Handle special look verbs for skeleton/altar/lock
+    async def do_say():
+        # Initialization
+        nonlocal args, user_state, USER_LOC
+        if len(args) == 0:
+            return refuse("What do you want to say?")
+        words = html.escape(" ".join(args))
+
+        # Everyone else in the room with a /listen socket open hears it
+        heard = await broadcast(app, USER_LOC, user_id, f"User #{user_id} says: {words}")
+        if heard == 0:
+            return web.Response(text=f"You say: {words}\nNobody seems to be listening...")
+        return web.Response(text=f"You say: {words}")
+
+        # Handle special look verbs for skeleton/altar/lock
     if verb == "look" and len(args)==1:
         if args[0] == "skeleton":
             if USER_LOC == "lobby":
                 return web.Response(text=look_skeleton(user_state['parchment_state']))
             else:
-                return web.Response(text="I do not find any...")
+                return refuse("I do not find any...")
             
         elif args[0] == "altar":
             if USER_LOC == "hallway":
                 return web.Response(text=look_altar(user_state['altar_state']))
             else:
-                return web.Response(text="I do not find any...")
+                return refuse("I do not find any...")
             
         elif args[0] == "lock":
             if USER_LOC == "lobby":
                 return web.Response(text=look_lock(user_state['lock_state']))
             else:
-                return web.Response(text="I do not find any...")
+                return refuse("I do not find any...")
 
     # Dispatch commands
     if verb == "look":
@@ -798,12 +1255,16 @@ async def command_handler(req : Request) -> Response:
         resp = await do_read()
     elif verb == "take":
         resp = await do_take()
+    elif verb == "go" and travel_target(args):
+        resp = await do_travel(travel_target(args))
     elif verb == "go":
         resp = await do_go()
     elif verb == "use":
         resp = await do_use()
+    elif verb == "say":
+        resp = await do_say()
     else:
-        resp = web.Response(text="I don't know how to do that.")
+        resp = refuse("I don't know how to do that.")
 
     # Synchronize the local changes of the user_state to the global user_state
     syn_user_state(user_id, user_state)
@@ -820,19 +1281,1167 @@ async def allow_cors(req, handler):
     resp.headers["Access-Control-Allow-Origin"] = "*"
     return resp
 
+# ====================================================== Presence ======================================================
+# Open /listen sockets: user_id -> {WebSocketResponse: queue of messages waiting to be sent on it}
+LISTENERS = {}
+LISTEN_BACKLOG = 64     # Messages queued for a slow socket before newer ones are dropped
+
+# HELPER: Queue a message for the users' listeners on this process; returns how many sockets it went to
+def deliver(message, user_ids):
+    # The message is only queued here, so a room of hundreds costs one pass and never waits on a socket
+    sent = 0
+    for user_id in user_ids:
+        for queue in LISTENERS.get(user_id, {}).values():
+            try:
+                queue.put_nowait(message)
+                sent += 1
+            except asyncio.QueueFull:
+                count("domain_say_dropped_total", ())
+    return sent
+
+# HELPER: Send a message to every listener in the room except the sender; returns how many sockets it went to.
+# Under --workers a user's /listen socket is on the worker their requests are routed to, so the other workers'
+# shares are relayed to them (see relay_handler)
+async def broadcast(app, room, sender, text):
+    message = json.dumps({"room": room, "from": sender, "text": text})
+    count("domain_say_messages_total", ())
+    hearers = room_occupants(room) - {sender}
+    if WORKER_SOCKET is None:
+        return deliver(message, hearers)
+    shares = {}
+    for user_id in hearers:
+        shares.setdefault(WORKER_SOCKETS[worker_for(user_id)], []).append(user_id)
+    async def relay(path, user_ids):
+        if path == WORKER_SOCKET:
+            return deliver(message, user_ids)
+        try:
+            async with app.client.post("unix:" + path + "/relay", json={"message": message, "users": user_ids},
+                                       headers={"Authorization": "Bearer " + ADMIN_TOKEN}) as resp:
+                return (await resp.json())["sent"]
+        except Exception as ex:
+            print("ERROR: relaying a message to the worker at", path, "did not work", repr(ex))
+            count("domain_say_dropped_total", (), len(user_ids))
+            return 0
+    return sum(await asyncio.gather(*(relay(path, user_ids) for path, user_ids in shares.items())))
+
+# Another worker's broadcast(): {"message", "users"} to deliver to those users' listeners here
+@routes.post("/relay")
+async def relay_handler(req: Request) -> Response:
+    denied = check_admin(req)
+    if denied is not None:
+        return denied
+    data = await req.json()
+    return json_response({"sent": deliver(data["message"], data["users"])})
+
+# HELPER: Send queued messages on the socket until it closes
+async def pump_messages(ws, queue):
+    while True:
+        await ws.send_str(await queue.get())
+
+@routes.get("/listen")
+async def listen_handler(req: Request) -> Response:
+    # Initialization
+    try:
+        user_id = int(req.query["user"])
+    except (KeyError, ValueError):
+        return web.Response(status=400, text="Say which user is listening.")
+    if ("token" in req.query or REQUIRE_TOKEN) and not verify_token(req.query.get("token"), user_id):
+        return web.Response(status=403, text="Your session is not valid here; please log in again.")
+
+    # Messages said in the user's room are pushed as they happen
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(req)
+    queue = asyncio.Queue(maxsize=LISTEN_BACKLOG)
+    LISTENERS.setdefault(user_id, {})[ws] = queue
+    pump = asyncio.create_task(pump_messages(ws, queue))
+    try:
+        # Nothing is expected from the client; this just waits for it to go away
+        async for msg in ws:
+            pass
+    finally:
+        pump.cancel()
+        del LISTENERS[user_id][ws]
+        if not LISTENERS[user_id]:
+            del LISTENERS[user_id]
+    return ws
+
+async def close_listeners(app):
+    for sockets in list(LISTENERS.values()):
+        for ws in list(sockets):
+            await ws.close(code=web.WSCloseCode.GOING_AWAY, message=b"Server shutting down")
+
+# ====================================================== Admission Control ======================================================
+# Limits on /command traffic, adjustable at runtime through /admin/limits
+LIMITS = {
+    "rate": 10.0,           # Commands per second each user may sustain
+    "burst": 20,            # Commands a user may send at once after being idle
+    "concurrency": 512,     # /command requests in progress at once before shedding load
+    "batch": 20,            # Most commands in one macro request
+}
+BUCKETS = {}        # user_id -> [tokens, time.monotonic() of last refill]
+IN_FLIGHT = 0       # /command requests currently being handled
+
+# HELPER: Spend cost of the user's tokens (one per command); returns 0 if allowed, else seconds until enough are available
+def take_token(user_id, cost=1):
+    now = time.monotonic()
+    bucket = BUCKETS.get(user_id)
+    if bucket is None:
+        bucket = BUCKETS[user_id] = [LIMITS["burst"], now]
+    bucket[0] = min(LIMITS["burst"], bucket[0] + (now - bucket[1]) * LIMITS["rate"])
+    bucket[1] = now
+    if bucket[0] >= cost:
+        bucket[0] -= cost
+        return 0
+    return (cost - bucket[0]) / LIMITS["rate"] if LIMITS["rate"] > 0 else 60
+
+# HELPER: A 429 response telling the client when to try again
+def too_many(wait, why):
+    return web.Response(status=429, text=why, headers={"Retry-After": str(max(1, math.ceil(wait)))})
+
+@web.middleware
+async def shed_load(req, handler):
+    # Refuse commands beyond the global concurrency cap rather than queueing them
+    global IN_FLIGHT
+    if req.path != "/command":
+        return await handler(req)
+    if IN_FLIGHT >= LIMITS["concurrency"]:
+        return too_many(1, "The domain is busy; try again shortly.")
+    IN_FLIGHT += 1
+    try:
+        return await handler(req)
+    finally:
+        IN_FLIGHT -= 1
+
+# Current admission-control limits
+@routes.get("/admin/limits")
+async def get_limits_handler(req: Request) -> Response:
+    denied = check_admin(req)
+    if denied is not None:
+        return denied
+    return json_response(LIMITS)
+
+# Change some or all of the admission-control limits, e.g. {"rate": 5}
+@routes.post("/admin/limits")
+async def set_limits_handler(req: Request) -> Response:
+    denied = check_admin(req)
+    if denied is not None:
+        return denied
+    try:
+        data = await req.json()
+    except:
+        return json_response(status=400, data={"error": "JSON data required"})
+    if not isinstance(data, dict) or any(k not in LIMITS for k in data):
+        return json_response(status=400, data={"error": "Known limits are " + ", ".join(LIMITS)})
+    if any(not isinstance(v, (int, float)) or isinstance(v, bool) or v < 0 for v in data.values()):
+        return json_response(status=400, data={"error": "Limits must be non-negative numbers"})
+    LIMITS.update(data)
+    return json_response(LIMITS)
+
+# ====================================================== Metrics ======================================================
+# Metric definitions: name -> (type, help, histogram buckets)
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+METRIC_INFO = {
+    "domain_requests_total": ("counter", "Requests handled, by route, command verb and status", None),
+    "domain_request_seconds": ("histogram", "Request latency, by route and command verb", LATENCY_BUCKETS),
+    "domain_outbound_requests_total": ("counter", "Calls made to the hub, by peer, path and status", None),
+    "domain_outbound_seconds": ("histogram", "Latency of calls made to the hub, by peer and path", LATENCY_BUCKETS),
+    "domain_user_evictions_total": ("counter", "Idle users moved from memory to the spill file", None),
+    "domain_user_rehydrations_total": ("counter", "Users loaded back from the spill file", None),
+    "domain_hub_calls_per_command": ("histogram", "Hub round trips made while handling one /command, by verb", (0, 1, 2, 4, 8, 16, 32)),
+    "domain_event_loop_lag_seconds": ("histogram", "How late the event loop ran a timer scheduled every LAG_INTERVAL", LATENCY_BUCKETS),
+    "domain_event_loop_stalls_total": ("counter", "Times a single callback blocked the event loop for over STALL_THRESHOLD", None),
+    "domain_say_messages_total": ("counter", "Messages said with [say]", None),
+    "domain_say_dropped_total": ("counter", "Copies of said messages dropped because a listener's backlog was full", None),
+}
+# Recorded values, keyed by (name, ((label,value),...)); histograms hold per-bucket counts then the sum
+METRIC_VALUES = {}
+DOMAIN_VERBS = ("look", "read", "take", "go", "use", "say")
+# Per-request hub round-trip counter ([n] while a /command is being handled)
+HUB_CALLS = contextvars.ContextVar("HUB_CALLS", default=None)
+
+# HELPER: Add to a counter
+def count(name, labels, by=1):
+    key = (name, labels)
+    METRIC_VALUES[key] = METRIC_VALUES.get(key, 0) + by
+
+# HELPER: Record one sample in a histogram
+def observe(name, labels, value):
+    key = (name, labels)
+    buckets = METRIC_INFO[name][2]
+    h = METRIC_VALUES.get(key)
+    if h is None:
+        h = METRIC_VALUES[key] = [0] * (len(buckets) + 2)
+    h[bisect.bisect_left(buckets, value)] += 1
+    h[-1] += value
+
+# HELPER: Render every metric in the Prometheus text exposition format
+def render_metrics():
+    def fmt(labels):
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+    lines = []
+    for name, (kind, text, buckets) in METRIC_INFO.items():
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (n, labels), value in list(METRIC_VALUES.items()):
+            if n != name:
+                continue
+            if kind == "counter":
+                lines.append(f"{name}{fmt(labels)} {value}")
+                continue
+            total = 0
+            for le, hits in zip(buckets + ("+Inf",), value):
+                total += hits
+                lines.append(f"{name}_bucket{fmt(labels + (('le', le),))} {total}")
+            lines.append(f"{name}_sum{fmt(labels)} {value[-1]}")
+            lines.append(f"{name}_count{fmt(labels)} {total}")
+    gauges = {
+        "domain_user_states": ("Users with state held in memory by this domain", len(USER_STATES)),
+        "domain_known_items": ("Items this domain knows the details of", len(ID_2_ITEM)),
+        "domain_listeners": ("Users with a /listen socket open", len(LISTENERS)),
+        "domain_event_loop_lag_last_seconds": ("Most recently measured event loop lag", LOOP_LAG),
+    }
+    for name, (text, value) in gauges.items():
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+@routes.get("/metrics")
+async def metrics_handler(req: Request) -> Response:
+    return web.Response(text=render_metrics(), content_type="text/plain")
+
+@web.middleware
+async def record_metrics(req, handler):
+    resource = req.match_info.route.resource
+    route = resource.canonical if resource is not None else "unmatched"
+    calls = None
+    if route == "/command":
+        calls = [0]
+        HUB_CALLS.set(calls)
+    start = time.perf_counter()
+    status = 500
+    try:
+        resp = await handler(req)
+        status = resp.status
+        return resp
+    except web.HTTPException as ex:
+        status = ex.status
+        raise
+    finally:
+        labels = (("route", route), ("verb", req.get("verb", "")))
+        observe("domain_request_seconds", labels, time.perf_counter() - start)
+        count("domain_requests_total", labels + (("status", status),))
+        if calls is not None:
+            observe("domain_hub_calls_per_command", (("verb", req.get("verb", "")),), calls[0])
+
+# HELPER: aiohttp client hooks that time every call to the hub and count round trips per command
+def outbound_tracing():
+    from aiohttp import TraceConfig
+    async def on_start(session, ctx, params):
+        ctx.start = time.perf_counter()
+        calls = HUB_CALLS.get()
+        if calls is not None:
+            calls[0] += 1
+        ctx.parent = CURRENT_SPAN.get()
+        if ctx.parent is not None:
+            ctx.span = (ctx.parent[0], new_id(8), ctx.parent[2])
+            ctx.wall = time.time()
+            params.headers[TRACE_HEADER] = f"00-{ctx.span[0]}-{ctx.span[1]}-{'01' if ctx.span[2] else '00'}"
+    def finish(ctx, params, status):
+        labels = (("peer", str(params.url.origin())), ("path", params.url.path))
+        observe("domain_outbound_seconds", labels, time.perf_counter() - ctx.start)
+        count("domain_outbound_requests_total", labels + (("status", status),))
+        if ctx.parent is not None and ctx.span[2]:
+            write_span(params.method + " " + str(params.url), ctx.span, ctx.parent[1], ctx.wall, time.time(), {"status": status})
+    async def on_end(session, ctx, params):
+        finish(ctx, params, params.response.status)
+    async def on_error(session, ctx, params):
+        finish(ctx, params, "error")
+    trace = TraceConfig()
+    trace.on_request_start.append(on_start)
+    trace.on_request_end.append(on_end)
+    trace.on_request_exception.append(on_error)
+    return trace
+
+# ====================================================== Tracing ======================================================
+# W3C traceparent headers to and from the hub, spans written in the Chrome trace-event JSON format
+# (loadable by Perfetto, chrome://tracing or speedscope)
+TRACE_HEADER = "traceparent"
+TRACE_SAMPLE_RATE = 0.0         # Fraction of browser-originated /command requests traced (--trace-sample)
+TRACE_FILE = "domain-trace.json"  # Where sampled spans go (--trace-file), rotated to .1, .2, ... when full
+TRACE_MAX_BYTES = 16 * 1024 * 1024
+TRACE_BACKUPS = 3
+TRACE_OUT = None                # The open trace file, created on the first sampled span
+CURRENT_SPAN = contextvars.ContextVar("CURRENT_SPAN", default=None)  # (trace_id, span_id, sampled)
+
+# HELPER: A random lowercase hex identifier
+def new_id(nbytes):
+    return f"{random.getrandbits(nbytes * 8):0{nbytes * 2}x}"
+
+# HELPER: (trace_id, parent_span_id, sampled) from a traceparent header, or None
+def parse_traceparent(header):
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    return (parts[1], parts[2], bool(flags & 1))
+
+# HELPER: Start a fresh trace file, shifting the older ones along
+def open_trace_file():
+    global TRACE_OUT
+    if TRACE_OUT is not None:
+        TRACE_OUT.close()
+    for i in range(TRACE_BACKUPS - 1, 0, -1):
+        if os.path.exists(f"{TRACE_FILE}.{i}"):
+            os.replace(f"{TRACE_FILE}.{i}", f"{TRACE_FILE}.{i + 1}")
+    if os.path.exists(TRACE_FILE):
+        os.replace(TRACE_FILE, TRACE_FILE + ".1")
+    TRACE_OUT = open(TRACE_FILE, "w")
+    # The closing ] is optional in this format, so events can simply be appended
+    TRACE_OUT.write("[\n" + json.dumps({"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": "domain"}}) + ",\n")
+
+# HELPER: Append one finished span to the trace file
+def write_span(name, me, parent_id, start, end, args):
+    if TRACE_OUT is None or TRACE_OUT.tell() > TRACE_MAX_BYTES:
+        open_trace_file()
+    TRACE_OUT.write(json.dumps({
+        "name": name, "cat": "domain", "ph": "X",
+        "ts": int(start * 1e6), "dur": int((end - start) * 1e6),
+        "pid": os.getpid(), "tid": int(me[0][:8], 16),
+        "args": {"trace_id": me[0], "span_id": me[1], "parent_id": parent_id} | args,
+    }) + ",\n")
+
+# HELPER: Time a unit of work as a child of parent (default: the current span); no-op outside a trace
+@contextlib.contextmanager
+def span(name, parent=None, **args):
+    if parent is None:
+        parent = CURRENT_SPAN.get()
+    if parent is None:
+        yield None
+        return
+    me = (parent[0], new_id(8), parent[2])
+    token = CURRENT_SPAN.set(me)
+    start = time.time()
+    try:
+        yield me
+    finally:
+        CURRENT_SPAN.reset(token)
+        if me[2]:
+            write_span(name, me, parent[1], start, time.time(), args)
+
+@web.middleware
+async def trace_requests(req, handler):
+    # Continue the hub's trace; commands straight from the browser start their own
+    parent = parse_traceparent(req.headers.get(TRACE_HEADER))
+    if parent is None:
+        if req.path != "/command":
+            return await handler(req)
+        parent = (new_id(16), None, random.random() < TRACE_SAMPLE_RATE)
+    with span(req.method + " " + req.path, parent) as me:
+        resp = await handler(req)
+        resp.headers["X-Trace-Id"] = me[0]
+        return resp
+
+# ====================================================== Traffic Recording ======================================================
+# Every /command appended to RECORD_FILE as one compact JSON object per line, for bench/replay.py:
+# {"t": unix time, "srv": "domain", "path", "user", "cmd" or "cmds", "status", "ms"} (tokens are left out)
+RECORD_FILE = None      # Where to record (--record); nothing is recorded while None
+RECORD_OUT = None       # The open record file
+
+@web.middleware
+async def record_traffic(req, handler):
+    if RECORD_OUT is None or req.path != "/command":
+        return await handler(req)
+    body = await req.read() if req.can_read_body else b""
+    start, before = time.time(), time.perf_counter()
+    status = 500
+    try:
+        resp = await handler(req)
+        status = resp.status
+        return resp
+    except web.HTTPException as ex:
+        status = ex.status
+        raise
+    finally:
+        entry = {"t": round(start, 4), "srv": "domain", "path": req.path}
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = {}
+        if isinstance(data, dict):
+            for key, short in (("user", "user"), ("command", "cmd"), ("commands", "cmds")):
+                if key in data:
+                    entry[short] = data[key]
+        entry["status"] = status
+        entry["ms"] = round((time.perf_counter() - before) * 1000, 2)
+        RECORD_OUT.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+# ====================================================== Shared State ======================================================
+# With a STATE_STORE (--state-store: the default under --workers, and opt-in for a single process that should
+# carry on after a restart without registering again) users are kept in a store every worker process can reach,
+# instead of only in memory: user_lock reads the user's state from it before each /arrive,
+# /depart and /command and writes it back after, so whichever worker gets a user's next request carries on
+# from there. The registration and the domain-wide tables (ID_2_ITEM, NAME_2_ID, DOMAIN_LOCS, DOMAIN_ITS)
+# are shared too, read before and merged back after every request that changed them.
+STATE_STORE = None      # The open store; None keeps everything in this process
+STATE_STORE_URL = None  # Which one, e.g. "sqlite:domain-state.sqlite" (--state-store)
+SHARED_SEEN = None      # (version, shared globals) as last read from or written to the store
+
+# Local embedded store: one SQLite file (in WAL mode) that processes on this host open together
+class SQLiteStore:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=10, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS user_states (user_id TEXT PRIMARY KEY, state TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS shared (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL, data TEXT NOT NULL)")
+        # Only arrived users are indexed by room, so looking a room up never touches those who have left
+        self.db.execute("CREATE INDEX IF NOT EXISTS arrived_rooms ON user_states (json_extract(state, '$.loc')) WHERE json_extract(state, '$.arrived')")
+
+    # The user's state, or None if the store has never seen them
+    def get_user(self, user_id):
+        row = self.db.execute("SELECT state FROM user_states WHERE user_id = ?", (json.dumps(user_id),)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put_user(self, user_id, state):
+        self.db.execute("INSERT OR REPLACE INTO user_states VALUES (?, ?)", (json.dumps(user_id), json.dumps(state)))
+
+    def clear_users(self):
+        self.db.execute("DELETE FROM user_states")
+
+    # Users in the store
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM user_states").fetchone()[0]
+
+    # (user_id, state) of every stored user who is arrived in the domain
+    def arrived_users(self):
+        for user_id, state in self.db.execute("SELECT user_id, state FROM user_states WHERE json_extract(state, '$.arrived')"):
+            yield json.loads(user_id), json.loads(state)
+
+    # The users arrived in room whose state was last written at or after time.time() value since
+    def room_users(self, room, since):
+        return [json.loads(user_id) for (user_id,) in self.db.execute(
+            "SELECT user_id FROM user_states WHERE json_extract(state, '$.arrived') AND json_extract(state, '$.loc') = ? "
+            "AND json_extract(state, '$.seen') >= ?", (room, since))]
+
+    # (version, shared globals), or None if nothing was shared yet or the store is still at version
+    def get_shared(self, version=None):
+        row = self.db.execute("SELECT version, data FROM shared WHERE id = 0").fetchone()
+        if row is None or row[0] == version:
+            return None
+        return row[0], json.loads(row[1])
+
+    # Replace the shared globals with merge(the stored ones or None), atomically; returns the new (version, data)
+    def update_shared(self, merge):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT version, data FROM shared WHERE id = 0").fetchone()
+            version, data = (row[0], json.loads(row[1])) if row is not None else (0, None)
+            data = merge(data)
+            self.db.execute("INSERT OR REPLACE INTO shared VALUES (0, ?, ?)", (version + 1, json.dumps(data)))
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return version + 1, data
+
+    def close(self):
+        self.db.close()
+
+# Local single-process store kept in memory: every change is appended to a journal file as it happens, and
+# once the journal has grown as long as the snapshot, a new snapshot is written in the background and the
+# journals it covers are deleted. Opening loads the snapshot then replays the newer journals.
+# Every user's state stays in memory, evicted or not, so it suits small domains only; --max-users does not bound it.
+#   where.snapshot   {"journal": first journal not in it, "version", "shared", "users": {user key: state JSON}}
+#   where.journal.N  one ["user", user key, state], ["clear", null, null] or ["shared", version, data] per line
+class JournalStore:
+    COMPACT_MIN = 1000      # Journal lines before a compaction is worth it, however few users there are
+
+    def __init__(self, where):
+        self.where = where
+        self.users = {}         # json.dumps(user_id) -> json.dumps(state)
+        self.version, self.shared = 0, None
+        self.compactor = None   # The thread writing a snapshot, while one is
+        self.lines = 0          # Lines in the journals since the snapshot
+        first = 0
+        if os.path.exists(where + ".snapshot"):
+            with open(where + ".snapshot") as f:
+                snapshot = json.load(f)
+            first, self.version, self.shared, self.users = snapshot["journal"], snapshot["version"], snapshot["shared"], snapshot["users"]
+        gens = sorted(int(name.rsplit(".", 1)[1]) for name in os.listdir(os.path.dirname(where) or ".")
+                      if name.startswith(os.path.basename(where) + ".journal.") and name.rsplit(".", 1)[1].isdigit())
+        for gen in gens:
+            if gen < first:
+                os.unlink(self.journal_path(gen))   # a compaction finished but was stopped before deleting it
+                continue
+            with open(self.journal_path(gen)) as f:
+                for line in f:
+                    try:
+                        kind, key, value = json.loads(line)
+                    except ValueError:
+                        continue                    # torn by a crash mid-write
+                    self.lines += 1
+                    if kind == "user":
+                        self.users[key] = json.dumps(value)
+                    elif kind == "clear":
+                        self.users.clear()
+                    else:
+                        self.version, self.shared = key, value
+        self.gen = max(gens + [first - 1]) + 1
+        self.journal = open(self.journal_path(self.gen), "a", buffering=1)
+
+    def journal_path(self, gen):
+        return f"{self.where}.journal.{gen}"
+
+    # Append one change to the journal (flushed to the OS per line, so it survives the process dying)
+    def log(self, kind, key, value):
+        self.journal.write(json.dumps([kind, key, value], separators=(",", ":")) + "\n")
+        self.lines += 1
+        if self.lines >= max(self.COMPACT_MIN, len(self.users)) and self.compactor is None:
+            self.compact()
+
+    def get_user(self, user_id):
+        state = self.users.get(json.dumps(user_id))
+        return json.loads(state) if state is not None else None
+
+    def put_user(self, user_id, state):
+        self.users[json.dumps(user_id)] = json.dumps(state)
+        self.log("user", json.dumps(user_id), state)
+
+    def clear_users(self):
+        self.users.clear()
+        self.log("clear", None, None)
+
+    # Users in the store
+    def __len__(self):
+        return len(self.users)
+
+    # (user_id, state) of every stored user who is arrived in the domain (most are not, so skip parsing those)
+    def arrived_users(self):
+        for key, state in self.users.items():
+            if '"arrived": true' in state:
+                yield json.loads(key), json.loads(state)
+
+    # The users arrived in room whose state was last written at or after time.time() value since
+    def room_users(self, room, since):
+        found = []
+        for user_id, state in self.arrived_users():
+            if state["loc"] == room and state.get("seen", 0) >= since:
+                found.append(user_id)
+        return found
+
+    def get_shared(self, version=None):
+        if self.shared is None or self.version == version:
+            return None
+        return self.version, self.shared
+
+    def update_shared(self, merge):
+        self.version, self.shared = self.version + 1, merge(self.shared)
+        self.log("shared", self.version, self.shared)
+        return self.version, self.shared
+
+    # Start a new journal and snapshot everything before it on a thread; wait for it if background is False
+    def compact(self, background=True):
+        self.journal.close()
+        self.gen += 1
+        self.journal = open(self.journal_path(self.gen), "a", buffering=1)
+        self.lines = 0
+        snapshot = {"journal": self.gen, "version": self.version, "shared": self.shared, "users": dict(self.users)}
+        self.compactor = threading.Thread(target=self.write_snapshot, args=(snapshot,), daemon=True)
+        self.compactor.start()
+        if not background:
+            self.compactor.join()
+
+    # Compaction thread body: the snapshot replaces the old one only once it is completely on disk
+    def write_snapshot(self, snapshot):
+        with open(self.where + ".snapshot.tmp", "w") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.where + ".snapshot.tmp", self.where + ".snapshot")
+        for gen in range(snapshot["journal"] - 1, -1, -1):
+            if not os.path.exists(self.journal_path(gen)):
+                break
+            os.unlink(self.journal_path(gen))
+        self.compactor = None
+
+    # Leave one snapshot and an empty journal behind, so the next start has nothing to replay
+    def close(self):
+        if self.compactor is not None:
+            self.compactor.join()
+        self.compact(background=False)
+        self.journal.close()
+
+# Store kinds by URL scheme; another backend (e.g. over the network, for workers on several hosts) needs the same methods
+STORE_KINDS = {
+    "sqlite": SQLiteStore,
+    "journal": JournalStore,
+}
+
+# HELPER: The store kind and location named by a "kind:where" URL
+def parse_store_url(url):
+    kind, _, where = url.partition(":")
+    if kind not in STORE_KINDS or not where:
+        raise ValueError(f"Unknown state store {url!r}; expected one of " + ", ".join(k + ":..." for k in STORE_KINDS))
+    return kind, where
+
+# HELPER: Open the store named by a "kind:where" URL
+def open_store(url):
+    kind, where = parse_store_url(url)
+    return STORE_KINDS[kind](where)
+
+# HELPER: This process's copy of everything the workers share (item ids become strings, as in JSON)
+def shared_globals():
+    return {
+        "hub_url": HUB_URL,
+        "domain_id": DOMAIN_ID,
+        "domain_secret": DOMAIN_SECRET,
+        "items": {str(item_id): info for item_id, info in ID_2_ITEM.items()},
+        "names": dict(NAME_2_ID),
+        "locs": dict(DOMAIN_LOCS),
+        "its": dict(DOMAIN_ITS),
+    }
+
+# HELPER: Take the shared globals read from the store as this process's own
+def adopt_shared(version, data):
+    global HUB_URL, DOMAIN_ID, DOMAIN_SECRET, TOKEN_KEY, SHARED_SEEN
+    if data["domain_secret"] is not None and data["domain_secret"] != DOMAIN_SECRET:
+        TOKEN_KEY = token_key(data["domain_secret"])
+    HUB_URL, DOMAIN_ID, DOMAIN_SECRET = data["hub_url"], data["domain_id"], data["domain_secret"]
+    ID_2_ITEM.clear()
+    ID_2_ITEM.update({int(item_id): info for item_id, info in data["items"].items()})
+    NAME_2_ID.clear()
+    NAME_2_ID.update(data["names"])
+    ITEM_NAMES.clear()
+    for item_id, info in ID_2_ITEM.items():
+        ITEM_NAMES.add(info["name"], item_id)
+    DOMAIN_LOCS.update(data["locs"])
+    DOMAIN_ITS.update(data["its"])
+    SHARED_SEEN = (version, shared_globals())
+
+# HELPER: Merge what this process changed since it last synced into the stored shared globals
+def push_shared():
+    mine = shared_globals()
+    if SHARED_SEEN is not None and mine == SHARED_SEEN[1]:
+        return
+    seen = SHARED_SEEN[1] if SHARED_SEEN is not None else None
+    registration = ("hub_url", "domain_id", "domain_secret")
+    def merge(theirs):
+        if theirs is None:
+            return mine
+        merged = dict(theirs)
+        # A /newhub handled here replaces the registration; otherwise whatever another worker registered stands
+        if mine["hub_url"] is not None and (seen is None or any(mine[k] != seen[k] for k in registration)):
+            merged.update({k: mine[k] for k in registration})
+        # Items are only ever learned, and rooms and items only ever get visited
+        merged["items"] = theirs["items"] | mine["items"]
+        merged["names"] = theirs["names"] | mine["names"]
+        merged["locs"] = {k: theirs["locs"].get(k, False) or v for k, v in mine["locs"].items()}
+        merged["its"] = {k: theirs["its"].get(k, False) or v for k, v in mine["its"].items()}
+        return merged
+    adopt_shared(*STATE_STORE.update_shared(merge))
+
+@web.middleware
+async def share_globals(req, handler):
+    if STATE_STORE is None:
+        return await handler(req)
+    fresh = STATE_STORE.get_shared(SHARED_SEEN[0] if SHARED_SEEN is not None else None)
+    if fresh is not None:
+        adopt_shared(*fresh)
+    try:
+        return await handler(req)
+    finally:
+        push_shared()
+
+# Open the store, taking up the registration and the users it holds from before a restart
+async def open_state_store(app):
+    global STATE_STORE
+    if STATE_STORE_URL is None:
+        return
+    start = time.perf_counter()
+    STATE_STORE = open_store(STATE_STORE_URL)
+    fresh = STATE_STORE.get_shared()
+    if fresh is not None:
+        adopt_shared(*fresh)
+    # Workers read presence from the store itself (see room_occupants), so only a lone process puts everyone back in their rooms
+    arrived = 0
+    if WORKER_SOCKET is None:
+        # Held and placed as if just seen, so they leave their rooms again if they stay idle
+        for user_id, state in STATE_STORE.arrived_users():
+            adopt_user_state(user_id, state)
+            touch_user(user_id)
+            arrived += 1
+    if HUB_URL is not None and WORKER_SOCKET is None:
+        print(f"Restored domain {DOMAIN_ID} of hub {HUB_URL} and {arrived} arrived users from {STATE_STORE_URL} in {(time.perf_counter()-start)*1000:.0f} ms")
+
+async def close_state_store(app):
+    if STATE_STORE is not None:
+        STATE_STORE.close()
+
+# ====================================================== Workers ======================================================
+# --workers N runs N copies of this server, each listening on its own Unix socket and sharing the STATE_STORE,
+# behind a router in this process that listens on --host/--port (and --unix) and sends each request to a worker
+# picked by its user id. One user's requests therefore always meet the same per-user lock, while the store
+# keeps them correct on any worker should the routing change (a different N after a restart, say).
+# Requests without a user (/newhub, /metrics, /admin/...) go to the first worker; /admin/limits goes to all,
+# and a batched /arrive is split between the workers of its users.
+WORKER_SOCKETS = []     # Each worker's socket path, in routing order (known to the workers too, to relay [say])
+WORKER_SOCKET = None    # The socket this process serves on as a worker (--worker-socket)
+BROADCAST_PATHS = {"/admin/limits"}
+# Not copied between the client and a worker (aiohttp sets them for each side itself)
+HOP_HEADERS = {"Connection", "Keep-Alive", "Transfer-Encoding", "Content-Length", "Content-Encoding", "Upgrade", "Host"}
+
+# HELPER: The socket of each of n workers, in routing order
+def worker_sockets(directory, n):
+    return [os.path.join(directory, f"worker-{i}.sock") for i in range(n)]
+
+# HELPER: Which worker handles a user's requests (the same in every run, unlike hash() of a str)
+def worker_for(user_id):
+    if user_id is None:
+        return 0
+    return zlib.crc32(str(user_id).encode()) % len(WORKER_SOCKETS)
+
+# HELPER: The user a request is about, from its ?user= or its JSON body's "user", or None
+def request_user(req, body):
+    if "user" in req.query:
+        return req.query["user"]
+    if body[:1] == b"{":
+        try:
+            return json.loads(body).get("user")
+        except ValueError:
+            pass
+    return None
+
+# HELPER: Relay messages from one WebSocket to the other until src closes
+async def relay_messages(src, dst):
+    from aiohttp import WSMsgType
+    async for msg in src:
+        if msg.type == WSMsgType.TEXT:
+            await dst.send_str(msg.data)
+        elif msg.type == WSMsgType.BINARY:
+            await dst.send_bytes(msg.data)
+
+# HELPER: Send every worker its own users' share of a batched /arrive at once; answers with the worst status
+async def route_arrivals(req, batch, headers):
+    shares = {}
+    for body in batch["users"]:
+        shares.setdefault(worker_for(body.get("user") if isinstance(body, dict) else None), []).append(body)
+    async def send(i, bodies):
+        async with req.app.worker_clients[i].post("http://worker/arrive", json=batch | {"users": bodies}, headers=headers) as resp:
+            await resp.read()
+            return resp.status
+    return web.Response(status=max(await asyncio.gather(*(send(i, bodies) for i, bodies in shares.items())), default=200))
+
+async def route_request(req: Request) -> Response:
+    body = await req.read()
+    target = worker_for(request_user(req, body))
+    headers = {k: v for k, v in req.headers.items() if k not in HOP_HEADERS}
+    clients = req.app.worker_clients
+
+    if req.method == "POST" and req.path == "/arrive" and b'"users"' in body:
+        try:
+            batch = json.loads(body)
+        except ValueError:
+            batch = None
+        if isinstance(batch, dict) and isinstance(batch.get("users"), list):
+            return await route_arrivals(req, batch, headers)
+
+    if req.headers.get("Upgrade", "").lower() == "websocket":
+        ws = web.WebSocketResponse()
+        await ws.prepare(req)
+        async with clients[target].ws_connect("http://worker" + req.path_qs, headers=headers) as upstream:
+            to_client = asyncio.create_task(relay_messages(upstream, ws))
+            await relay_messages(ws, upstream)
+            to_client.cancel()
+        return ws
+
+    targets = range(len(clients)) if req.method == "POST" and req.path in BROADCAST_PATHS else [target]
+    first = None
+    for i in targets:
+        async with clients[i].request(req.method, "http://worker" + req.path_qs, data=body, headers=headers) as resp:
+            answer = web.Response(status=resp.status, body=await resp.read(),
+                                  headers={k: v for k, v in resp.headers.items() if k not in HOP_HEADERS})
+        first = first or answer
+    return first
+
+# Start the workers and wait until every one is listening
+async def start_workers(app):
+    from aiohttp import ClientSession, UnixConnector
+    import subprocess
+    argv = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--state-store", STATE_STORE_URL, "--admin-token", ADMIN_TOKEN]
+    app.workers = [subprocess.Popen(argv + ["--worker-socket", path], stdout=subprocess.DEVNULL) for path in WORKER_SOCKETS]
+    for _ in range(100):
+        if all(os.path.exists(path) for path in WORKER_SOCKETS):
+            break
+        if any(worker.poll() is not None for worker in app.workers):
+            raise RuntimeError("A worker exited during startup")
+        await asyncio.sleep(0.1)
+    app.worker_clients = [ClientSession(connector=UnixConnector(path=path)) for path in WORKER_SOCKETS]
+
+async def stop_workers(app):
+    for client in app.worker_clients:
+        await client.close()
+    for worker in app.workers:
+        worker.terminate()
+    for worker in app.workers:
+        worker.wait()
+
+# ====================================================== Profiling ======================================================
+# On-demand sampling profiler: a background thread periodically snapshots the event-loop
+# thread's stack and tallies collapsed stacks ("outer;...;inner count", as flamegraph.pl expects)
+PROFILING = None    # While running: {"routes": set, "users": set, "frames": set of middleware frames of selected requests}
+
+# HELPER: file:function label for one stack frame
+def frame_name(frame):
+    code = frame.f_code
+    return os.path.basename(code.co_filename) + ":" + getattr(code, "co_qualname", code.co_name)
+
+# HELPER: Profiler thread body; only counts stacks passing through a frame in selected, if given
+def sample_stacks(thread_id, interval, stop, stacks, selected):
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            return
+        if frame.f_code.co_name == "select" and frame.f_code.co_filename.endswith("selectors.py"):
+            continue  # idle event loop
+        names = []
+        chosen = selected is None
+        while frame is not None:
+            if not chosen and frame in selected:
+                chosen = True
+            names.append(frame_name(frame))
+            frame = frame.f_back
+        if chosen:
+            key = ";".join(reversed(names))
+            stacks[key] = stacks.get(key, 0) + 1
+
+# Sample the event loop for {"seconds", "interval", "routes", "users"} and return collapsed stacks
+@routes.post("/admin/profile")
+async def profile_handler(req: Request) -> Response:
+    global PROFILING
+    denied = check_admin(req)
+    if denied is not None:
+        return denied
+    try:
+        data = await req.json() if req.can_read_body else {}
+    except:
+        return json_response(status=400, data={"error": "JSON data required"})
+    if PROFILING is not None:
+        return json_response(status=409, data={"error": "A profile is already being taken"})
+    try:
+        seconds = min(60, max(0, float(data.get("seconds", 10))))
+        interval = max(0.001, float(data.get("interval", 0.005)))
+    except (TypeError, ValueError):
+        return json_response(status=400, data={"error": "seconds and interval must be numbers"})
+    filtered = "routes" in data or "users" in data
+    PROFILING = {"routes": set(data.get("routes", ())), "users": set(data.get("users", ())), "frames": set()}
+    stacks = {}
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_stacks, daemon=True,
+        args=(threading.get_ident(), interval, stop, stacks, PROFILING["frames"] if filtered else None))
+    # Without a short GIL switch interval the sampler mostly wakes when the loop is idle
+    switch = sys.getswitchinterval()
+    sys.setswitchinterval(min(switch, interval/5))
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stop.set()
+        sampler.join()
+        sys.setswitchinterval(switch)
+        PROFILING = None
+    return web.Response(text="".join(f"{k} {v}\n" for k, v in sorted(stacks.items())))
+
+@web.middleware
+async def mark_profiled(req, handler):
+    # While a filtered profile runs, mark the requests it selected by their frame
+    if PROFILING is None or not (PROFILING["routes"] or PROFILING["users"]):
+        return await handler(req)
+    chosen = req.path in PROFILING["routes"]
+    if not chosen and PROFILING["users"] and req.can_read_body:
+        try:
+            chosen = (await req.json()).get("user") in PROFILING["users"]
+        except:
+            pass
+    if not chosen:
+        return await handler(req)
+    marks = PROFILING["frames"]
+    me = sys._getframe()
+    marks.add(me)
+    try:
+        return await handler(req)
+    finally:
+        marks.discard(me)
+
+# ====================================================== Watchdog ======================================================
+# A timer measures event-loop lag, and a thread captures the loop's stack whenever that
+# timer is overdue by more than STALL_THRESHOLD (i.e. some callback is blocking the loop)
+LAG_INTERVAL = 0.1              # Seconds between lag measurements
+STALL_THRESHOLD = 0.25          # Seconds of blocking worth a stack capture (--stall-threshold)
+LOOP_LAG = 0.0                  # Latest lag measurement
+HEARTBEAT = time.monotonic()    # When the lag timer was last scheduled
+STALLS = collections.deque(maxlen=20)   # Recent captures: {"at", "seconds", "stack"}
+
+# HELPER: Runs forever, recording how late each LAG_INTERVAL sleep wakes up
+async def measure_lag():
+    global LOOP_LAG, HEARTBEAT
+    loop = asyncio.get_running_loop()
+    while True:
+        HEARTBEAT = time.monotonic()
+        before = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        LOOP_LAG = max(0.0, loop.time() - before - LAG_INTERVAL)
+        observe("domain_event_loop_lag_seconds", (), LOOP_LAG)
+
+# HELPER: Watchdog thread body, capturing the loop thread's stack once per stall
+def watch_loop(thread_id, stop):
+    stall = None
+    while not stop.wait(STALL_THRESHOLD / 4):
+        late = time.monotonic() - HEARTBEAT - LAG_INTERVAL
+        if late <= STALL_THRESHOLD:
+            stall = None
+        elif stall is None:
+            frame = sys._current_frames().get(thread_id)
+            stall = {"at": time.time(), "seconds": late, "stack": "".join(traceback.format_stack(frame)) if frame else ""}
+            STALLS.append(stall)
+            count("domain_event_loop_stalls_total", ())
+            print(f"WARNING: event loop blocked for over {STALL_THRESHOLD}s in:\n{stall['stack']}", file=sys.stderr)
+        else:
+            stall["seconds"] = late
+
+# Recent event-loop stalls with the stack that was running, newest last
+@routes.get("/admin/stalls")
+async def stalls_handler(req: Request) -> Response:
+    denied = check_admin(req)
+    if denied is not None:
+        return denied
+    return json_response(list(STALLS))
+
+async def start_watchdog(app):
+    app.lag_timer = asyncio.create_task(measure_lag())
+    app.watchdog_stop = threading.Event()
+    threading.Thread(target=watch_loop, args=(threading.get_ident(), app.watchdog_stop), daemon=True).start()
+
+async def stop_watchdog(app):
+    app.watchdog_stop.set()
+    app.lag_timer.cancel()
+
+# ====================================================== Memory ======================================================
+# Approximate deep sizes of the global structures, and tracemalloc snapshots each diffed
+# against the one before to find what keeps growing. With --workers each worker answers
+# for itself; ?user= picks the worker as it does for any other request
+MEMORY_STRUCTURES = ("USER_STATES", "ID_2_ITEM", "NAME_2_ID", "ITEM_NAMES", "DOMAIN_LOCS", "LAST_SEEN", "ROOM_OCCUPANTS",
+                     "USER_LOCKS", "LISTENERS", "BUCKETS", "METRIC_VALUES", "SHARED_SEEN", "STALLS", "STATE_STORE")
+MEMORY_SNAPSHOT = None  # The last tracemalloc snapshot taken, compared against by the next diff
+MEMORY_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+# HELPER: Approximate bytes held by root and everything it reaches, each object counted once.
+# Containers are followed, as are the attributes of objects of classes defined in this file;
+# anything else (sockets, locks, ...) counts only its own size. So a JournalStore counts with every user in its
+# users dict, while a SQLiteStore's users, on disk or in SQLite's page cache, are not included
+def deep_size(root):
+    size, seen, todo = 0, set(), [root]
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            todo.extend(obj.keys())
+            todo.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            todo.extend(obj)
+        elif type(obj).__module__ == __name__:
+            if hasattr(obj, "__dict__"):
+                todo.append(obj.__dict__)
+            todo.extend(getattr(obj, slot) for slot in getattr(type(obj), "__slots__", ()) if hasattr(obj, slot))
+    return size
+
+# HELPER: The process's resident set size, from /proc on Linux
+def resident_bytes():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+# HELPER: Start, diff or stop tracemalloc; a diff lists the top allocation sites by growth since the last snapshot
+def memory_trace(action, top, frames):
+    global MEMORY_SNAPSHOT
+    if action == "stop":
+        tracemalloc.stop()
+        MEMORY_SNAPSHOT = None
+        return {"tracing": False}
+    if action == "start" and not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    snapshot = tracemalloc.take_snapshot().filter_traces(MEMORY_FILTERS)
+    current, peak = tracemalloc.get_traced_memory()
+    result = {"tracing": True, "traced_bytes": current, "peak_bytes": peak}
+    if action == "diff":
+        key = "traceback" if tracemalloc.get_traceback_limit() > 1 else "lineno"
+        result["growth"] = [
+            {"where": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+             "size_diff": stat.size_diff, "count_diff": stat.count_diff, "size": stat.size, "count": stat.count}
+            for stat in snapshot.compare_to(MEMORY_SNAPSHOT, key)[:top]
+        ]
+    MEMORY_SNAPSHOT = snapshot
+    return result
+
+# Report approximate memory use per global structure, and optionally trace allocations:
+# {"structures": names from MEMORY_STRUCTURES (default all), "trace": "start" | "diff" | "stop",
+#  "top": sites listed by a diff (default 25), "frames": traceback depth recorded from "start" on (default 1)}
+# Sizing walks every object on the event loop, so it stalls the domain while it runs
+@routes.post("/admin/memory")
+async def memory_handler(req: Request) -> Response:
+    denied = check_admin(req)
+    if denied is not None:
+        return denied
+    try:
+        data = await req.json() if req.can_read_body else {}
+    except:
+        return json_response(status=400, data={"error": "JSON data required"})
+    names = data.get("structures", MEMORY_STRUCTURES)
+    if not isinstance(names, list | tuple) or any(name not in MEMORY_STRUCTURES for name in names):
+        return json_response(status=400, data={"error": "structures must be a list of: " + ", ".join(MEMORY_STRUCTURES)})
+    action = data.get("trace")
+    if action not in (None, "start", "diff", "stop"):
+        return json_response(status=400, data={"error": "trace must be start, diff or stop"})
+    if action == "diff" and MEMORY_SNAPSHOT is None:
+        return json_response(status=409, data={"error": "Tracing is not started"})
+    try:
+        top = max(0, int(data.get("top", 25)))
+        frames = min(100, max(1, int(data.get("frames", 1))))
+    except (TypeError, ValueError):
+        return json_response(status=400, data={"error": "top and frames must be integers"})
+
+    report = {"rss_bytes": resident_bytes()}
+    # Snapshot before sizing so the walk's own allocations are not in the diff
+    if action is not None:
+        report["tracemalloc"] = memory_trace(action, top, frames)
+    report["structures"] = {}
+    for name in names:
+        obj = globals()[name]
+        report["structures"][name] = {"bytes": deep_size(obj), "entries": len(obj) if hasattr(obj, "__len__") else None}
+    return json_response(report)
+
+@web.middleware
+async def honour_deadline(req, handler):
+    # No header means no deadline (e.g. commands sent straight from the browser)
+    if DEADLINE_HEADER not in req.headers:
+        return await handler(req)
+    try:
+        left = int(req.headers[DEADLINE_HEADER]) / 1000
+    except ValueError:
+        return json_response(status=400, data={"error": "Malformed " + DEADLINE_HEADER + " header"})
+    if left <= 0:
+        return json_response(status=504, data={"error": "Deadline exceeded"})
+    DEADLINE.set(time.monotonic() + left)
+    try:
+        return await asyncio.wait_for(handler(req), left)
+    except asyncio.TimeoutError:
+        return json_response(status=504, data={"error": "Deadline exceeded"})
+
+# Posts to http:// peers over TCP and to unix:/path/to/socket peers over that Unix socket
+class PeerClient:
+    def __init__(self, **kwargs):
+        from aiohttp import ClientSession
+        self.kwargs = kwargs
+        self.tcp = ClientSession(**kwargs)
+        self.unix = {}      # socket path -> ClientSession using a UnixConnector to it
+
+    # Like ClientSession.post; every hub endpoint is one path segment, so a unix: URL splits at its last /
+    def post(self, url, **kwargs):
+        if not url.startswith("unix:"):
+            return self.tcp.post(url, **kwargs)
+        sock, _, endpoint = url[len("unix:"):].rpartition("/")
+        session = self.unix.get(sock)
+        if session is None:
+            from aiohttp import ClientSession, UnixConnector
+            session = self.unix[sock] = ClientSession(connector=UnixConnector(path=sock), **self.kwargs)
+        return session.post("http://unix/" + endpoint, **kwargs)
+
+    async def close(self):
+        await self.tcp.close()
+        for session in self.unix.values():
+            await session.close()
+
 async def start_session(app):
-    from aiohttp import ClientSession, ClientTimeout
-    app.client = ClientSession(timeout=ClientTimeout(total=3))
+    global RECORD_OUT
+    from aiohttp import ClientTimeout
+    app.client = PeerClient(timeout=ClientTimeout(total=3), trace_configs=[outbound_tracing()])
+    if RECORD_FILE is not None:
+        RECORD_OUT = open(RECORD_FILE, "a", buffering=1)
 
 async def end_session(app):
     await app.client.close()
+    if TRACE_OUT is not None:
+        TRACE_OUT.flush()
+    if RECORD_OUT is not None:
+        RECORD_OUT.close()
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', type=str, default="0.0.0.0")
     parser.add_argument('-p','--port', type=int, default=3400)
+    parser.add_argument('--trace-sample', type=float, default=TRACE_SAMPLE_RATE, help='fraction of /command requests from browsers to trace')
+    parser.add_argument('--trace-file', type=str, default=TRACE_FILE, help='where to write sampled spans')
+    parser.add_argument('--allow-missing-token', action='store_true', help='trust requests without a session token, for hubs that do not issue them')
+    parser.add_argument('--user-ttl', type=float, default=USER_TTL, help='seconds before an idle user is moved out of memory')
+    parser.add_argument('--max-users', type=int, default=MAX_USERS, help='most users to keep in memory')
+    parser.add_argument('--spill-file', type=str, default=SPILL_FILE, help='SQLite file holding evicted users (with --state-store none)')
+    parser.add_argument('--record', type=str, default=None, help='append every /command to this file, for bench/replay.py')
+    parser.add_argument('--unix', type=str, default=None, help='also listen on this Unix socket, for a hub on this host')
+    parser.add_argument('--stall-threshold', type=float, default=STALL_THRESHOLD, help='seconds a callback may block the event loop before its stack is captured')
+    parser.add_argument('--admin-token', type=str, default=None, help='bearer token for /admin/... endpoints (random if omitted)')
+    parser.add_argument('--state-store', type=str, default=None, help='keep the registration and users in this store, e.g. to carry on after a restart: sqlite:PATH '
+                        '(default sqlite:domain-state.sqlite with --workers, which need a store they can share), '
+                        'journal:PATH (all users held in memory; not with --workers) or none (default otherwise)')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes behind a router that spreads users over them')
+    parser.add_argument('--worker-socket', type=str, default=None, help=argparse.SUPPRESS)  # set by the router for its workers
     args = parser.parse_args()
+    TRACE_SAMPLE_RATE = args.trace_sample
+    TRACE_FILE = args.trace_file
+    import secrets
+    ADMIN_TOKEN = args.admin_token or secrets.token_urlsafe(12)
+    STALL_THRESHOLD = args.stall_threshold
+    REQUIRE_TOKEN = not args.allow_missing_token
+    USER_TTL = args.user_ttl
+    MAX_USERS = args.max_users
+    SPILL_FILE = args.spill_file
+    RECORD_FILE = args.record
+    UNIX_PATH = args.unix
+    STATE_STORE_URL = args.state_store
+    WORKER_SOCKET = args.worker_socket
+    if STATE_STORE_URL is None:
+        STATE_STORE_URL = "sqlite:domain-state.sqlite" if args.workers > 1 else "none"
+    if STATE_STORE_URL == "none":
+        if args.workers > 1:
+            parser.error("--workers need a store they can all open, e.g. --state-store sqlite:domain-state.sqlite")
+        STATE_STORE_URL = None
+    else:
+        try:
+            kind, _ = parse_store_url(STATE_STORE_URL)
+        except ValueError as ex:
+            parser.error(str(ex))
+        if kind == "journal" and args.workers > 1:
+            parser.error("--workers need a store they can all open, e.g. --state-store sqlite:domain-state.sqlite")
+    for path in (UNIX_PATH, WORKER_SOCKET):
+        if path and os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)     # left behind by an earlier run
 
     import socket
     whoami = socket.getfqdn()
@@ -840,11 +2449,35 @@ if __name__ == '__main__':
     whoami += ':'+str(args.port)
     whoami = 'http://' + whoami
     print("URL to type into web prompt:\n\t"+whoami)
+    print("Admin token:\n\t"+ADMIN_TOKEN)
     print()
 
     from aiohttp.web import Application
-    app = Application(middlewares=[allow_cors])
+    if args.workers > 1 and WORKER_SOCKET is None:
+        import shutil, tempfile
+        sockets = tempfile.mkdtemp(prefix="newdomain-workers-")
+        WORKER_SOCKETS = worker_sockets(sockets, args.workers)
+        front = Application()
+        front.on_startup.append(start_workers)
+        front.on_cleanup.append(stop_workers)
+        front.router.add_route("*", "/{path:.*}", route_request)
+        web.run_app(front, host=args.host, port=args.port, path=UNIX_PATH)
+        shutil.rmtree(sockets, ignore_errors=True)
+        sys.exit()
+
+    app = Application(middlewares=[allow_cors, share_globals, record_metrics, record_traffic, shed_load, trace_requests, honour_deadline, mark_profiled])
+    app.on_startup.append(open_state_store)
     app.on_startup.append(start_session)
+    app.on_startup.append(start_watchdog)
+    app.on_startup.append(start_evictor)
+    app.on_shutdown.append(close_listeners)
     app.on_shutdown.append(end_session)
+    app.on_shutdown.append(stop_watchdog)
+    app.on_shutdown.append(stop_evictor)
+    app.on_cleanup.append(close_state_store)
     app.add_routes(routes)
-    web.run_app(app, host=args.host, port=args.port)
+    if WORKER_SOCKET is not None:
+        WORKER_SOCKETS = worker_sockets(os.path.dirname(WORKER_SOCKET), args.workers)
+        web.run_app(app, host=None, port=None, path=WORKER_SOCKET, print=None)
+    else:
+        web.run_app(app, host=args.host, port=args.port, path=UNIX_PATH)
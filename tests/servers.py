@@ -0,0 +1,120 @@
+"""A real hub.py and newdomain.py on unused ports, for tests that need both servers as they are run
+
+    async with Deployment(domain_args=['--workers', '2']) as game:
+        me = await game.login()
+        status, text = await game.command(me, 'look')
+
+The domain runs in a temporary directory, so any state store or spill file it writes
+is thrown away with it; the hub runs from the repository, where it finds tba.html.
+"""
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+
+import aiohttp
+from aiohttp.test_utils import unused_port
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+ADMIN = 'test-admin-token'
+AUTH = {'Authorization': 'Bearer '+ADMIN}
+
+
+class Deployment:
+    """A hub and one domain, registered and in play mode, with admission limits lifted"""
+    def __init__(self, domain_args=(), hub_args=()):
+        self.domain_args, self.hub_args = list(domain_args), list(hub_args)
+        self.hub_port, self.domain_port = unused_port(), unused_port()
+        self.hub, self.domain = f'http://localhost:{self.hub_port}', f'http://localhost:{self.domain_port}'
+        self.processes = {}
+
+    def start(self, which : str) -> subprocess.Popen:
+        if which == 'hub':
+            argv, cwd = ['hub.py', '-p', str(self.hub_port)] + self.hub_args, ROOT
+        else:
+            argv, cwd = ['newdomain.py', '-p', str(self.domain_port)] + self.domain_args, self.tmp.name
+        log = open(os.path.join(self.tmp.name, which+'.log'), 'a')
+        self.processes[which] = subprocess.Popen([sys.executable, os.path.join(ROOT, argv[0])] + argv[1:] + ['--admin-token', ADMIN],
+                                                 cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        log.close()
+        return self.processes[which]
+
+    def log(self, which : str) -> str:
+        with open(os.path.join(self.tmp.name, which+'.log')) as f:
+            return f.read()
+
+    async def wait_up(self, url : str, which : str) -> None:
+        for _ in range(200):
+            if self.processes[which].poll() is not None:
+                raise RuntimeError(f'{which} exited:\n{self.log(which)}')
+            try:
+                async with self.session.get(url) as r:
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.05)
+        raise RuntimeError(f'{url} never came up')
+
+    async def start_domain(self) -> None:
+        self.start('domain')
+        await self.wait_up(self.domain+'/metrics', 'domain')
+        await self.admin(self.domain, '/admin/limits', {'rate':1e9, 'burst':1e9, 'concurrency':1e9})
+
+    async def restart_domain(self, how : signal.Signals = signal.SIGTERM) -> None:
+        """Stop the domain (politely or not) and start it again on the same port and directory"""
+        domain = self.processes['domain']
+        domain.send_signal(how)
+        domain.wait()
+        await self.start_domain()
+
+    async def __aenter__(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.session = aiohttp.ClientSession()
+        try:
+            self.start('hub')
+            await self.wait_up(self.hub+'/mode', 'hub')
+            await self.admin(self.hub, '/admin/limits', {'rate':1e9, 'burst':1e9, 'concurrency':1e9})
+            await self.start_domain()
+            async with self.session.post(self.hub+'/domain', data=self.domain) as r:
+                assert r.status == 200, await r.text()
+            async with self.session.post(self.hub+'/mode', data='play') as r:
+                assert r.status == 200, await r.text()
+        except BaseException:
+            await self.__aexit__()
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        for p in self.processes.values():
+            if p.poll() is None:
+                p.terminate()
+        for p in self.processes.values():
+            p.wait()
+        await self.session.close()
+        self.tmp.cleanup()
+
+    async def admin(self, url : str, path : str, body : dict):
+        async with self.session.post(url+path, json=body, headers=AUTH) as r:
+            assert r.status == 200, await r.text()
+            return await r.json()
+
+    async def login(self) -> dict:
+        async with self.session.get(self.hub+'/login') as r:
+            assert r.status == 200, await r.text()
+            return await r.json()
+
+    async def command(self, player : dict, *words : str, **body) -> tuple[int, str]:
+        """A domain command as the front-end sends it (with the player's token unless body says otherwise)"""
+        body = {'user':player['id'], 'token':player['token'], 'command':list(words)} | body
+        async with self.session.post(self.domain+'/command', json=body) as r:
+            return r.status, await r.text()
+
+    async def hub_command(self, player : dict, *words : str) -> tuple[int, str]:
+        async with self.session.post(self.hub+'/command', json={'user':player['id'], 'secret':player['secret'], 'command':list(words)}) as r:
+            return r.status, await r.text()
+
+    def listen(self, player : dict):
+        """The player's /listen socket, as an async context manager"""
+        return self.session.ws_connect(f"{self.domain}/listen?user={player['id']}&token={player['token']}")
@@ -0,0 +1,157 @@
+"""Tests for hub.py: the leaderboard, bulk provisioning, batched arrivals, completion and the front-end"""
+import gzip
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from servers import AUTH, Deployment
+import hub
+
+
+class LeaderboardTest(unittest.TestCase):
+    def test_ties_are_in_user_order(self):
+        board = hub.Leaderboard()
+        for uid, total in [(5, 1.5), (2, 1.5), (9, 3.0), (7, 1.5), (1, 0.5)]:
+            board.update(uid, total)
+        self.assertEqual(board.top(4, 10), [(9, 3.0), (2, 1.5), (5, 1.5), (7, 1.5)])
+        self.assertEqual([board.rank(uid) for uid in (9, 2, 7, 1, 0)], [1, 2, 2, 5, 6])
+
+    def test_moving_between_totals(self):
+        board = hub.Leaderboard()
+        board.update(3, 1.0)
+        board.update(4, 1.0)
+        board.update(3, 2.0)
+        board.update(4, 0)
+        self.assertEqual(board.top(3, 5), [(3, 2.0), (0, 0.0), (1, 0.0)])
+        self.assertEqual(board.members, {2000: [3]})
+        self.assertEqual(board.total(4), 0.0)
+
+
+async def stub_domain(handler) -> TestServer:
+    """A domain that only answers /arrive, with handler"""
+    app = web.Application()
+    app.router.add_post('/arrive', handler)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+
+class ArriveManyTest(unittest.IsolatedAsyncioTestCase):
+    """arrive_many against a stub domain, with the hub's globals set up by hand"""
+    async def asyncSetUp(self):
+        self.arrived = []
+        self.app = web.Application()
+        await hub.start_session(self.app)
+
+    async def asyncTearDown(self):
+        await hub.end_session(self.app)
+        await self.server.close()
+        hub.domains.clear()
+        hub.users.clear()
+
+    async def arrive_many(self, handler) -> set:
+        self.server = await stub_domain(handler)
+        hub.domains[0] = {'peer':str(self.server.make_url('')).rstrip('/'), 'secret':'s', 'loot':[]}
+        self.uids = [hub.users.add(secret, 0) for secret in hub.make_secrets(3)]
+        return await hub.arrive_many(self.uids, 0, self.app)
+
+    async def test_batch_accepted(self):
+        async def handler(req):
+            self.arrived += [body['user'] for body in (await req.json())['users']]
+            return web.Response()
+        self.assertEqual(await self.arrive_many(handler), set())
+        self.assertEqual(self.arrived, self.uids)
+
+    async def test_refused_batch_falls_back(self):
+        async def handler(req):
+            data = await req.json()
+            if 'users' in data: return web.Response(status=400)
+            self.arrived.append(data['user'])
+            return web.Response()
+        self.assertEqual(await self.arrive_many(handler), set())
+        self.assertEqual(self.arrived, self.uids)
+
+    async def test_broken_batch_falls_back_and_reports_failures(self):
+        async def handler(req):
+            data = await req.json()
+            if 'users' in data:
+                req.transport.close() # as if the domain died mid-request
+                return web.Response()
+            self.arrived.append(data['user'])
+            return web.Response(status=500 if data['user'] == self.uids[1] else 200)
+        self.assertEqual(await self.arrive_many(handler), {self.uids[1]})
+        self.assertEqual(self.arrived, self.uids)
+
+
+class HubTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.game = await Deployment().__aenter__()
+
+    async def asyncTearDown(self):
+        await self.game.__aexit__()
+
+    async def test_provision(self):
+        game = self.game
+        async with game.session.post(game.hub+'/admin/users', json={'count':30}) as r:
+            self.assertEqual(r.status, 401)
+        async with game.session.post(game.hub+'/admin/users', json={'count':0}, headers=AUTH) as r:
+            self.assertEqual(r.status, 400)
+        players = await game.admin(game.hub, '/admin/users', {'count':30})
+        self.assertEqual(len({p['id'] for p in players}), 30)
+        self.assertTrue(all({'id', 'secret', 'token', 'domain'} <= p.keys() and 'arrived' not in p for p in players))
+        for p in players[::7]:
+            status, text = await game.command(p, 'look')
+            self.assertEqual(status, 200)
+            self.assertIn('lobby', text)
+
+    async def test_leaderboard(self):
+        game = self.game
+        me, other = await game.login(), await game.login()
+        for words in [('go', 'west'), ('take', 'torch'), ('use', 'torch'), ('go', 'east')]:
+            await game.command(me, *words)
+        await game.hub_command(me, 'journey', 'east') # comes back with the dagger, another domain's item
+        for words in [('go', 'west'), ('use', 'dagger', 'altar'), ('go', 'west')]:
+            await game.command(me, *words)
+        async with game.session.get(game.hub+'/leaderboard', params={'user':me['id'], 'k':2}) as r:
+            board = await r.json()
+        self.assertEqual(board['score'], 0.5) # half the domain's rooms unlocked
+        self.assertEqual(board['rank'], 1)
+        self.assertEqual(board['top'][0], {'user':me['id'], 'score':board['score']})
+        self.assertEqual(board['top'][1], {'user':min(set(range(board['users']))-{me['id']}), 'score':0.0})
+        async with game.session.get(game.hub+'/leaderboard', params={'user':999}) as r:
+            self.assertEqual(r.status, 404)
+
+    async def test_complete_and_drop_by_prefix(self):
+        game = self.game
+        me = await game.login()
+        await game.command(me, 'take', 'parchment')
+        async with game.session.post(game.hub+'/complete', json={'user':me['id'], 'secret':me['secret'], 'prefix':'pa'}) as r:
+            self.assertEqual(await r.json(), ['parchment'])
+        status, text = await game.hub_command(me, 'drop', 'parch')
+        self.assertIn('dropped', text)
+        async with game.session.post(game.hub+'/complete', json={'user':me['id'], 'secret':me['secret'], 'prefix':'pa'}) as r:
+            self.assertEqual(await r.json(), [])
+
+    async def test_malformed_commands(self):
+        me = await self.game.login()
+        self.assertEqual((await self.game.hub_command(me))[0], 400)
+        self.assertEqual((await self.game.hub_command(me, 'inventory'))[0], 200)
+
+    async def test_front_end_is_compressed_and_revalidated(self):
+        game = self.game
+        async with game.session.get(game.hub+'/', headers={'Accept-Encoding':'gzip'}, auto_decompress=False) as r:
+            body, etag = await r.read(), r.headers['ETag']
+            self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(r.headers['Vary'], 'Accept-Encoding')
+        with open(hub.os.path.join(hub.os.path.dirname(hub.__file__), 'tba.html'), 'rb') as f:
+            self.assertEqual(gzip.decompress(body), f.read())
+        async with game.session.get(game.hub+'/', headers={'Accept-Encoding':'gzip', 'If-None-Match':etag}) as r:
+            self.assertEqual(r.status, 304)
+        async with game.session.get(game.hub+'/', headers={'Accept-Encoding':'identity', 'If-None-Match':etag}) as r:
+            self.assertEqual(r.status, 200)
+            self.assertNotIn('Content-Encoding', r.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
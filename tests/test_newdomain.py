@@ -0,0 +1,159 @@
+"""Tests for newdomain.py run as it is deployed: session tokens, presence and say, eviction and state stores"""
+import asyncio
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import unittest
+import zlib
+
+import aiohttp
+
+from servers import ROOT, Deployment
+
+
+class DomainTest(unittest.IsolatedAsyncioTestCase):
+    """One Deployment per test, started with domain_args"""
+    domain_args = ()
+
+    async def asyncSetUp(self):
+        self.game = await Deployment(domain_args=self.domain_args).__aenter__()
+
+    async def asyncTearDown(self):
+        await self.game.__aexit__()
+
+    def also_here(self, text : str) -> set[int]:
+        """The users a look says are in the room"""
+        return {int(uid) for uid in re.findall(r'user #(\d+)', text.partition('Also here:')[2])}
+
+    async def heard(self, ws) -> dict:
+        return json.loads((await ws.receive(timeout=5)).data)
+
+
+class TokenTest(DomainTest):
+    async def test_commands_need_a_valid_token(self):
+        game = self.game
+        me, other = await game.login(), await game.login()
+        self.assertEqual((await game.command(me, 'look', token=None))[0], 403)
+        self.assertEqual((await game.command(me, 'look', token=other['token']))[0], 403)
+        self.assertEqual((await game.command(me, 'look', token=me['token'][:-2]+'xx'))[0], 403)
+        self.assertEqual((await game.command(me, 'look'))[0], 200)
+        async with game.session.post(game.domain+'/complete', json={'user':me['id'], 'prefix':'pa'}) as r:
+            self.assertEqual(r.status, 403)
+        async with game.session.post(game.domain+'/complete', json={'user':me['id'], 'token':me['token'], 'prefix':'pa'}) as r:
+            self.assertEqual(await r.json(), ['parchment'])
+
+    async def test_listening_needs_a_valid_token(self):
+        game = self.game
+        me, other = await game.login(), await game.login()
+        for query in (f"user={me['id']}", f"user={me['id']}&token={other['token']}"):
+            with self.assertRaises(aiohttp.WSServerHandshakeError) as caught:
+                await game.session.ws_connect(f"{game.domain}/listen?{query}")
+            self.assertEqual(caught.exception.status, 403)
+
+
+class PresenceTest(DomainTest):
+    async def test_others_in_the_room_are_shown(self):
+        game = self.game
+        me, other = await game.login(), await game.login()
+        status, text = await game.command(me, 'look')
+        self.assertIn(f"Also here: user #{other['id']}.", text)
+        await game.command(other, 'go', 'west')
+        status, text = await game.command(me, 'look')
+        self.assertNotIn('Also here', text)
+        status, text = await game.command(other, 'look')
+        self.assertNotIn('Also here', text)
+
+    async def test_say_reaches_listeners_in_the_room(self):
+        game = self.game
+        me, other, away = await game.login(), await game.login(), await game.login()
+        await game.command(away, 'go', 'west')
+        status, text = await game.command(me, 'say', 'hello')
+        self.assertIn('Nobody seems to be listening', text)
+        async with game.listen(other) as ws, game.listen(away) as far:
+            await asyncio.sleep(0.2) # the sockets are registered just after the handshake
+            status, text = await game.command(me, 'say', 'hello', '<there>')
+            self.assertEqual(text, 'You say: hello &lt;there&gt;')
+            self.assertEqual(await self.heard(ws), {'room':'lobby', 'from':me['id'], 'text':f"User #{me['id']} says: hello &lt;there&gt;"})
+            with self.assertRaises(asyncio.TimeoutError):
+                await far.receive(timeout=0.3)
+
+
+class EvictionTest(DomainTest):
+    domain_args = ('--max-users', '1')
+
+    async def test_evicted_users_leave_their_room(self):
+        game = self.game
+        me, other = await game.login(), await game.login()
+        await game.command(other, 'go', 'west')
+        await game.command(other, 'go', 'east')
+        status, text = await game.command(me, 'look') # holding me evicts the other user
+        self.assertEqual(status, 200)
+        self.assertNotIn('Also here', text)
+        status, text = await game.command(other, 'look') # and they come back where they were, with their state
+        self.assertIn("You're back in the main lobby.", text)
+        self.assertNotIn('Also here', text)
+
+
+class WorkersTest(DomainTest):
+    domain_args = ('--workers', '2')
+
+    async def test_presence_and_say_cross_workers(self):
+        game = self.game
+        # Requests are routed by user, so log in until there is a player on each worker
+        players = {}
+        while len(players) < 2:
+            me = await game.login()
+            players.setdefault(zlib.crc32(str(me['id']).encode()) % 2, me)
+        me, other = players[0], players[1]
+        status, text = await game.command(me, 'look')
+        self.assertIn(other['id'], self.also_here(text))
+        async with game.listen(other) as ws:
+            await asyncio.sleep(0.2)
+            status, text = await game.command(me, 'say', 'hello')
+            self.assertEqual(text, 'You say: hello')
+            self.assertEqual((await self.heard(ws))['text'], f"User #{me['id']} says: hello")
+        await game.command(other, 'go', 'west')
+        status, text = await game.command(me, 'look')
+        self.assertNotIn(other['id'], self.also_here(text))
+
+
+class StoreTest(unittest.IsolatedAsyncioTestCase):
+    async def test_restart_restores_users(self):
+        for store in ('sqlite:state.sqlite', 'journal:state'):
+            for how in (signal.SIGTERM, signal.SIGKILL):
+                with self.subTest(store=store, signal=how.name):
+                    async with Deployment(domain_args=['--state-store', store]) as game:
+                        me = await game.login()
+                        await game.command(me, 'take', 'parchment')
+                        await game.command(me, 'go', 'west')
+                        await game.restart_domain(how)
+                        self.assertIn('Restored domain', game.log('domain'))
+                        status, text = await game.command(me, 'look')
+                        self.assertEqual(status, 200)
+                        self.assertIn('hallway', text)
+                        status, text = await game.command(me, 'go', 'east')
+                        self.assertIn('lobby', text)
+                        other = await game.login() # the registration came back too
+                        status, text = await game.command(other, 'look')
+                        self.assertIn(f"Also here: user #{me['id']}.", text)
+
+    async def test_no_store_by_default(self):
+        async with Deployment() as game:
+            me = await game.login()
+            await game.command(me, 'go', 'west')
+            self.assertEqual(sorted(os.listdir(game.tmp.name)), ['domain.log', 'hub.log']) # the domain wrote nothing of its own
+
+    def test_workers_need_a_shared_store(self):
+        for store in ('none', 'journal:state'):
+            with self.subTest(store=store):
+                done = subprocess.run([sys.executable, os.path.join(ROOT, 'newdomain.py'), '--workers', '2', '--state-store', store],
+                                      capture_output=True, text=True, timeout=30)
+                self.assertEqual(done.returncode, 2)
+                self.assertIn('--workers need a store they can all open', done.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()